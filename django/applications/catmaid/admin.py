@@ -10,7 +10,8 @@ from catmaid.models import BrokenSlice, Overlay
 from catmaid.control.importer import importer_admin_view
 from catmaid.control.classificationadmin import classification_admin_view
 from catmaid.control.annotationadmin import ImportingWizard
-from catmaid.views import UseranalyticsView, UserProficiencyView
+from catmaid.views import UseranalyticsView, UserProficiencyView, \
+        InstrumentationView
 
 
 def duplicate_action(modeladmin, request, queryset):
@@ -241,6 +242,8 @@ admin.site.register_view('useranalytics', 'User Analytics',
                          view=UseranalyticsView.as_view())
 admin.site.register_view('userproficiency', 'User Proficiency',
                          view=UserProficiencyView.as_view())
+admin.site.register_view('instrumentation', 'Request statistics',
+                         view=InstrumentationView.as_view())
 admin.site.register_view('classificationadmin',
                          'Tag Based Classification Graph Linker',
                          view=classification_admin_view)
@@ -25,18 +25,16 @@ def analyze_skeletons(request, project_id=None):
     cursor = connection.cursor()
 
     query = '''
-        SELECT tc2.skeleton_id
-        FROM treenode_connector tc1,
-             treenode_connector tc2,
+        SELECT sc.skeleton_b
+        FROM skeleton_connectivity sc,
              relation r1,
              relation r2
-        WHERE tc1.skeleton_id IN (%s)
-          AND tc1.relation_id = r1.id
+        WHERE sc.skeleton_a IN (%s)
+          AND sc.relation_a = r1.id
           AND %s
-          AND tc1.connector_id = tc2.connector_id
-          AND tc2.relation_id = r2.id
+          AND sc.relation_b = r2.id
           AND %s
-        GROUP BY tc2.skeleton_id'''
+        GROUP BY sc.skeleton_b'''
 
     if 0 == extra:
         # Just skids
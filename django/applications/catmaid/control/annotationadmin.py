@@ -4,6 +4,7 @@ from django.contrib.formtools.wizard.views import SessionWizardView
 from django.db import connection
 from django.shortcuts import render_to_response
 
+from catmaid.control import ontologycache
 from catmaid.models import Class, ClassInstance, ClassInstanceClassInstance
 from catmaid.models import Connector, Project, Relation, Treenode
 
@@ -265,6 +266,7 @@ def copy_annotations(source_pid, target_pid, import_treenodes=True,
                         "isreciprocal": annotated_with_src.isreciprocal,
                         "uri": annotated_with_src.uri,
                     })[0]
+            ontologycache.invalidate(target_pid)
 
             # Get all source annotations and import them into target
             annotations_src = ClassInstance.objects.filter(
@@ -0,0 +1,274 @@
+# An 'arbor' is a tree stored as flat arrays rather than as a networkx graph:
+# an array of node IDs, an array with the index of each node's parent (-1 for
+# the root) and an optional Nx3 array of node locations. All analytics below
+# operate on whole arrays at once.
+
+import numpy as np
+
+
+def _bincount(indices, weights=None, minlength=0):
+    """ Like np.bincount, but also for empty indices, which numpy versions
+    before 1.7 reject. """
+    if 0 == len(indices):
+        return np.zeros(minlength, dtype=np.int64 if weights is None
+                        else np.float64)
+    return np.bincount(indices, weights=weights, minlength=minlength)
+
+
+class Arbor(object):
+
+    def __init__(self, node_ids, parents, locations=None):
+        """ node_ids: array of node IDs
+        parents: array of indices into node_ids, -1 for the root
+        locations: optional Nx3 array of node positions """
+        self.node_ids = np.asarray(node_ids)
+        self.parents = np.asarray(parents, dtype=np.int64)
+        self.locations = None if locations is None else \
+                np.asarray(locations, dtype=np.float64)
+        self._depths = None
+
+    @classmethod
+    def from_ids(cls, node_ids, parent_ids, locations=None):
+        """ Create an arbor from an array of node IDs and an array of parent
+        IDs in the same order, using -1 for the root. Nodes whose parent is not
+        part of node_ids are treated as roots. """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        parent_ids = np.asarray(parent_ids, dtype=np.int64)
+        if 0 == len(node_ids):
+            return cls(node_ids, parent_ids, locations)
+        order = np.argsort(node_ids)
+        sorted_ids = node_ids[order]
+        index = np.searchsorted(sorted_ids, parent_ids)
+        index[index == len(sorted_ids)] = 0
+        found = sorted_ids[index] == parent_ids
+        parents = np.where(found, order[index], -1)
+        return cls(node_ids, parents, locations)
+
+    @classmethod
+    def from_digraph(cls, tree, locations=None):
+        """ Create an arbor from a networkx DiGraph with edges from parent to
+        child. locations: optional dictionary of node ID vs position. """
+        node_ids = tree.nodes()
+        index = dict((node, i) for i, node in enumerate(node_ids))
+        parents = np.empty(len(node_ids), dtype=np.int64)
+        for i, node in enumerate(node_ids):
+            parent = next(tree.predecessors_iter(node), None)
+            parents[i] = -1 if parent is None else index[parent]
+        if locations is not None:
+            locations = [locations[node] for node in node_ids]
+        ids = np.empty(len(node_ids), dtype=object)
+        ids[:] = node_ids
+        return cls(ids, parents, locations)
+
+    def __len__(self):
+        return len(self.parents)
+
+    def roots(self):
+        return np.flatnonzero(self.parents < 0)
+
+    def n_children(self):
+        """ The number of children of every node. """
+        return _bincount(self.parents[self.parents >= 0],
+                         minlength=len(self.parents))
+
+    def depths(self):
+        """ The number of edges from every node to its root, computed by
+        pointer jumping in O(log(depth)) vectorized steps. """
+        if self._depths is None:
+            depths = (self.parents >= 0).astype(np.int64)
+            ancestors = self.parents.copy()
+            jumping = ancestors >= 0
+            while jumping.any():
+                a = ancestors[jumping]
+                depths[jumping] += depths[a]
+                ancestors[jumping] = ancestors[a]
+                jumping = ancestors >= 0
+            self._depths = depths
+        return self._depths
+
+    def levels(self):
+        """ Return a list of index arrays, one for each depth, starting at the
+        roots. """
+        depths = self.depths()
+        if 0 == len(depths):
+            return []
+        order = np.argsort(depths, kind='mergesort')
+        bounds = np.searchsorted(depths[order], np.arange(depths.max() + 2))
+        return [order[bounds[d]:bounds[d+1]] for d in xrange(len(bounds) - 1)]
+
+    def subtree_sums(self, values):
+        """ For every node, the sum of values over the node and all of its
+        descendants. """
+        sums = np.array(values, dtype=np.float64)
+        for level in reversed(self.levels()[1:]):
+            sums += np.bincount(self.parents[level], weights=sums[level],
+                                minlength=len(sums))
+        return sums
+
+    def edge_lengths(self, locations=None):
+        """ The length of the edge from every node to its parent, and zero for
+        root nodes. """
+        if locations is None:
+            locations = self.locations
+        lengths = np.zeros(len(self.parents))
+        child = self.parents >= 0
+        delta = locations[child] - locations[self.parents[child]]
+        lengths[child] = np.sqrt((delta * delta).sum(axis=1))
+        return lengths
+
+    def cable_length(self, locations=None):
+        return self.edge_lengths(locations).sum()
+
+    def end_and_branch_masks(self):
+        """ Return two boolean arrays marking end nodes and branch nodes. A
+        root with a single child counts as an end node and a root with two
+        children as a slab node. """
+        n_children = self.n_children()
+        root = self.parents < 0
+        ends = np.where(root, n_children == 1, n_children == 0)
+        branches = np.where(root, n_children > 2, n_children > 1)
+        return ends, branches
+
+    def smoothed_locations(self, lengths=None):
+        """ Move every slab node to 40% of its own position and 60% of the
+        average position of its neighbors, weighted by their distance. End and
+        branch nodes don't move. """
+        if lengths is None:
+            lengths = self.edge_lengths()
+        n = len(self.parents)
+        child = np.flatnonzero(self.parents >= 0)
+        parent = self.parents[child]
+        # Every edge contributes to both of its nodes
+        a = np.concatenate((child, parent))
+        b = np.concatenate((parent, child))
+        w = np.concatenate((lengths[child], lengths[child]))
+        sum_lengths = _bincount(a, weights=w, minlength=n)
+        weighted = np.column_stack([
+            _bincount(a, weights=w * self.locations[b, k], minlength=n)
+            for k in xrange(3)]) if n else np.zeros((0, 3))
+        nonzero = sum_lengths != 0
+        weighted[nonzero] /= sum_lengths[nonzero][:, np.newaxis]
+        weighted[~nonzero] = 0
+
+        ends, branches = self.end_and_branch_masks()
+        slab = ~(ends | branches)
+        smooth = self.locations.copy()
+        smooth[slab] = self.locations[slab] * 0.4 + weighted[slab] * 0.6
+        return smooth
+
+    def partition(self):
+        """ Partition the arbor into a list of sequences of node indices, with
+        branch nodes repeated as ends of all sequences except the longest one
+        that finishes at the root. Each sequence runs from an end node to
+        either the root or a branch node. """
+        depths = self.depths()
+        ends = np.flatnonzero(self.n_children() == 0)
+        # Iterate end nodes sorted from highest to lowest distance to root
+        ends = ends[np.argsort(-depths[ends], kind='mergesort')]
+        # Walking up is faster on plain lists than on numpy scalars
+        parents = self.parents.tolist()
+        seen = [False] * len(parents)
+        sequences = []
+        for end in ends.tolist():
+            sequence = [end]
+            parent = parents[end]
+            while parent != -1:
+                sequence.append(parent)
+                if seen[parent]:
+                    break
+                seen[parent] = True
+                parent = parents[parent]
+            if len(sequence) > 1:
+                sequences.append(np.array(sequence, dtype=np.int64))
+        return sequences
+
+    def strahler(self):
+        """ The Strahler number of every node: 1 for end nodes, the largest
+        number of the children, increased by one where at least two children
+        share it. """
+        n = len(self.parents)
+        numbers = np.ones(n, dtype=np.int64)
+        highest = np.zeros(n, dtype=np.int64)
+        n_highest = np.zeros(n, dtype=np.int64)
+        has_children = self.n_children() > 0
+        for level in reversed(self.levels()):
+            inner = level[has_children[level]]
+            numbers[inner] = highest[inner] + (n_highest[inner] > 1)
+            level = level[self.parents[level] >= 0]
+            if 0 == len(level):
+                continue
+            # Group by parent to find the highest number among siblings
+            order = np.lexsort((numbers[level], self.parents[level]))
+            parents = self.parents[level][order]
+            values = numbers[level][order]
+            starts = np.flatnonzero(np.concatenate(([True],
+                                                    parents[1:] != parents[:-1])))
+            highest[parents[starts]] = np.maximum.reduceat(values, starts)
+            n_highest += np.bincount(parents,
+                    weights=(values == highest[parents]),
+                    minlength=n).astype(np.int64)
+        return numbers
+
+    def reroot(self, index):
+        """ Return a new arbor with the same nodes, rooted at the node with the
+        given index. """
+        parents = self.parents.copy()
+        previous = -1
+        node = index
+        while node != -1:
+            next_node = parents[node]
+            parents[node] = previous
+            previous = node
+            node = next_node
+        return Arbor(self.node_ids, parents, self.locations)
+
+    def synapse_centrality(self, inputs, outputs, total_inputs=None,
+                           total_outputs=None):
+        """ Compute the synapse centrality of every node, given arrays with the
+        number of inputs and outputs of every node. The centrality is the
+        number of possible paths from inputs to outputs that go through the
+        node, normalized by the number of outputs. The totals default to the
+        sums of inputs and outputs. Returns a tuple of arrays with the number
+        of inputs and outputs seen downstream of every node, the number of
+        possible paths and the centrality. All centralities are -1 if there
+        are no outputs. """
+        inputs = np.asarray(inputs, dtype=np.float64)
+        outputs = np.asarray(outputs, dtype=np.float64)
+        if total_inputs is None:
+            total_inputs = inputs.sum()
+        if total_outputs is None:
+            total_outputs = outputs.sum()
+        n = len(self.parents)
+        if 0 == total_outputs:
+            zeros = np.zeros(n)
+            return zeros, zeros, zeros, -np.ones(n)
+
+        # Ensure the root is an end node
+        arbor = self
+        roots = self.roots()
+        if len(roots) and self.n_children()[roots[0]] > 1:
+            ends = np.flatnonzero(self.n_children() == 0)
+            arbor = self.reroot(ends[0])
+
+        seen_inputs = arbor.subtree_sums(inputs)
+        seen_outputs = arbor.subtree_sums(outputs)
+        n_paths = seen_inputs * (total_outputs - seen_outputs) + \
+                  seen_outputs * (total_inputs - seen_inputs)
+        return seen_inputs, seen_outputs, n_paths, n_paths / float(total_outputs)
+
+
+def arbors_from_rows(rows):
+    """ Given rows of (node ID, parent ID or -1, skeleton ID, x, y, z) sorted
+    by skeleton ID, return a generator of (skeleton ID, Arbor) tuples. """
+    if not rows:
+        return
+    n = len(rows)
+    node_ids = np.fromiter((row[0] for row in rows), np.int64, n)
+    parent_ids = np.fromiter((row[1] for row in rows), np.int64, n)
+    skeleton_ids = np.fromiter((row[2] for row in rows), np.int64, n)
+    locations = np.array([row[3:6] for row in rows], dtype=np.float64)
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(skeleton_ids)) + 1,
+                             [n]))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        yield int(skeleton_ids[start]), Arbor.from_ids(node_ids[start:end],
+                parent_ids[start:end], locations[start:end])
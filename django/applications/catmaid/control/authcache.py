@@ -0,0 +1,112 @@
+""" A cache for the authorization data of users.
+
+The permissions a user has on a project and the domain of users whose work a
+user can edit are needed by nearly every request, but change rarely. Both are
+kept in Django's cache, under keys that include a global version. Any change
+to users, groups, group memberships or object permissions replaces the
+version and with it all entries. Updates that bypass model signals, like
+QuerySet.update(), are only seen after AUTHORIZATION_CACHE_TIMEOUT seconds.
+
+Independent of this, AuthorizationCacheMiddleware keeps a memo of all values
+looked up during a request, so that they are looked up only once per request.
+Like the node list cache, a version replaced during a request is replaced
+again after its transaction has been committed.
+"""
+
+import threading
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User, Group
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from guardian.models import UserObjectPermission, GroupObjectPermission
+
+
+_VERSION_KEY = 'catmaid.auth.version'
+
+# The memo of the current request. Outside of requests there is none.
+_request = threading.local()
+
+
+def enabled():
+    return getattr(settings, 'AUTHORIZATION_CACHE_ENABLED', False)
+
+
+def _version():
+    version = cache.get(_VERSION_KEY)
+    if version is None:
+        cache.add(_VERSION_KEY, uuid.uuid4().hex,
+                  settings.AUTHORIZATION_CACHE_TIMEOUT)
+        version = cache.get(_VERSION_KEY)
+    return version
+
+
+def get(key, load):
+    """ Return the value stored under key, which is created by calling load()
+    if neither the memo of the current request nor Django's cache has it.
+    Values must not be None. """
+    memo = getattr(_request, 'memo', None)
+    if memo is not None and key in memo:
+        return memo[key]
+    if enabled():
+        if memo is not None:
+            if 'version' not in memo:
+                memo['version'] = _version()
+            version = memo['version']
+        else:
+            version = _version()
+        cache_key = 'catmaid.auth.%s.%s' % (version, key)
+        value = cache.get(cache_key)
+        if value is None:
+            value = load()
+            cache.set(cache_key, value, settings.AUTHORIZATION_CACHE_TIMEOUT)
+    else:
+        value = load()
+    if memo is not None:
+        memo[key] = value
+    return value
+
+
+def invalidate():
+    """ Drop all cached authorization data. """
+    memo = getattr(_request, 'memo', None)
+    if memo is not None:
+        memo.clear()
+        _request.pending = True
+    if enabled():
+        cache.set(_VERSION_KEY, uuid.uuid4().hex,
+                  settings.AUTHORIZATION_CACHE_TIMEOUT)
+
+
+def start_request():
+    _request.memo = {}
+    _request.pending = False
+
+
+def end_request():
+    """ Drop the memo of the current request and invalidate the cache once
+    more if it was invalidated during the request. Called by
+    AuthorizationCacheMiddleware after the transaction has been committed.
+    """
+    pending = getattr(_request, 'pending', False)
+    _request.memo = None
+    _request.pending = False
+    if pending:
+        invalidate()
+
+
+def _on_change(sender, **kwargs):
+    # Logins only update the last login time
+    if sender is User and kwargs.get('update_fields') == frozenset(['last_login']):
+        return
+    invalidate()
+
+for model in (User, Group, UserObjectPermission, GroupObjectPermission):
+    post_save.connect(_on_change, sender=model,
+                      dispatch_uid='catmaid.authcache.save.%s' % model.__name__)
+    post_delete.connect(_on_change, sender=model,
+                        dispatch_uid='catmaid.authcache.delete.%s' % model.__name__)
+m2m_changed.connect(_on_change, sender=User.groups.through,
+                    dispatch_uid='catmaid.authcache.groups')
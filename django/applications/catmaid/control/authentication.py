@@ -5,7 +5,7 @@ from functools import wraps
 from itertools import groupby
 
 from guardian.models import UserObjectPermission, GroupObjectPermission
-from guardian.shortcuts import get_perms_for_model
+from guardian.shortcuts import get_perms, get_perms_for_model
 
 from django import forms
 from django.conf import settings
@@ -22,6 +22,7 @@ from django.shortcuts import _get_queryset, render
 
 from catmaid.models import Project, UserRole, ClassInstance, \
         ClassInstanceClassInstance
+from catmaid.control import authcache
 from catmaid.control.common import my_render_to_response
 
 def login_vnc(request):
@@ -97,11 +98,11 @@ def requires_user_role(roles):
 
     def decorated_with_requires_user_role(f):
         def inner_decorator(request, roles=roles, *args, **kwargs):
-            p = Project.objects.get(pk=kwargs['project_id'])
             u = request.user
+            perms = project_permissions(u, kwargs['project_id'])
 
             # Check for admin privs in all cases.
-            has_role = u.has_perm('can_administer', p)
+            has_role = 'can_administer' in perms
 
             if not has_role:
                 # Check the indicated role(s)
@@ -109,9 +110,9 @@ def requires_user_role(roles):
                     roles = [roles]
                 for role in roles:
                     if role == UserRole.Annotate:
-                        has_role = u.has_perm('can_annotate', p)
+                        has_role = 'can_annotate' in perms
                     elif role == UserRole.Browse:
-                        has_role = u.has_perm('can_browse', p)
+                        has_role = 'can_browse' in perms
                     if has_role:
                         break
 
@@ -128,6 +129,15 @@ def requires_user_role(roles):
         return wraps(f)(inner_decorator)
     return decorated_with_requires_user_role
 
+def project_permissions(user, project_id):
+    """ Return the set of codenames of all permissions the user has on the
+    project, including those of the user's groups. A superuser has all of
+    them. """
+    project_id = int(project_id)
+    def load():
+        return frozenset(get_perms(user, Project.objects.get(pk=project_id)))
+    return authcache.get('perms.%s.%s' % (user.id, project_id), load)
+
 def get_objects_and_perms_for_user(user, codenames, klass, use_groups=True, any_perm=False):
     """ Similar to what guardian's get_objects_for_user method does,
     this method return a dictionary of object IDs (!) of model klass
@@ -322,6 +332,8 @@ def user_can_edit(cursor, user_id, other_user_id):
     # The group with identical name to the username is implicit, doesn't have to exist. Therefore, check this edge case before querying:
     if user_id == other_user_id:
         return True
+    if authcache.enabled():
+        return other_user_id in user_domain(cursor, user_id)
     # Retrieve a value larger than zero when the user_id belongs to a group with name equal to that associated with other_user_id
     cursor.execute("""
     SELECT count(*)
@@ -341,20 +353,23 @@ def user_domain(cursor, user_id):
     """ This function returns the set of all other user_id, including the self, that the user has edit rights on via group membership.
     A user can edit nodes of other user(s) when the user belongs to a group named like that other user(s). Belonging to the self group is implicit, and therefore the self group--a group named like the user--doesn't have to exist; the user_id is added to the set in all cases.
     If a user can only edit its own nodes, then the returned set contains only its own user_id. """
-    cursor.execute("""
-    SELECT u2.id
-    FROM auth_user u1,
-         auth_user u2,
-         auth_group g,
-         auth_user_groups ug
-    WHERE u1.id = %s
-      AND u1.id = ug.user_id
-      AND ug.group_id = g.id
-      AND u2.username = g.name
-    """ % int(user_id))
-    domain = set(row[0] for row in cursor.fetchall())
-    domain.add(user_id)
-    return domain
+    user_id = int(user_id)
+    def load():
+        cursor.execute("""
+        SELECT u2.id
+        FROM auth_user u1,
+             auth_user u2,
+             auth_group g,
+             auth_user_groups ug
+        WHERE u1.id = %s
+          AND u1.id = ug.user_id
+          AND ug.group_id = g.id
+          AND u2.username = g.name
+        """ % user_id)
+        domain = set(row[0] for row in cursor.fetchall())
+        domain.add(user_id)
+        return frozenset(domain)
+    return set(authcache.get('domain.%s' % user_id, load))
 
 @requires_user_role([UserRole.Annotate])
 def all_usernames(request, project_id=None):
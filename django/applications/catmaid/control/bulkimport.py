@@ -0,0 +1,352 @@
+""" Bulk import of tracing data through PostgreSQL's COPY.
+
+Data is read from CSV files, one per table of TABLES, each starting with a
+header line naming its columns. Every file is copied into a temporary staging
+table with the columns of the live table, the new ID of each row and whether
+the row matches an existing one. New IDs are drawn for all rows of a table at
+once and references between imported rows are rewritten by joins on the
+staging tables, while every table is inserted into the live table by a single
+INSERT ... SELECT. All of this happens in the caller's transaction, so an
+import is applied completely or not at all.
+
+Classes and relations are matched by name with those of the target project and
+only created if missing, the same is done for annotations and tags. Rows
+referencing rows that are not part of the import are skipped, except for
+parents of treenodes: these nodes become roots.
+
+The row triggers that keep the skeleton connectivity, skeleton summary and
+contribution summary tables up to date are skipped during the import, by
+setting catmaid.skip_summary_triggers for the transaction, because they would
+run several queries for every inserted row. The summaries of the imported rows
+are added afterwards with one statement per table.
+"""
+
+import csv
+import gzip
+import os
+import tarfile
+
+from collections import OrderedDict
+from cStringIO import StringIO
+
+from catmaid.control import nodelistcache, ontologycache
+
+
+# The imported columns of each table, in the order the tables are imported.
+# All tables get the project of the import.
+TABLES = OrderedDict((
+    ('class', ('id', 'user_id', 'creation_time', 'edition_time',
+               'class_name', 'description')),
+    ('relation', ('id', 'user_id', 'creation_time', 'edition_time',
+                  'relation_name', 'uri', 'description', 'isreciprocal')),
+    ('class_instance', ('id', 'user_id', 'creation_time', 'edition_time',
+                        'class_id', 'name')),
+    ('class_instance_class_instance', ('id', 'user_id', 'creation_time',
+                                       'edition_time', 'relation_id',
+                                       'class_instance_a', 'class_instance_b')),
+    ('treenode', ('id', 'user_id', 'creation_time', 'edition_time',
+                  'editor_id', 'location_x', 'location_y', 'location_z',
+                  'parent_id', 'radius', 'confidence', 'skeleton_id')),
+    ('connector', ('id', 'user_id', 'creation_time', 'edition_time',
+                   'editor_id', 'location_x', 'location_y', 'location_z',
+                   'confidence')),
+    ('treenode_connector', ('id', 'user_id', 'creation_time', 'edition_time',
+                            'relation_id', 'treenode_id', 'connector_id',
+                            'skeleton_id', 'confidence')),
+    ('treenode_class_instance', ('id', 'user_id', 'creation_time',
+                                 'edition_time', 'relation_id', 'treenode_id',
+                                 'class_instance_id')),
+    ('review', ('id', 'reviewer_id', 'review_time', 'skeleton_id',
+                'treenode_id')),
+))
+
+# Columns that reference other imported tables
+REFERENCES = {
+    'class_instance': {'class_id': 'class'},
+    'class_instance_class_instance': {'relation_id': 'relation',
+                                      'class_instance_a': 'class_instance',
+                                      'class_instance_b': 'class_instance'},
+    'treenode': {'parent_id': 'treenode', 'skeleton_id': 'class_instance'},
+    'treenode_connector': {'relation_id': 'relation',
+                           'treenode_id': 'treenode',
+                           'connector_id': 'connector',
+                           'skeleton_id': 'class_instance'},
+    'treenode_class_instance': {'relation_id': 'relation',
+                                'treenode_id': 'treenode',
+                                'class_instance_id': 'class_instance'},
+    'review': {'skeleton_id': 'class_instance', 'treenode_id': 'treenode'},
+}
+
+# References that are set to NULL instead of skipping the row if they can't
+# be mapped
+OPTIONAL_REFERENCES = frozenset([('treenode', 'parent_id')])
+
+# The sequences IDs are drawn from, concept_id_seq for all other tables
+SEQUENCES = {
+    'treenode': 'location_id_seq',
+    'connector': 'location_id_seq',
+    'review': 'review_id_seq',
+}
+
+
+def copy_rows(cursor, table, columns, rows):
+    """ Copy an iterable of row tuples into the given columns of a table. """
+    data = StringIO()
+    writer = csv.writer(data)
+    for row in rows:
+        writer.writerow(['' if v is None else v for v in row])
+    data.seek(0)
+    cursor.copy_expert('COPY %s (%s) FROM STDIN WITH CSV' % (table,
+            ', '.join(columns)), data)
+
+
+class BulkImporter(object):
+    """ Imports CSV files of the tables in TABLES into a project. If a user is
+    given, all imported rows are owned, edited and reviewed by this user
+    instead of the users named in the files.
+    """
+
+    def __init__(self, cursor, project_id, user_id=None):
+        self.cursor = cursor
+        self.project_id = int(project_id)
+        self.user_id = None if user_id is None else int(user_id)
+        self.staged = set()
+
+    def stage(self, table, data):
+        """ Copy the CSV data of a table from a file object into its staging
+        table. """
+        header = [c.strip() for c in next(csv.reader([data.readline()]))]
+        missing = set(TABLES[table]) - set(header)
+        unknown = set(header) - set(TABLES[table])
+        if missing or unknown:
+            raise ValueError("The columns of table %s don't match, missing: "
+                    "%s, unknown: %s" % (table, ', '.join(sorted(missing)),
+                    ', '.join(sorted(unknown))))
+        self._create_staging_table(table)
+        self.cursor.copy_expert('COPY import_%s (%s) FROM STDIN WITH CSV' % \
+                (table, ', '.join(header)), data)
+
+    def _create_staging_table(self, table):
+        self.cursor.execute('''
+            DROP TABLE IF EXISTS import_%(table)s;
+            CREATE TEMPORARY TABLE import_%(table)s ON COMMIT DROP AS
+            SELECT %(columns)s FROM %(table)s WITH NO DATA;
+            ALTER TABLE import_%(table)s
+                ADD COLUMN new_id bigint,
+                ADD COLUMN existing boolean NOT NULL DEFAULT false;
+        ''' % {'table': table, 'columns': ', '.join(TABLES[table])})
+        self.staged.add(table)
+
+    def insert(self):
+        """ Map the staged rows to new IDs and insert them into the live
+        tables. Returns a dictionary of the number of inserted rows of each
+        table. """
+        for table in TABLES:
+            if table not in self.staged:
+                self._create_staging_table(table)
+            self.cursor.execute('CREATE INDEX ON import_%s (id)' % table)
+            self.cursor.execute('ANALYZE import_%s' % table)
+
+        self._match()
+
+        self.cursor.execute("SET LOCAL catmaid.skip_summary_triggers TO on")
+        counts = OrderedDict()
+        for table in TABLES:
+            self.cursor.execute('''
+                UPDATE import_%s SET new_id = nextval('%s')
+                WHERE new_id IS NULL
+            ''' % (table, SEQUENCES.get(table, 'concept_id_seq')))
+            counts[table] = self._insert_table(table)
+        self._update_summaries()
+        self.cursor.execute("SET LOCAL catmaid.skip_summary_triggers TO off")
+
+        self.cursor.execute('''
+            SELECT DISTINCT new_id FROM import_class_instance i
+            WHERE NOT existing AND EXISTS (
+                SELECT 1 FROM import_treenode t WHERE t.skeleton_id = i.id)
+        ''')
+        nodelistcache.invalidate_skeletons(self.cursor, self.project_id,
+                [row[0] for row in self.cursor.fetchall()])
+
+        if counts['class'] or counts['relation']:
+            ontologycache.invalidate(self.project_id)
+
+        return counts
+
+    def _match(self):
+        """ Map classes, relations, annotations and tags to existing ones of
+        the target project with the same name. """
+        self.cursor.execute('''
+            UPDATE import_class i SET new_id = c.id, existing = true
+            FROM class c
+            WHERE c.project_id = %(project_id)s AND c.class_name = i.class_name;
+
+            UPDATE import_relation i SET new_id = r.id, existing = true
+            FROM relation r
+            WHERE r.project_id = %(project_id)s
+              AND r.relation_name = i.relation_name;
+
+            UPDATE import_class_instance i SET new_id = ci.id, existing = true
+            FROM import_class c, class_instance ci
+            WHERE i.class_id = c.id AND c.class_name IN ('annotation', 'label')
+              AND c.existing AND ci.class_id = c.new_id
+              AND ci.project_id = %(project_id)s AND ci.name = i.name;
+        ''' % {'project_id': self.project_id})
+
+    def _update_summaries(self):
+        """ Add the imported rows to the summary tables, like their triggers
+        would have. Imported links, nodes and reviews belong to imported
+        connectors and skeletons, which therefore get new connectivity and
+        skeleton summary rows. Contributions are added to existing rows with
+        change_contribution_summary(), which other transactions may change
+        concurrently. """
+        self.cursor.execute('''
+            INSERT INTO skeleton_connectivity
+            SELECT t1.project_id, t1.skeleton_id, t1.relation_id,
+                   t2.skeleton_id, t2.relation_id, count(*)
+            FROM import_connector i
+            JOIN treenode_connector t1 ON t1.connector_id = i.new_id
+            JOIN treenode_connector t2 ON t2.connector_id = i.new_id
+            WHERE NOT i.existing AND t1.id <> t2.id
+            GROUP BY t1.project_id, t1.skeleton_id, t1.relation_id,
+                     t2.skeleton_id, t2.relation_id;
+
+            INSERT INTO skeleton_summary
+            SELECT t.skeleton_id, min(t.project_id), count(*), 0,
+                   coalesce(sum(sqrt((t.location_x - p.location_x)^2 +
+                                     (t.location_y - p.location_y)^2 +
+                                     (t.location_z - p.location_z)^2)), 0),
+                   max(t.edition_time)
+            FROM import_treenode i
+            JOIN treenode t ON t.id = i.new_id
+            LEFT JOIN treenode p ON t.parent_id = p.id
+            WHERE NOT i.existing
+            GROUP BY t.skeleton_id;
+
+            UPDATE skeleton_summary s SET num_reviewed_nodes = r.n
+            FROM (SELECT r.skeleton_id, count(DISTINCT r.treenode_id) AS n
+                  FROM import_review i
+                  JOIN review r ON r.id = i.new_id
+                  WHERE NOT i.existing
+                  GROUP BY r.skeleton_id) r
+            WHERE s.skeleton_id = r.skeleton_id;
+
+            INSERT INTO skeleton_reviewer_summary
+            SELECT r.skeleton_id, r.reviewer_id, min(r.project_id),
+                   count(DISTINCT r.treenode_id)
+            FROM import_review i
+            JOIN review r ON r.id = i.new_id
+            WHERE NOT i.existing
+            GROUP BY r.skeleton_id, r.reviewer_id;
+
+            WITH changes AS (
+                SELECT project_id, user_id, date,
+                       sum(nodes_created) AS nodes_created,
+                       sum(nodes_edited) AS nodes_edited,
+                       sum(connectors_created) AS connectors_created,
+                       sum(skeletons_created) AS skeletons_created,
+                       sum(reviews) AS reviews
+                FROM (
+                    SELECT t.project_id, t.user_id,
+                           t.creation_time::date AS date,
+                           1 AS nodes_created, 0 AS nodes_edited,
+                           0 AS connectors_created, 0 AS skeletons_created,
+                           0 AS reviews
+                    FROM import_treenode i JOIN treenode t ON t.id = i.new_id
+                    WHERE NOT i.existing
+                    UNION ALL
+                    SELECT t.project_id, t.editor_id, t.edition_time::date,
+                           0, 1, 0, 0, 0
+                    FROM import_treenode i JOIN treenode t ON t.id = i.new_id
+                    WHERE NOT i.existing AND t.editor_id <> t.user_id
+                    UNION ALL
+                    SELECT c.project_id, c.user_id, c.creation_time::date,
+                           0, 0, 1, 0, 0
+                    FROM import_connector i JOIN connector c ON c.id = i.new_id
+                    WHERE NOT i.existing
+                    UNION ALL
+                    SELECT ci.project_id, ci.user_id, ci.creation_time::date,
+                           0, 0, 0, 1, 0
+                    FROM import_class_instance i
+                    JOIN class_instance ci ON ci.id = i.new_id
+                    JOIN class c ON c.id = ci.class_id
+                    WHERE NOT i.existing AND c.class_name = 'skeleton'
+                    UNION ALL
+                    SELECT r.project_id, r.reviewer_id, r.review_time::date,
+                           0, 0, 0, 0, 1
+                    FROM import_review i JOIN review r ON r.id = i.new_id
+                    WHERE NOT i.existing
+                ) c
+                GROUP BY project_id, user_id, date
+            )
+            SELECT change_contribution_summary(project_id, user_id, date,
+                nodes_created::integer, nodes_edited::integer,
+                connectors_created::integer, skeletons_created::integer,
+                reviews::integer)
+            FROM changes;
+        ''')
+
+    def _insert_table(self, table):
+        columns = ['id', 'project_id']
+        values = ['i.new_id', str(self.project_id)]
+        joins = []
+        references = REFERENCES.get(table, {})
+        for column in TABLES[table][1:]:
+            columns.append(column)
+            if column in references:
+                alias = 'r_%s' % column
+                join = 'LEFT OUTER JOIN' if (table, column) in \
+                        OPTIONAL_REFERENCES else 'JOIN'
+                joins.append('%s import_%s %s ON %s.id = i.%s' % (join,
+                        references[column], alias, alias, column))
+                values.append('%s.new_id' % alias)
+            elif column in ('user_id', 'editor_id', 'reviewer_id') and \
+                    self.user_id:
+                values.append(str(self.user_id))
+            elif column in ('creation_time', 'edition_time', 'review_time'):
+                values.append('coalesce(i.%s, now())' % column)
+            else:
+                values.append('i.%s' % column)
+        self.cursor.execute('''
+            INSERT INTO %s (%s)
+            SELECT %s
+            FROM import_%s i
+            %s
+            WHERE NOT i.existing
+        ''' % (table, ', '.join(columns), ', '.join(values), table,
+               '\n'.join(joins)))
+        return self.cursor.rowcount
+
+
+def import_files(cursor, path, project_id, user_id=None, tables=None):
+    """ Import the CSV files of a directory or a (compressed) tar archive, as
+    created by catmaid_export_data. Files are named after their table, like
+    treenode.csv, and may be gzip compressed. Only the given tables are
+    imported, all by default. Returns a dictionary of the number of inserted
+    rows of each table. """
+    importer = BulkImporter(cursor, project_id, user_id)
+    if os.path.isdir(path):
+        names = dict((name, os.path.join(path, name)) for name in os.listdir(path))
+        open_member = lambda path: open(path, 'rb')
+        archive = None
+    else:
+        archive = tarfile.open(path, 'r:*')
+        names = dict((os.path.basename(m.name), m) for m in archive.getmembers()
+                     if m.isfile())
+        open_member = archive.extractfile
+    try:
+        for table in (TABLES if tables is None else tables):
+            for name in (table + '.csv', table + '.csv.gz'):
+                if name in names:
+                    data = open_member(names[name])
+                    if name.endswith('.gz'):
+                        data = gzip.GzipFile(fileobj=data)
+                    try:
+                        importer.stage(table, data)
+                    finally:
+                        data.close()
+                    break
+        return importer.insert()
+    finally:
+        if archive:
+            archive.close()
@@ -10,22 +10,21 @@ from django.http import HttpResponse
 
 from catmaid.models import UserRole
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import get_relation_to_id_map
 from catmaid.control.skeleton import _neuronnames
 
 def _next_circle(skeleton_set, cursor):
     """ Return a dictionary of skeleton IDs in the skeleton_set vs a dictionary of connected skeletons vs how many connections."""
     cursor.execute('''
-    SELECT tc1.skeleton_id, tc1.relation_id, tc2.skeleton_id
-    FROM treenode_connector tc1,
-         treenode_connector tc2
-    WHERE tc1.skeleton_id in (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.skeleton_id != tc2.skeleton_id
-      AND tc1.relation_id != tc2.relation_id
+    SELECT skeleton_a, relation_a, skeleton_b, count
+    FROM skeleton_connectivity
+    WHERE skeleton_a in (%s)
+      AND skeleton_a != skeleton_b
+      AND relation_a != relation_b
     ''' % ','.join(map(str, skeleton_set)))
     connections = defaultdict(partial(defaultdict, partial(defaultdict, int)))
     for row in cursor.fetchall():
-        connections[row[0]][row[1]][row[2]] += 1
+        connections[row[0]][row[1]][row[2]] += row[3]
     return connections
 
 def _clean_mins(request, cursor, project_id):
@@ -39,8 +38,7 @@ def _clean_mins(request, cursor, project_id):
     if -1 == min_post:
         min_post = float('inf')
 
-    cursor.execute("SELECT relation_name, id FROM relation WHERE project_id = %s AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')" % int(project_id))
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     mins = {}
     mins[relations['presynaptic_to']]  = min_post # inverted: all postsynaptic to the set
     mins[relations['postsynaptic_to']] = min_pre # inverted: all presynaptic to the set
@@ -13,6 +13,7 @@ from django.shortcuts import get_object_or_404, render_to_response
 from django.contrib.contenttypes.models import ContentType
 from django.template.context import RequestContext
 
+from catmaid.control import ontologycache
 from catmaid.control.common import get_class_to_id_map, \
         get_relation_to_id_map, insert_into_log
 from catmaid.control.ajax_templates import render_block_to_string
@@ -249,6 +250,7 @@ def add_class(workspace_pid, class_user, class_name, class_desc):
         project_id = workspace_pid,
         class_name = class_name,
         description = class_desc)
+    ontologycache.invalidate(workspace_pid)
     return new_class
 
 def add_relation(workspace_pid, rel_user, rel_name, rel_desc, is_reciprocal=False):
@@ -258,6 +260,7 @@ def add_relation(workspace_pid, rel_user, rel_name, rel_desc, is_reciprocal=Fals
         relation_name = rel_name,
         description = rel_desc,
         isreciprocal = is_reciprocal)
+    ontologycache.invalidate(workspace_pid)
     return new_rel
 
 def check_classification_setup_view(request, project_id=None):
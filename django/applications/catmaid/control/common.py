@@ -1,13 +1,19 @@
 import string
 import random
 import json
+import time
+import uuid
 
 from collections import defaultdict
+from itertools import islice
 
+from django.conf import settings
+from django.db import connection
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
 
+from catmaid.control import ontologycache
 from catmaid.fields import Double3D
 from catmaid.models import Log, NeuronSearch, CELL_BODY_CHOICES, \
         SORT_ORDERS_DICT,  Relation, Class, ClassInstance, \
@@ -205,12 +211,64 @@ def cursor_fetch_dictionary(cursor):
             for row in cursor.fetchall()
             ]
 
-def get_relation_to_id_map(project_id):
+def server_side_rows(query, params=None, chunk_size=5000):
+    """ Generator of the rows of a query, read through a named (server-side)
+    cursor chunk_size rows at a time, so that the result is never kept in
+    memory as a whole. Has to be iterated inside a transaction.
+
+    Named cursors aren't supported by Django's cursor wrapper. Like the
+    wrapper, the query is added to connection.queries if queries are logged,
+    with the time spent executing it and fetching its rows. This happens once
+    all rows have been read, i.e. only after a streaming response has been
+    consumed. """
+    # Names of server-side cursors have to be unique within a session
+    cursor = connection.connection.cursor('catmaid_rows_' + uuid.uuid4().hex)
+    duration = 0
+    try:
+        start = time.time()
+        cursor.execute(query, params)
+        duration += time.time() - start
+        while True:
+            start = time.time()
+            rows = cursor.fetchmany(chunk_size)
+            duration += time.time() - start
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        sql = cursor.query or query
+        cursor.close()
+        if connection.use_debug_cursor or \
+                (connection.use_debug_cursor is None and settings.DEBUG):
+            connection.queries.append({'sql': sql, 'time': '%.3f' % duration})
+
+def json_array_chunks(rows, chunk_size=5000):
+    """ Generator of pieces of text that together are the JSON array of all
+    rows, encoding chunk_size rows at a time. """
+    rows = iter(rows)
+    yield '['
+    separator = ''
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield separator + json.dumps(chunk, separators=(',', ':'))[1:-1]
+        separator = ','
+    yield ']'
+
+def _load_relation_map(project_id):
     return {rname: ID for rname, ID in Relation.objects.filter(project=project_id).values_list("relation_name", "id")}
 
-def get_class_to_id_map(project_id):
+def _load_class_map(project_id):
     return {cname: ID for cname, ID in Class.objects.filter(project=project_id).values_list("class_name", "id")}
 
+def get_relation_to_id_map(project_id):
+    return ontologycache.get_map('relation', project_id, _load_relation_map)
+
+def get_class_to_id_map(project_id):
+    return ontologycache.get_map('class', project_id, _load_class_map)
+
 def urljoin(a, b):
     """ Joins to URL parts a and b while making sure this
     exactly one slash inbetween.
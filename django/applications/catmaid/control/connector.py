@@ -5,13 +5,13 @@ from itertools import imap
 from datetime import datetime, timedelta
 
 from django.db import connection
-from django.db.models import Count
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponse
 
 from catmaid.fields import Double3D
 from catmaid.models import Project, Stack, ProjectStack, Connector, \
-        ConnectorClassInstance, Treenode, TreenodeConnector, UserRole
+        ConnectorClassInstance, TreenodeConnector, UserRole
+from catmaid.control import nodelistcache
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
 from catmaid.control.common import cursor_fetch_dictionary, \
         get_relation_to_id_map
@@ -194,13 +194,12 @@ def list_connector(request, project_id=None):
         connector_ids = map(lambda con: con['connector_id'], connectors)
 
         response_on_error = 'Failed to find counts of treenodes in skeletons.'
-        skel_tn_count = Treenode.objects.filter(skeleton__in=connected_skeletons)\
-        .values('skeleton').annotate(treenode_count=Count('skeleton'))
-        # .values to group by skeleton_id. See http://tinyurl.com/dj-values-annotate
-
-        skeleton_to_treenode_count = {}
-        for s in skel_tn_count:
-            skeleton_to_treenode_count[s['skeleton']] = s['treenode_count']
+        cursor.execute('''
+            SELECT skeleton_id, num_nodes
+            FROM skeleton_summary
+            WHERE skeleton_id = ANY(%s)
+            ''', (connected_skeletons,))
+        skeleton_to_treenode_count = dict(cursor.fetchall())
 
         # Rather than do a LEFT OUTER JOIN to also include the connectors
         # with no partners, just do another query to find the connectors
@@ -350,14 +349,7 @@ def _connector_skeletons(connector_ids, project_id):
     and 'postsynaptic_to' with a list of skeleton IDs (maybe empty). """
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     PRE = relations['presynaptic_to']
     POST = relations['postsynaptic_to']
 
@@ -399,14 +391,7 @@ def _connector_associated_edgetimes(connector_ids, project_id):
     the timestamp of the edge. """
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     PRE = relations['presynaptic_to']
     POST = relations['postsynaptic_to']
 
@@ -470,6 +455,8 @@ def create_connector(request, project_id=None):
         location_z=float(query_parameters['z']),
         confidence=parsed_confidence)
     new_connector.save()
+    nodelistcache.invalidate_connectors(connection.cursor(), project_id,
+                                        [new_connector.id])
 
     return HttpResponse(json.dumps({'connector_id': new_connector.id}))
 
@@ -478,6 +465,8 @@ def create_connector(request, project_id=None):
 def delete_connector(request, project_id=None):
     connector_id = int(request.POST.get("connector_id", 0))
     can_edit_or_fail(request.user, connector_id, 'connector')
+    nodelistcache.invalidate_connectors(connection.cursor(), project_id,
+                                        [connector_id])
     Connector.objects.filter(parent_id=connector_id).update(parent=None)
     Connector.objects.filter(id=connector_id).delete()
     return HttpResponse(json.dumps({
@@ -560,8 +549,7 @@ def connectors_info(request, project_id):
 
     cursor = connection.cursor()
 
-    cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
 
     pre = relations['presynaptic_to']
     post = relations['postsynaptic_to']
@@ -656,6 +644,16 @@ def _join_connectors(user, from_connector_id, to_connector_id, project_id):
         if from_connector_id == to_connector_id:
             raise Exception('Cannot join a connector to itself.')
 
+        # Invalidate cached node list tiles of the whole chain, before and
+        # after it is changed.
+        chain_ids = [to_connector_id]
+        connector = from_connector
+        while connector is not None:
+            chain_ids.append(connector.id)
+            connector = connector.parent
+        cursor = connection.cursor()
+        nodelistcache.invalidate_connectors(cursor, project_id, chain_ids)
+
         # Reroot connector chain at from_connector if necessary
         connector = from_connector
         last_connector = None
@@ -671,6 +669,7 @@ def _join_connectors(user, from_connector_id, to_connector_id, project_id):
         # Update the parent of to_treenode.
         response_on_error = 'Could not update parent of connector with ID %s' % to_connector_id
         Connector.objects.filter(id=from_connector_id).update(parent=to_connector_id, editor=user)
+        nodelistcache.invalidate_connectors(cursor, project_id, chain_ids)
 
 
     except Exception as e:
@@ -690,7 +689,9 @@ def split_connectors(request, project_id=None):
             from_connector = Connector.objects.get(pk=from_connector_id)
         except Connector.DoesNotExist:
             raise Exception("Could not find connector with ID #%s" % from_connector_id)
-            
+
+        nodelistcache.invalidate_connectors(connection.cursor(), project_id,
+                                            [from_connector_id])
         from_connector.parent = None
         from_connector.save()
 
@@ -7,11 +7,19 @@ from django.contrib.auth.decorators import login_required
 
 from catmaid.models import Stack, Project, ProjectStack, Message, User
 from catmaid.control.common import id_generator, json_error_response
+from catmaid.control import tilecache
 
 import urllib2 as urllib
+import httplib
 import os.path
 import glob
-from time import time
+import socket
+import threading
+import urlparse
+from collections import deque
+from itertools import chain, islice
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
 from math import cos, sin, radians
 
 # The libuuid import is a workaround for a bug with GraphicsMagick
@@ -159,6 +167,86 @@ class ImageRetrievalError(IOError):
         self.path = path
         self.error = error
 
+# Tiles are fetched and decoded by a pool of CROPPING_TILE_WORKERS threads per
+# process. Every thread keeps its HTTP connections open for the next tile.
+_pool = None
+_pool_pid = None
+_connections = threading.local()
+
+def _get_pool():
+    global _pool, _pool_pid
+    # A pool can't be shared with forked processes, like Celery's workers
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ThreadPool(settings.CROPPING_TILE_WORKERS)
+        _pool_pid = os.getpid()
+    return _pool
+
+def _read_url(path):
+    """ Return the content available at the given URL. HTTP connections are
+    reused by the calling thread, other URLs (and redirects) are handled by
+    urllib2. Raises urllib2's HTTPError and URLError. """
+    url = urlparse.urlsplit(path)
+    if url.scheme not in ('http', 'https'):
+        return urllib.urlopen(path).read()
+    if not hasattr(_connections, 'open'):
+        _connections.open = {}
+    key = (url.scheme, url.netloc)
+    target = url.path + ('?' + url.query if url.query else '')
+    # A connection that has been idle may have been closed by the server, in
+    # which case the request is repeated once with a new connection.
+    for attempt in (1, 2):
+        connection = _connections.open.get(key)
+        if connection is None:
+            if 'https' == url.scheme:
+                connection = httplib.HTTPSConnection(url.netloc,
+                        timeout=settings.CROPPING_TILE_TIMEOUT)
+            else:
+                connection = httplib.HTTPConnection(url.netloc,
+                        timeout=settings.CROPPING_TILE_TIMEOUT)
+            _connections.open[key] = connection
+        try:
+            connection.request('GET', target)
+            response = connection.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error) as e:
+            connection.close()
+            del _connections.open[key]
+            if attempt == 2:
+                raise urllib.URLError(e)
+            continue
+        if response.will_close:
+            connection.close()
+            del _connections.open[key]
+        if 300 <= response.status < 400:
+            return urllib.urlopen(path).read()
+        if response.status != 200:
+            raise urllib.HTTPError(path, response.status, response.reason,
+                                   response.msg, None)
+        return data
+
+def _is_transient(error):
+    """ Whether it makes sense to repeat a request that failed with the given
+    error: socket errors, like timeouts and refused connections, and server
+    errors. Other errors, like missing local files, won't go away. """
+    if isinstance(error, urllib.HTTPError):
+        return error.code >= 500
+    if isinstance(error, urllib.URLError):
+        error = error.reason
+    return isinstance(error, socket.error)
+
+def fetch_images(image_parts):
+    """ Return an iterator over the images of all image parts, in the same
+    order. Up to twice as many images as there are worker threads are fetched
+    and decoded ahead of time. """
+    pool = _get_pool()
+    parts = iter(image_parts)
+    window = 2 * settings.CROPPING_TILE_WORKERS
+    pending = deque(pool.apply_async(p.get_image) for p in islice(parts, window))
+    while pending:
+        image = pending.popleft().get()
+        pending.extend(pool.apply_async(p.get_image) for p in islice(parts, 1))
+        yield image
+
 class ImagePart:
     """ A part of a 2D image where height and width are not necessarily
     of the same size. Provides readout of the defined sub-area of the image.
@@ -179,16 +267,32 @@ class ImagePart:
             raise ValueError( "An image part must have an area, hence no " \
                     "extent should be zero!" )
 
+    def fetch( self ):
+        """ Return the content of the tile, retrying with increasing delays if
+        this fails for a reason that might go away.
+        """
+        delay = settings.CROPPING_TILE_RETRY_DELAY
+        for attempt in range(settings.CROPPING_TILE_RETRIES + 1):
+            try:
+                return _read_url( self.path )
+            except (urllib.URLError, socket.error) as e:
+                if attempt == settings.CROPPING_TILE_RETRIES or \
+                        not _is_transient(e):
+                    if isinstance(e, urllib.HTTPError):
+                        raise ImageRetrievalError(self.path,
+                                "Error code: %s" % e.code)
+                    raise ImageRetrievalError(self.path,
+                            getattr(e, 'reason', e))
+                sleep(delay)
+                delay *= 2
+
     def get_image( self ):
-        # Open the image
-        try:
-            img_file = urllib.urlopen( self.path )
-            img_data = img_file.read()
-            bytes_read = len(img_data)
-        except urllib.HTTPError as e:
-            raise ImageRetrievalError(self.path, "Error code: %s" % e.code)
-        except urllib.URLError as e:
-            raise ImageRetrievalError(self.path, e.reason)
+        # Open the image, from the local tile cache if possible
+        img_data = tilecache.get( self.path )
+        if img_data is None:
+            img_data = self.fetch()
+            tilecache.put( self.path, img_data )
+        bytes_read = len(img_data)
 
         blob = Blob( img_data )
         image = Image( blob )
@@ -466,6 +570,9 @@ def extract_substack_no_rotation( job ):
     cropped_stack = []
     # Accumulator for estimated result size
     estimated_total_size = 0
+    # The image parts of all slices and stacks are collected first, so that
+    # tiles can be fetched concurrently. They are composed in this order.
+    slices = []
     # Iterate over all slices
     for nz in range(n_slices):
         for stack in job.stacks:
@@ -516,45 +623,48 @@ def extract_substack_no_rotation( job ):
                     y_dst += cur_px_y_max - cur_px_y_min
                 # Update x component of destination position
                 x_dst += cur_px_x_max - cur_px_x_min
-
-            # Write out the image parts and make sure the maximum allowed file
-            # size isn't exceeded.
-            cropped_slice = None
-            for ip in image_parts:
-                # Get (correctly cropped) image
-                image = ip.get_image()
-
-                # Estimate total file size and abort if this exceeds the
-                # maximum allowed file size.
-                estimated_total_size = estimated_total_size + ip.estimated_size
-                if estimated_total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
-                    raise ValueError("The estimated size of the requested image "
-                                     "region is larger than the maximum allowed "
-                                     "file size: %0.2f > %s Bytes" % \
-                                     (estimated_total_size,
-                                      settings.GENERATED_FILES_MAXIMUM_SIZE))
-
-                # It is unfortunately not possible to create proper composite
-                # images based on a canvas image newly created like this:
-                # cropped_slice = Image( Geometry(bb.width, bb.height), Color("black"))
-                # Therefore, this workaround is used.
-                if not cropped_slice:
-                    cropped_slice = Image(image)
-                    cropped_slice.backgroundColor("black")
-                    cropped_slice.erase()
-                    # The '!' makes sure the aspect ration is ignored
-                    cropped_slice.scale('%sx%s!' % (bb.width, bb.height))
-                # Draw the image onto result image
-                cropped_slice.composite( image, ip.x_dst, ip.y_dst, co.OverCompositeOp )
-                # Delete tile image - it's not needed anymore
-                del image
-
-            if cropped_slice:
-                # Optionally, use only a single channel
-                if job.single_channel:
-                    cropped_slice.channel( ChannelType.RedChannel )
-                # Add the image to the cropped stack
-                cropped_stack.append( cropped_slice )
+            slices.append((bb, image_parts))
+
+    images = fetch_images(chain.from_iterable(p for _, p in slices))
+    for bb, image_parts in slices:
+        # Write out the image parts and make sure the maximum allowed file
+        # size isn't exceeded.
+        cropped_slice = None
+        for ip in image_parts:
+            # Get (correctly cropped) image
+            image = next(images)
+
+            # Estimate total file size and abort if this exceeds the
+            # maximum allowed file size.
+            estimated_total_size = estimated_total_size + ip.estimated_size
+            if estimated_total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
+                raise ValueError("The estimated size of the requested image "
+                                 "region is larger than the maximum allowed "
+                                 "file size: %0.2f > %s Bytes" % \
+                                 (estimated_total_size,
+                                  settings.GENERATED_FILES_MAXIMUM_SIZE))
+
+            # It is unfortunately not possible to create proper composite
+            # images based on a canvas image newly created like this:
+            # cropped_slice = Image( Geometry(bb.width, bb.height), Color("black"))
+            # Therefore, this workaround is used.
+            if not cropped_slice:
+                cropped_slice = Image(image)
+                cropped_slice.backgroundColor("black")
+                cropped_slice.erase()
+                # The '!' makes sure the aspect ration is ignored
+                cropped_slice.scale('%sx%s!' % (bb.width, bb.height))
+            # Draw the image onto result image
+            cropped_slice.composite( image, ip.x_dst, ip.y_dst, co.OverCompositeOp )
+            # Delete tile image - it's not needed anymore
+            del image
+
+        if cropped_slice:
+            # Optionally, use only a single channel
+            if job.single_channel:
+                cropped_slice.channel( ChannelType.RedChannel )
+            # Add the image to the cropped stack
+            cropped_stack.append( cropped_slice )
 
     return cropped_stack
 
@@ -7,8 +7,6 @@ from collections import defaultdict
 from itertools import chain, ifilter
 from functools import partial
 from synapseclustering import  tree_max_density
-from numpy import subtract
-from numpy.linalg import norm
 from math import sqrt
 
 from django.db import connection
@@ -17,8 +15,9 @@ from django.http import HttpResponse
 from catmaid.models import Relation, UserRole
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.review import get_treenodes_to_reviews
-from catmaid.control.tree_util import simplify, find_root, reroot, partition, \
-        spanning_tree, cable_length
+from catmaid.control.arbor import Arbor
+from catmaid.control.tree_util import simplify, spanning_tree, cable_length, \
+        set_edge_weights
 
 def split_by_confidence_and_add_edges(confidence_threshold, digraphs, rows):
     """ dipgrahs is a dictionary of skeleton IDs as keys and DiGraph instances as values,
@@ -75,10 +74,7 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
                 subdomains.append(graph)
                 continue
 
-            for parent_id, treenode_id in graph.edges_iter():
-                loc0 = locations[treenode_id]
-                loc1 = locations[parent_id]
-                graph[parent_id][treenode_id]['weight'] = norm(subtract(loc0, loc1))
+            set_edge_weights(graph, locations)
 
             # Invoke Casey's magic
             synapse_group = tree_max_density(graph.to_undirected(), treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
@@ -392,7 +388,8 @@ def _node_centrality_by_synapse(tree, nodes, totalOutputs, totalInputs):
         totalOutputs: the total number of output synapses of the tree
         totalInputs: the total number of input synapses of the tree
         Returns nothing, the results are an update to the Counts instance of each treenode entry in nodes, namely the nPossibleIOPaths. """
-    # 1. Ensure the root is an end by checking that it has only one child; otherwise reroot at the first end node found
+    # The synapses seen by each node are the ones of its subtree, with the
+    # arbor rerooted at an end node if necessary.
 
     if 0 == totalOutputs:
         # Not computable
@@ -400,26 +397,17 @@ def _node_centrality_by_synapse(tree, nodes, totalOutputs, totalInputs):
             counts.synapse_centrality = -1
         return
 
-    if len(tree.successors(find_root(tree))) > 1:
-        # Reroot at the first end node found
-        tree = tree.copy()
-        endNode = (nodeID for nodeID in nodes.iterkeys() if not tree.successors(nodeID)).next()
-        reroot(tree, endNode)
-
-    # 2. Partition into sequences, sorted from small to large
-    sequences = sorted(partition(tree), key=len)
-
-    # 3. Traverse all partitions counting synapses seen
-    for seq in sequences:
-        # Each seq runs from an end node towards the root or a branch node
-        seenI = 0
-        seenO = 0
-        for nodeID in seq:
-            counts = nodes[nodeID]
-            seenI += counts.inputs + counts.seenInputs
-            seenO += counts.outputs + counts.seenOutputs
-            counts.seenInputs = seenI
-            counts.seenOutputs = seenO
-            counts.nPossibleIOPaths = counts.seenInputs * (totalOutputs - counts.seenOutputs) + counts.seenOutputs * (totalInputs - counts.seenInputs)
-            counts.synapse_centrality = counts.nPossibleIOPaths / float(totalOutputs)
+    arbor = Arbor.from_digraph(tree)
+    node_ids = arbor.node_ids
+    inputs = [nodes[nodeID].inputs for nodeID in node_ids]
+    outputs = [nodes[nodeID].outputs for nodeID in node_ids]
+    seenInputs, seenOutputs, nPossibleIOPaths, centrality = \
+            arbor.synapse_centrality(inputs, outputs, totalInputs, totalOutputs)
+
+    for i, nodeID in enumerate(node_ids):
+        counts = nodes[nodeID]
+        counts.seenInputs = int(seenInputs[i])
+        counts.seenOutputs = int(seenOutputs[i])
+        counts.nPossibleIOPaths = int(nPossibleIOPaths[i])
+        counts.synapse_centrality = float(centrality[i])
 
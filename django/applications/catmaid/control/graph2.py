@@ -5,15 +5,14 @@ from collections import defaultdict
 from itertools import izip, count
 from functools import partial
 from synapseclustering import tree_max_density
-from numpy import subtract
-from numpy.linalg import norm
 
 from django.db import connection
 from django.http import HttpResponse
 
 from catmaid.models import UserRole
 from catmaid.control.authentication import requires_user_role
-from catmaid.control.tree_util import simplify
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.tree_util import simplify, set_edge_weights
 
 def basic_graph(project_id, skeleton_ids):
     if not skeleton_ids:
@@ -21,58 +20,23 @@ def basic_graph(project_id, skeleton_ids):
 
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
 
+    skids = ",".join(str(int(skid)) for skid in skeleton_ids)
     cursor.execute('''
-    SELECT tc.connector_id, tc.relation_id, tc.skeleton_id
-    FROM treenode_connector tc
-    WHERE tc.project_id = %s
-      AND tc.skeleton_id IN (%s)
-    ''' % (int(project_id), ",".join(str(int(skid)) for skid in skeleton_ids)))
-
-    # stores entire query set in memory, linking pre and post
-    connectors = defaultdict(partial(defaultdict, list))
-    for row in cursor.fetchall():
-        connectors[row[0]][row[1]].append(row[2])
-
-    # Safe to placeholder, half-complete connectors:
-    # only adds the edge if both pre and post exist
-    edges = defaultdict(partial(defaultdict, int))
-    for c in connectors.itervalues():
-        for pre in c[preID]: # should be one or none
-            for post in c[postID]:
-                edges[pre][post] += 1
-
-    return {'edges': tuple((pre, post, count) for pre, edge in edges.iteritems() for post, count in edge.iteritems())}
-
-    '''
-    return {'edges': [{'source': pre,
-                       'target': post,
-                       'weight': count} for pre, edge in edges.iteritems() for post, count in edge.iteritems()]}
-    '''
+    SELECT skeleton_a, skeleton_b, count
+    FROM skeleton_connectivity
+    WHERE project_id = %s
+      AND relation_a = %s
+      AND relation_b = %s
+      AND skeleton_a IN (%s)
+      AND skeleton_b IN (%s)
+    ''' % (int(project_id), preID, postID, skids, skids))
 
-    """ Can't get the variable to be set with all the skeleton IDs
-    cursor.execute('''
-    WITH skeletons as (VALUES (%s) UNION ALL)
-    SELECT tc1.skeleton_id, tc2.skeleton_id, count(*)
-    FROM treenode_connector tc1,
-         treenode_connector tc2
-    WHERE tc1.project_id = %s
-      AND tc1.project_id = tc2.project_id
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.relation_id = %s
-      AND tc2.relation_id = %s
-      AND tc1.skeleton_id IN skeletons
-      AND tc2.skeleton_id IN skeletons
-    ''' % (",".join(str(int(skid)) for skid in skeleton_ids), int(project_id), preID, postID))
-    """
+    # Only pairs of a presynaptic and a postsynaptic link are counted, so
+    # half-complete connectors don't create edges
+    return {'edges': tuple(cursor.fetchall())}
 
 
 def confidence_split_graph(project_id, skeleton_ids, confidence_threshold):
@@ -83,13 +47,7 @@ def confidence_split_graph(project_id, skeleton_ids, confidence_threshold):
     cursor = connection.cursor()
     skids = ",".join(str(int(skid)) for skid in skeleton_ids)
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
 
     # Fetch synapses of all skeletons
@@ -165,13 +123,7 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
 
     skids = ",".join(str(int(skid)) for skid in skeleton_ids)
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
 
     # Fetch synapses of all skeletons
@@ -329,8 +281,7 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
 
     for i, chunkID, chunk in izip(count(start=1), chunkIDs, chunks):
         # Populate edge properties with the weight
-        for parent, child in chunk.edges_iter():
-            chunk[parent][child]['weight'] = norm(subtract(locations[child], locations[parent]))
+        set_edge_weights(chunk, locations)
 
         # Check if need to expand at all
         blob = tuple(c for c in cs if c[0] in chunk)
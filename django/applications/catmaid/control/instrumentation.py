@@ -0,0 +1,264 @@
+""" Per view statistics of the cost of requests.
+
+If REQUEST_INSTRUMENTATION_ENABLED is set, InstrumentationMiddleware records
+for every request the wall time, the time spent in the database, the number
+of queries, the response size and queries that were executed more than once
+with only their parameters differing. The latter are identified by their
+fingerprint, the SQL with all literals replaced by '?', and usually point to a
+query run in a loop.
+
+Statistics are aggregated per view into histograms with fixed buckets, so that
+they take constant space. Each process keeps its own statistics in memory and
+stores a copy in Django's cache at most every
+REQUEST_INSTRUMENTATION_FLUSH_INTERVAL seconds. The statistics of all
+processes are merged when they are looked at, which requires a cache backend
+shared by all worker processes (e.g. memcached). Resetting replaces a global
+generation, which makes every process start over the next time it stores its
+statistics.
+"""
+
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+_GENERATION_KEY = 'catmaid.instrumentation.generation'
+
+# The number of duplicate query fingerprints kept per view
+MAX_FINGERPRINTS = 20
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?(?:e[-+]?\d+)?\b', re.IGNORECASE)
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_ARRAY = re.compile(r'\[\s*\?(?:\s*,\s*\?)*\s*\]')
+_SPACE = re.compile(r'\s+')
+
+
+def enabled():
+    return getattr(settings, 'REQUEST_INSTRUMENTATION_ENABLED', False)
+
+
+def fingerprint(sql):
+    """ Return the SQL with all string and number literals replaced by '?'
+    and lists of them collapsed into a single one. """
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _LIST.sub('(?)', sql)
+    sql = _ARRAY.sub('[?]', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+def _bounds(first, last):
+    """ Bucket bounds of 1, 2 and 5 times the powers of ten from first to
+    last. """
+    bounds = []
+    bound = first
+    while bound <= last:
+        bounds.extend((bound, bound * 2, bound * 5))
+        bound *= 10
+    return tuple(bounds)
+
+
+class Histogram(object):
+    """ Counts values in buckets with fixed upper bounds, with an additional
+    bucket for values above the last bound. """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return float(self.total) / self.count if self.count else 0
+
+    def percentile(self, p):
+        """ Return the upper bound of the bucket holding the value of the
+        given percentile, but at most the largest value seen. """
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                break
+        return self.max
+
+    def as_dict(self):
+        buckets = [{'le': b, 'count': c} for b, c in zip(self.bounds, self.counts)]
+        buckets.append({'le': None, 'count': self.counts[-1]})
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'buckets': buckets}
+
+
+# Milliseconds, numbers of queries and bytes
+TIME_BOUNDS = _bounds(1, 10000)
+QUERY_BOUNDS = _bounds(1, 10000)
+SIZE_BOUNDS = _bounds(100, 10000000)
+
+
+class ViewStats(object):
+    """ The aggregated statistics of the requests of a single view. """
+
+    def __init__(self):
+        self.requests = 0
+        self.wall = Histogram(TIME_BOUNDS)
+        self.db = Histogram(TIME_BOUNDS)
+        self.queries = Histogram(QUERY_BOUNDS)
+        self.size = Histogram(SIZE_BOUNDS)
+        # Maps fingerprints to the number of requests that repeated them and
+        # the total number of their executions in these requests.
+        self.duplicates = {}
+
+    def add(self, wall, db, queries, size, duplicates):
+        self.requests += 1
+        self.wall.add(wall)
+        self.db.add(db)
+        self.queries.add(queries)
+        if size is not None:
+            self.size.add(size)
+        for sql, executions in duplicates.iteritems():
+            entry = self.duplicates.setdefault(sql, [0, 0])
+            entry[0] += 1
+            entry[1] += executions
+        self._trim()
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.wall.merge(other.wall)
+        self.db.merge(other.db)
+        self.queries.merge(other.queries)
+        self.size.merge(other.size)
+        for sql, (requests, executions) in other.duplicates.iteritems():
+            entry = self.duplicates.setdefault(sql, [0, 0])
+            entry[0] += requests
+            entry[1] += executions
+        self._trim()
+
+    def _trim(self):
+        """ Keep the MAX_FINGERPRINTS most executed duplicates, once there
+        are twice as many. """
+        if len(self.duplicates) > 2 * MAX_FINGERPRINTS:
+            self.duplicates = dict(self.top_duplicates())
+
+    def top_duplicates(self):
+        return sorted(self.duplicates.iteritems(), key=lambda d: -d[1][1]) \
+                [:MAX_FINGERPRINTS]
+
+
+# The statistics of this process, keyed by view name, together with the
+# generation and process they belong to
+_stats = {}
+_state = {'generation': None, 'pid': None, 'flushed': 0}
+_lock = threading.Lock()
+
+
+def _generation():
+    generation = cache.get(_GENERATION_KEY)
+    if generation is None:
+        cache.add(_GENERATION_KEY, uuid.uuid4().hex,
+                  settings.REQUEST_INSTRUMENTATION_TIMEOUT)
+        generation = cache.get(_GENERATION_KEY)
+    return generation
+
+def _processes_key(generation):
+    return 'catmaid.instrumentation.%s.processes' % generation
+
+def _stats_key(generation, process):
+    return 'catmaid.instrumentation.%s.%s' % (generation, process)
+
+def _process():
+    return '%s-%s' % (socket.gethostname(), os.getpid())
+
+
+def record(view, wall, db, queries, size, duplicates):
+    """ Add the statistics of a request, times in milliseconds and
+    duplicates as a dictionary of fingerprints to their number of
+    executions. """
+    with _lock:
+        # Statistics inherited from a parent process are not ours
+        if _state['pid'] != os.getpid():
+            _stats.clear()
+            _state.update(pid=os.getpid(), generation=None, flushed=0)
+        stats = _stats.get(view)
+        if stats is None:
+            stats = _stats[view] = ViewStats()
+        stats.add(wall, db, queries, size, duplicates)
+
+        now = time.time()
+        if now - _state['flushed'] >= \
+                settings.REQUEST_INSTRUMENTATION_FLUSH_INTERVAL:
+            _state['flushed'] = now
+            _flush()
+
+
+def _flush():
+    """ Store the statistics of this process in Django's cache, after
+    dropping them if the generation changed. """
+    generation = _generation()
+    if generation != _state['generation']:
+        if _state['generation'] is not None:
+            _stats.clear()
+        _state['generation'] = generation
+    timeout = settings.REQUEST_INSTRUMENTATION_TIMEOUT
+    process = _process()
+    cache.set(_stats_key(generation, process), _stats, timeout)
+    # Registering is not atomic, a process missing because of a concurrent
+    # update is added again on its next flush.
+    processes = cache.get(_processes_key(generation)) or []
+    if process not in processes:
+        cache.set(_processes_key(generation), processes + [process], timeout)
+
+
+def flush():
+    """ Store the statistics of this process right away. """
+    with _lock:
+        _state['flushed'] = time.time()
+        _flush()
+
+
+def snapshot():
+    """ Return the statistics of all processes merged into a dictionary of
+    view names to ViewStats. """
+    generation = _generation()
+    merged = defaultdict(ViewStats)
+    processes = cache.get(_processes_key(generation)) or []
+    for stats in cache.get_many([_stats_key(generation, p)
+                                 for p in processes]).itervalues():
+        for view, view_stats in stats.iteritems():
+            merged[view].merge(view_stats)
+    return dict(merged)
+
+
+def reset():
+    """ Start over with new statistics in all processes. """
+    cache.set(_GENERATION_KEY, uuid.uuid4().hex,
+              settings.REQUEST_INSTRUMENTATION_TIMEOUT)
+    with _lock:
+        _stats.clear()
+        _state['generation'] = None
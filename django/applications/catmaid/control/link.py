@@ -1,10 +1,12 @@
 import json
 
+from django.db import connection
 from django.http import HttpResponse
 from django.core.exceptions import ObjectDoesNotExist
 
 from catmaid.models import UserRole, Project, Relation, Treenode, Connector, \
         TreenodeConnector, ClassInstance
+from catmaid.control import nodelistcache
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
 
 @requires_user_role(UserRole.Annotate)
@@ -69,6 +71,7 @@ def create_link(request, project_id=None):
         skeleton=from_treenode.skeleton,  # treenode.skeleton_id where treenode.id = from_id
         connector=to_connector  # connector_id = to_id
     ).save()
+    nodelistcache.invalidate_connectors(connection.cursor(), project_id, [to_id])
 
     return HttpResponse(json.dumps({'message': 'success'}), content_type='text/json')
 
@@ -90,6 +93,8 @@ def delete_link(request, project_id=None):
     # and the user_id not matching or not being superuser.
     can_edit_or_fail(request.user, links[0].id, 'treenode_connector')
 
+    nodelistcache.invalidate_connectors(connection.cursor(), project_id,
+                                        [connector_id])
     links[0].delete()
     return HttpResponse(json.dumps({'result': 'Removed treenode to connector link'}))
 
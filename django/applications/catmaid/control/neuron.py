@@ -5,6 +5,7 @@ from django.shortcuts import get_object_or_404
 from django.db import connection
 from django.contrib.auth.models import User
 
+from catmaid.control import nodelistcache
 from catmaid.control.authentication import requires_user_role, \
         can_edit_class_instance_or_fail, can_edit_all_or_fail
 from catmaid.control.common import insert_into_log
@@ -110,6 +111,7 @@ def delete_neuron(request, project_id=None, neuron_id=None):
 
     # Delete the skeletons (and their treenodes through cascading delete)
     cursor = connection.cursor()
+    nodelistcache.invalidate_skeletons(cursor, project_id, skeleton_ids)
     for skid in skeleton_ids:
         # Because there are constraints used in the database that Django is not
         # aware of, it's emulation of cascading deletion doesn't work.
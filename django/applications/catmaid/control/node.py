@@ -13,6 +13,7 @@ from catmaid.models import UserRole, Treenode, TreenodeConnector, Connector, \
         Location, ClassInstanceClassInstance, Review
 from catmaid.control.authentication import requires_user_role, \
         can_edit_all_or_fail, user_domain
+from catmaid.control import nodelistcache
 from catmaid.control.common import get_relation_to_id_map, insert_into_log
 from catmaid.control.treenode import can_edit_treenode_or_fail
 
@@ -55,10 +56,7 @@ def node_list_tuples(request, project_id=None):
     try:
         cursor = connection.cursor()
 
-        cursor.execute('''
-        SELECT relation_name, id FROM relation WHERE project_id=%s
-        ''' % project_id)
-        relation_map = dict(cursor.fetchall())
+        relation_map = get_relation_to_id_map(project_id)
 
         response_on_error = 'Failed to query treenodes'
 
@@ -69,50 +67,17 @@ def node_list_tuples(request, project_id=None):
         # For a superuser, the domain is all users, and implicit.
         domain = None if is_superuser else user_domain(cursor, user_id)
 
-        # Fetch treenodes which are in the bounding box,
-        # which in z it includes the full thickess of the prior section
-        # and of the next section (therefore the '<' and not '<=' for zhigh)
         params['bottom'] = params['top'] + params['height']
         params['right'] = params['left'] + params['width']
-        cursor.execute('''
-        SELECT
-            t1.id,
-            t1.parent_id,
-            t1.location_x,
-            t1.location_y,
-            t1.location_z,
-            t1.confidence,
-            t1.radius,
-            t1.skeleton_id,
-            t1.user_id,
-            t2.id,
-            t2.parent_id,
-            t2.location_x,
-            t2.location_y,
-            t2.location_z,
-            t2.confidence,
-            t2.radius,
-            t2.skeleton_id,
-            t2.user_id
-        FROM treenode t1
-             INNER JOIN treenode t2 ON
-               (   (t1.id = t2.parent_id OR t1.parent_id = t2.id)
-                OR (t1.parent_id IS NULL AND t1.id = t2.id))
-        WHERE
-            t1.location_z = %(z)s
-            AND t1.location_x > %(left)s
-            AND t1.location_x < %(right)s
-            AND t1.location_y > %(top)s
-            AND t1.location_y < %(bottom)s
-            AND t1.project_id = %(project_id)s
-        LIMIT %(limit)s
-        ''', params)
-
-        # Above, notice that the join is done for:
-        # 1. A parent-child or child-parent pair (where the first one is in section z)
-        # 2. A node with itself when the parent is null
-        # This is by far the fastest way to retrieve all parents and children nodes
-        # of the nodes in section z within the specified 2d bounds.
+
+        # Use cached tiles if enabled, unless the field of view covers too
+        # many of them.
+        fetched = None
+        if nodelistcache.enabled():
+            fetched = nodelistcache.fetch_rows(cursor, params)
+        if fetched is None:
+            fetched = _fetch_node_list_rows(cursor, params)
+        pair_rows, crows, n_retrieved_nodes = fetched
 
         # A list of tuples, each tuple containing the selected columns for each treenode
         # The id is the first element of each tuple
@@ -120,9 +85,7 @@ def node_list_tuples(request, project_id=None):
         # A set of unique treenode IDs
         treenode_ids = set()
 
-        n_retrieved_nodes = 0 # at one per row, only those within the section
-        for row in cursor.fetchall():
-            n_retrieved_nodes += 1
+        for row in pair_rows:
             t1id = row[0]
             if t1id not in treenode_ids:
                 treenode_ids.add(t1id)
@@ -132,86 +95,6 @@ def node_list_tuples(request, project_id=None):
                 treenode_ids.add(t2id)
                 treenodes.append(row[9:17] + (is_superuser or row[17] == user_id or row[17] in domain,))
 
-
-        # Find connectors related to treenodes in the field of view
-        # Connectors found attached to treenodes
-        crows = []
-
-        if treenode_ids:
-            response_on_error = 'Failed to query connector locations.'
-            cursor.execute('''
-            SELECT connector.id,
-                connector.location_x,
-                connector.location_y,
-                connector.location_z,
-                connector.confidence,
-                treenode_connector.relation_id,
-                treenode_connector.treenode_id,
-                treenode_connector.confidence,
-                connector.user_id,
-                connector.parent_id
-            FROM treenode_connector,
-                 connector
-            WHERE treenode_connector.treenode_id IN (%s)
-              AND treenode_connector.connector_id = connector.id
-            ''' % ','.join(map(str, treenode_ids)))
-
-            crows = list(cursor.fetchall())
-
-        # Obtain connectors within the field of view that were not captured above.
-        # Uses a LEFT OUTER JOIN to include disconnected connectors,
-        # that is, connectors that aren't referenced from treenode_connector.
-
-        cursor.execute('''
-        SELECT connector.id,
-            connector.location_x,
-            connector.location_y,
-            connector.location_z,
-            connector.confidence,
-            treenode_connector.relation_id,
-            treenode_connector.treenode_id,
-            treenode_connector.confidence,
-            connector.user_id,
-            connector.parent_id
-        FROM connector LEFT OUTER JOIN treenode_connector
-                       ON connector.id = treenode_connector.connector_id
-        WHERE connector.project_id = %(project_id)s
-          AND connector.location_z = %(z)s
-          AND connector.location_x > %(left)s
-          AND connector.location_x < %(right)s
-          AND connector.location_y > %(top)s
-          AND connector.location_y < %(bottom)s
-        ''', params)
-
-        crows.extend(cursor.fetchall())
-        
-        # Obtain parent connectors not already captured because they are outside
-        # the field of view.
-        
-        connector_ids = set(str(crow[0]) for crow in crows)
-        parent_ids = set(str(crow[9]) for crow in crows if crow[9] is not None)
-
-        if connector_ids or parent_ids:
-            cursor.execute('''
-            SELECT connector.id,
-                connector.location_x,
-                connector.location_y,
-                connector.location_z,
-                connector.confidence,
-                treenode_connector.relation_id,
-                treenode_connector.treenode_id,
-                treenode_connector.confidence,
-                connector.user_id,
-                connector.parent_id
-            FROM connector LEFT OUTER JOIN treenode_connector
-                           ON connector.id = treenode_connector.connector_id
-            WHERE connector.id IN (%s)
-               OR connector.parent_id IN (%s)
-            ''' % (','.join(parent_ids or ['-1']),
-                   ','.join(connector_ids or ['-1'])))
-    
-            crows.extend(cursor.fetchall())
-
         connectors = []
         # A set of missing treenode IDs
         missing_treenode_ids = set()
@@ -327,12 +210,158 @@ def node_list_tuples(request, project_id=None):
                 for row in cursor.fetchall():
                     labels[row[0]].append(row[1])
 
-        return HttpResponse(json.dumps((treenodes, connectors, labels, n_retrieved_nodes == params['limit']), separators=(',', ':'))) # default separators have spaces in them like (', ', ': '). Must provide two: for list and for dictionary. The point of this: less space, more compact json
+        return HttpResponse(json.dumps((treenodes, connectors, labels, n_retrieved_nodes >= params['limit']), separators=(',', ':'))) # default separators have spaces in them like (', ', ': '). Must provide two: for list and for dictionary. The point of this: less space, more compact json
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
 
 
+def _fetch_node_list_rows(cursor, params):
+    """ Query the database for the treenode pair rows and the connector rows
+    node_list_tuples() is built from. Returns a three-tuple of these two row
+    lists and the number of retrieved pairs.
+    """
+    # Fetch treenodes which are in the bounding box,
+    # which in z it includes the full thickess of the prior section
+    # and of the next section (therefore the '<' and not '<=' for zhigh)
+    # The &&& test against the bounding box of the field of view lets
+    # PostGIS use the 3D spatial index on treenode locations. The
+    # expression has to match the one of the index exactly. The range
+    # tests below then refine this to the exact (open) bounding box.
+    cursor.execute('''
+    SELECT
+        t1.id,
+        t1.parent_id,
+        t1.location_x,
+        t1.location_y,
+        t1.location_z,
+        t1.confidence,
+        t1.radius,
+        t1.skeleton_id,
+        t1.user_id,
+        t2.id,
+        t2.parent_id,
+        t2.location_x,
+        t2.location_y,
+        t2.location_z,
+        t2.confidence,
+        t2.radius,
+        t2.skeleton_id,
+        t2.user_id
+    FROM treenode t1
+         INNER JOIN treenode t2 ON
+           (   (t1.id = t2.parent_id OR t1.parent_id = t2.id)
+            OR (t1.parent_id IS NULL AND t1.id = t2.id))
+    WHERE
+        ST_MakePoint(t1.location_x, t1.location_y, t1.location_z) &&&
+            ST_MakeLine(ST_MakePoint(%(left)s, %(top)s, %(z)s),
+                        ST_MakePoint(%(right)s, %(bottom)s, %(z)s))
+        AND t1.location_z = %(z)s
+        AND t1.location_x > %(left)s
+        AND t1.location_x < %(right)s
+        AND t1.location_y > %(top)s
+        AND t1.location_y < %(bottom)s
+        AND t1.project_id = %(project_id)s
+    LIMIT %(limit)s
+    ''', params)
+
+    # Above, notice that the join is done for:
+    # 1. A parent-child or child-parent pair (where the first one is in section z)
+    # 2. A node with itself when the parent is null
+    # This is by far the fastest way to retrieve all parents and children nodes
+    # of the nodes in section z within the specified 2d bounds.
+
+    pair_rows = cursor.fetchall()
+    treenode_ids = set()
+    for row in pair_rows:
+        treenode_ids.add(row[0])
+        treenode_ids.add(row[9])
+
+    # Find connectors related to treenodes in the field of view
+    # Connectors found attached to treenodes
+    crows = []
+
+    if treenode_ids:
+        cursor.execute('''
+        SELECT connector.id,
+            connector.location_x,
+            connector.location_y,
+            connector.location_z,
+            connector.confidence,
+            treenode_connector.relation_id,
+            treenode_connector.treenode_id,
+            treenode_connector.confidence,
+            connector.user_id,
+            connector.parent_id
+        FROM treenode_connector,
+             connector
+        WHERE treenode_connector.treenode_id IN (%s)
+          AND treenode_connector.connector_id = connector.id
+        ''' % ','.join(map(str, treenode_ids)))
+
+        crows = list(cursor.fetchall())
+
+    # Obtain connectors within the field of view that were not captured above.
+    # Uses a LEFT OUTER JOIN to include disconnected connectors,
+    # that is, connectors that aren't referenced from treenode_connector.
+
+    cursor.execute('''
+    SELECT connector.id,
+        connector.location_x,
+        connector.location_y,
+        connector.location_z,
+        connector.confidence,
+        treenode_connector.relation_id,
+        treenode_connector.treenode_id,
+        treenode_connector.confidence,
+        connector.user_id,
+        connector.parent_id
+    FROM connector LEFT OUTER JOIN treenode_connector
+                   ON connector.id = treenode_connector.connector_id
+    WHERE ST_MakePoint(connector.location_x, connector.location_y,
+                       connector.location_z) &&&
+            ST_MakeLine(ST_MakePoint(%(left)s, %(top)s, %(z)s),
+                        ST_MakePoint(%(right)s, %(bottom)s, %(z)s))
+      AND connector.project_id = %(project_id)s
+      AND connector.location_z = %(z)s
+      AND connector.location_x > %(left)s
+      AND connector.location_x < %(right)s
+      AND connector.location_y > %(top)s
+      AND connector.location_y < %(bottom)s
+    ''', params)
+
+    crows.extend(cursor.fetchall())
+    
+    # Obtain parent connectors not already captured because they are outside
+    # the field of view.
+    
+    connector_ids = set(str(crow[0]) for crow in crows)
+    parent_ids = set(str(crow[9]) for crow in crows if crow[9] is not None)
+
+    if connector_ids or parent_ids:
+        cursor.execute('''
+        SELECT connector.id,
+            connector.location_x,
+            connector.location_y,
+            connector.location_z,
+            connector.confidence,
+            treenode_connector.relation_id,
+            treenode_connector.treenode_id,
+            treenode_connector.confidence,
+            connector.user_id,
+            connector.parent_id
+        FROM connector LEFT OUTER JOIN treenode_connector
+                       ON connector.id = treenode_connector.connector_id
+        WHERE connector.id IN (%s)
+           OR connector.parent_id IN (%s)
+        ''' % (','.join(parent_ids or ['-1']),
+               ','.join(connector_ids or ['-1'])))
+
+        crows.extend(cursor.fetchall())
+
+    return pair_rows, crows, len(pair_rows)
+
+
 @requires_user_role(UserRole.Annotate)
 def update_location_reviewer(request, project_id=None, node_id=None):
     """ Updates the reviewer id and review time of a node """
@@ -364,6 +393,7 @@ def update_confidence(request, project_id=None, node_id=0):
     if new_confidence < 1 or new_confidence > 5:
         return HttpResponse(json.dumps({'error': 'Confidence not in range 1-5 inclusive.'}))
     to_connector = request.POST.get('to_connector', 'false') == 'true'
+    nodelistcache.invalidate_treenodes(connection.cursor(), project_id, [tnid])
     if to_connector:
         # Could be more than one. The GUI doesn't allow for specifying to which one.
         rows_affected = TreenodeConnector.objects.filter(treenode=tnid).update(confidence=new_confidence)
@@ -412,25 +442,48 @@ def most_recent_treenode(request, project_id=None):
     }))
 
 
-def _update(Kind, table, nodes, now, user):
+def _update(table, nodes, user, project_id, cursor):
+    """ Move all nodes of the given table with a single UPDATE statement.
+    <nodes> is a list of (id, x, y, z) tuples. Returns a dictionary that maps
+    each node ID to its new edition time.
+    """
     if not nodes:
-        return
-    # 0: id
-    # 1: X
-    # 2: Y
-    # 3: Z
-    can_edit_all_or_fail(user, (node[0] for node in nodes.itervalues()), table)
-    for node in nodes.itervalues():
-        Kind.objects.filter(id=int(node[0])).update(
-            editor=user,
-            edition_time=now,
-            location_x=float(node[1]),
-            location_y=float(node[2]),
-            location_z=float(node[3]))
+        return {}
+    node_ids = [node[0] for node in nodes]
+    invalidate = nodelistcache.invalidate_treenodes if table == 'treenode' \
+            else nodelistcache.invalidate_connectors
+    # Cached node list tiles of both the old and the new locations are stale
+    invalidate(cursor, project_id, node_ids)
+    # The edition time is set by the on_edit trigger
+    cursor.execute('''
+    UPDATE %s n
+    SET editor_id = %%s,
+        location_x = v.x,
+        location_y = v.y,
+        location_z = v.z
+    FROM (VALUES %s) AS v(id, x, y, z)
+    WHERE n.id = v.id
+    RETURNING n.id, n.edition_time
+    ''' % (table, ','.join(['(%s::bigint, %s::double precision,'
+                              ' %s::double precision, %s::double precision)']
+                             * len(nodes))),
+        [user.id] + list(itertools.chain.from_iterable(nodes)))
+    edition_times = dict(cursor.fetchall())
+    if len(edition_times) != len(set(node_ids)):
+        raise Exception('Could not find all of the %s nodes to update in '
+                        'table %s' % (len(set(node_ids)), table))
+    invalidate(cursor, project_id, node_ids)
+    return edition_times
 
 
 @requires_user_role(UserRole.Annotate)
 def node_update(request, project_id=None):
+    """ Move treenodes and connectors. The new locations are expected as
+    t[i][j] and c[i][j] for treenodes and connectors, respectively, where i is
+    a running index and j one of 0: id, 1: X, 2: Y and 3: Z. Returns the
+    number of updated nodes and their new edition times, which can be used by
+    clients to detect conflicting edits.
+    """
     N = len(request.POST)
     if 0 != N % 4:
         raise Exception("Incorrect number of posted items for node_update.")
@@ -447,12 +500,32 @@ def node_update(request, project_id=None):
             nodes[key[0]][i] = node = {}
         node[j] = value
 
-    now = datetime.now()
-    _update(Treenode, 'treenode', nodes['t'], now, request.user)
-    _update(Connector, 'connector', nodes['c'], now, request.user)
+    # Parse into (id, x, y, z) tuples
+    treenodes = [(int(n[0]), float(n[1]), float(n[2]), float(n[3]))
+                 for n in nodes['t'].itervalues()]
+    connectors = [(int(n[0]), float(n[1]), float(n[2]), float(n[3]))
+                  for n in nodes['c'].itervalues()]
 
-    num_updated_nodes = len(nodes['t'].keys()) + len(nodes['c'].keys())
-    return HttpResponse(json.dumps({'updated': num_updated_nodes}))
+    # Treenodes and connectors both inherit from location, which allows to
+    # check permissions for all of them at once.
+    if treenodes and connectors:
+        table = 'location'
+    else:
+        table = 'treenode' if treenodes else 'connector'
+    node_ids = [n[0] for n in itertools.chain(treenodes, connectors)]
+    if node_ids:
+        can_edit_all_or_fail(request.user, node_ids, table)
+
+    cursor = connection.cursor()
+    edition_times = _update('treenode', treenodes, request.user, project_id,
+                            cursor)
+    edition_times.update(_update('connector', connectors, request.user,
+                                 project_id, cursor))
+
+    return HttpResponse(json.dumps({
+        'updated': len(treenodes) + len(connectors),
+        'edition_times': dict((node_id, t.isoformat()) for node_id, t in
+                              edition_times.iteritems())}))
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -494,37 +567,36 @@ def node_nearest(request, project_id=None):
             for neur_skel_relation in neuron_skeletons:
                 skeletons.append(neur_skel_relation.class_instance_a_id)
 
-        # Get all treenodes connected to skeletons
+        if not skeletons:
+            raise Exception('No treenodes were found for skeletons in %s' % skeletons)
+
+        # Let the database find the treenode closest to the query location.
+        # This only looks at the nodes of the given skeletons and uses the
+        # skeleton index, instead of loading every treenode model instance.
         response_on_error = 'Finding the treenodes failed.'
-        treenodes = Treenode.objects.filter(project=project_id, skeleton__in=skeletons)
-
-        def getNearestTreenode(x, y, z, treenodes):
-            minDistance = -1
-            nearestTreenode = None
-            for tn in treenodes:
-                xdiff = x - tn.location_x
-                ydiff = y - tn.location_y
-                zdiff = z - tn.location_z
-                distanceSquared = xdiff ** 2 + ydiff ** 2 + zdiff ** 2
-                if distanceSquared < minDistance or minDistance < 0:
-                    nearestTreenode = tn
-                    minDistance = distanceSquared
-            return nearestTreenode
-
-        nearestTreenode = getNearestTreenode(
-            params['x'],
-            params['y'],
-            params['z'],
-            treenodes)
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT id, location_x, location_y, location_z, skeleton_id
+            FROM treenode
+            WHERE project_id = %s
+              AND skeleton_id IN (%s)
+            ORDER BY (location_x - %%(x)s) ^ 2
+                   + (location_y - %%(y)s) ^ 2
+                   + (location_z - %%(z)s) ^ 2, id
+            LIMIT 1
+        ''' % (int(project_id), ','.join(map(str, map(int, skeletons)))),
+            params)
+
+        nearestTreenode = cursor.fetchone()
         if nearestTreenode is None:
             raise Exception('No treenodes were found for skeletons in %s' % skeletons)
 
         return HttpResponse(json.dumps({
-            'treenode_id': nearestTreenode.id,
-            'x': int(nearestTreenode.location_x),
-            'y': int(nearestTreenode.location_y),
-            'z': int(nearestTreenode.location_z),
-            'skeleton_id': nearestTreenode.skeleton_id}))
+            'treenode_id': nearestTreenode[0],
+            'x': int(nearestTreenode[1]),
+            'y': int(nearestTreenode[2]),
+            'z': int(nearestTreenode[3]),
+            'skeleton_id': nearestTreenode[4]}))
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
@@ -0,0 +1,375 @@
+""" A server-side cache for the rows node_list_tuples() is built from.
+
+Space is cut into square tiles of NODE_LIST_CACHE_TILE_SIZE calibrated units
+per section. Each tile stores the raw database rows the node list queries
+would return for it: treenode/neighbor pairs, connectors attached to those
+treenodes, connectors located in the tile and their parent/child connectors.
+A field of view is assembled from the tiles covering it and then filtered
+down to exactly what the uncached queries would return.
+
+Write operations invalidate only the tiles that can contain rows of the
+nodes they change. Invalidated keys are additionally remembered for the
+current request and removed again by NodeListCacheMiddleware once the
+transaction of the view has been committed. This makes sure no concurrent
+reader can put back data that was read before the commit.
+"""
+
+import math
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Keys invalidated during the current request, deleted again after commit
+_pending = threading.local()
+
+
+def enabled():
+    return getattr(settings, 'NODE_LIST_CACHE_ENABLED', False)
+
+def _tile_size():
+    return float(settings.NODE_LIST_CACHE_TILE_SIZE)
+
+def _tile_index(value, size):
+    return int(math.floor(value / size))
+
+def _tile_key(project_id, z, i, j):
+    return 'catmaid.nodelist.%s.%r.%s.%s' % (project_id, float(z), i, j)
+
+
+def fetch_rows(cursor, params):
+    """ Return a three-tuple of treenode pair rows, connector rows and the
+    number of pairs that were available, based on cached tiles. The rows have
+    the same layout as the ones of the queries in node_list_tuples(). If the
+    field of view covers more than NODE_LIST_CACHE_MAX_TILES tiles, None is
+    returned and the caller is expected to query the database directly.
+    """
+    size = _tile_size()
+    project_id = params['project_id']
+    z = params['z']
+    left, right = params['left'], params['right']
+    top, bottom = params['top'], params['bottom']
+
+    tiles = [(i, j)
+             for i in xrange(_tile_index(left, size), _tile_index(right, size) + 1)
+             for j in xrange(_tile_index(top, size), _tile_index(bottom, size) + 1)]
+    if len(tiles) > settings.NODE_LIST_CACHE_MAX_TILES:
+        return None
+
+    keys = dict((_tile_key(project_id, z, i, j), (i, j)) for i, j in tiles)
+    cached = cache.get_many(keys.keys())
+    missing = [t for k, t in keys.iteritems() if k not in cached]
+    if missing:
+        built = _build_tiles(cursor, project_id, z, missing, size)
+        cache.set_many(dict((_tile_key(project_id, z, i, j), data)
+                            for (i, j), data in built.iteritems()),
+                       settings.NODE_LIST_CACHE_TIMEOUT)
+        cached.update((_tile_key(project_id, z, i, j), data)
+                      for (i, j), data in built.iteritems())
+
+    def in_view(x, y):
+        return left < x < right and top < y < bottom
+
+    # Only treenodes strictly inside the field of view are of interest,
+    # together with their parent and children.
+    pairs = [row for tile in cached.itervalues() for row in tile[0]
+             if in_view(row[2], row[3])]
+    n_available = len(pairs)
+    pairs = pairs[:params['limit']]
+
+    treenode_ids = set()
+    for row in pairs:
+        treenode_ids.add(row[0])
+        treenode_ids.add(row[9])
+
+    crows = [row for tile in cached.itervalues() for row in tile[1]
+             if row[6] in treenode_ids]
+    crows.extend(row for tile in cached.itervalues() for row in tile[2]
+                 if in_view(row[1], row[2]))
+
+    connector_ids = set(row[0] for row in crows)
+    parent_ids = set(row[9] for row in crows if row[9] is not None)
+    crows.extend(row for tile in cached.itervalues() for row in tile[3]
+                 if row[0] in parent_ids or row[9] in connector_ids)
+
+    return pairs, crows, n_available
+
+
+def _build_tiles(cursor, project_id, z, tiles, size):
+    """ Query the rows of all given tiles of section z with four queries in
+    total and split them up by tile. Returns a dictionary mapping each tile to
+    a tuple of four row lists: treenode pairs, attached connectors, connectors
+    in the tile and parent/child connectors.
+    """
+    result = dict((t, ([], [], [], [])) for t in tiles)
+    # The bounding box is extended by one unit on every side so that rounding
+    # at tile borders can't exclude rows. Which tile a row belongs to is
+    # decided by _tile_index() alone.
+    params = {
+        'project_id': project_id,
+        'z': z,
+        'left': min(t[0] for t in tiles) * size - 1,
+        'top': min(t[1] for t in tiles) * size - 1,
+        'right': (max(t[0] for t in tiles) + 1) * size + 1,
+        'bottom': (max(t[1] for t in tiles) + 1) * size + 1,
+    }
+
+    cursor.execute('''
+    SELECT
+        t1.id,
+        t1.parent_id,
+        t1.location_x,
+        t1.location_y,
+        t1.location_z,
+        t1.confidence,
+        t1.radius,
+        t1.skeleton_id,
+        t1.user_id,
+        t2.id,
+        t2.parent_id,
+        t2.location_x,
+        t2.location_y,
+        t2.location_z,
+        t2.confidence,
+        t2.radius,
+        t2.skeleton_id,
+        t2.user_id
+    FROM treenode t1
+         INNER JOIN treenode t2 ON
+           (   (t1.id = t2.parent_id OR t1.parent_id = t2.id)
+            OR (t1.parent_id IS NULL AND t1.id = t2.id))
+    WHERE
+        ST_MakePoint(t1.location_x, t1.location_y, t1.location_z) &&&
+            ST_MakeLine(ST_MakePoint(%(left)s, %(top)s, %(z)s),
+                        ST_MakePoint(%(right)s, %(bottom)s, %(z)s))
+        AND t1.location_z = %(z)s
+        AND t1.location_x >= %(left)s
+        AND t1.location_x < %(right)s
+        AND t1.location_y >= %(top)s
+        AND t1.location_y < %(bottom)s
+        AND t1.project_id = %(project_id)s
+    ''', params)
+
+    # Remember in which tiles each treenode shows up
+    treenode_tiles = {}
+    for row in cursor.fetchall():
+        t = (_tile_index(row[2], size), _tile_index(row[3], size))
+        if t not in result:
+            continue
+        result[t][0].append(row)
+        treenode_tiles.setdefault(row[0], set()).add(t)
+        treenode_tiles.setdefault(row[9], set()).add(t)
+
+    if treenode_tiles:
+        cursor.execute('''
+        SELECT connector.id,
+            connector.location_x,
+            connector.location_y,
+            connector.location_z,
+            connector.confidence,
+            treenode_connector.relation_id,
+            treenode_connector.treenode_id,
+            treenode_connector.confidence,
+            connector.user_id,
+            connector.parent_id
+        FROM treenode_connector,
+             connector
+        WHERE treenode_connector.treenode_id IN (%s)
+          AND treenode_connector.connector_id = connector.id
+        ''' % ','.join(map(str, treenode_tiles)))
+
+        for row in cursor.fetchall():
+            for t in treenode_tiles[row[6]]:
+                result[t][1].append(row)
+
+    cursor.execute('''
+    SELECT connector.id,
+        connector.location_x,
+        connector.location_y,
+        connector.location_z,
+        connector.confidence,
+        treenode_connector.relation_id,
+        treenode_connector.treenode_id,
+        treenode_connector.confidence,
+        connector.user_id,
+        connector.parent_id
+    FROM connector LEFT OUTER JOIN treenode_connector
+                   ON connector.id = treenode_connector.connector_id
+    WHERE ST_MakePoint(connector.location_x, connector.location_y,
+                       connector.location_z) &&&
+            ST_MakeLine(ST_MakePoint(%(left)s, %(top)s, %(z)s),
+                        ST_MakePoint(%(right)s, %(bottom)s, %(z)s))
+      AND connector.project_id = %(project_id)s
+      AND connector.location_z = %(z)s
+      AND connector.location_x >= %(left)s
+      AND connector.location_x < %(right)s
+      AND connector.location_y >= %(top)s
+      AND connector.location_y < %(bottom)s
+    ''', params)
+
+    for row in cursor.fetchall():
+        t = (_tile_index(row[1], size), _tile_index(row[2], size))
+        if t in result:
+            result[t][2].append(row)
+
+    # Parent and child connectors of every connector referenced by a tile
+    tile_connector_ids = {}
+    tile_parent_ids = {}
+    for t, data in result.iteritems():
+        crows = data[1] + data[2]
+        tile_connector_ids[t] = set(row[0] for row in crows)
+        tile_parent_ids[t] = set(row[9] for row in crows if row[9] is not None)
+
+    connector_ids = set().union(*tile_connector_ids.values())
+    parent_ids = set().union(*tile_parent_ids.values())
+    if connector_ids or parent_ids:
+        cursor.execute('''
+        SELECT connector.id,
+            connector.location_x,
+            connector.location_y,
+            connector.location_z,
+            connector.confidence,
+            treenode_connector.relation_id,
+            treenode_connector.treenode_id,
+            treenode_connector.confidence,
+            connector.user_id,
+            connector.parent_id
+        FROM connector LEFT OUTER JOIN treenode_connector
+                       ON connector.id = treenode_connector.connector_id
+        WHERE connector.id IN (%s)
+           OR connector.parent_id IN (%s)
+        ''' % (','.join(map(str, parent_ids or [-1])),
+               ','.join(map(str, connector_ids or [-1]))))
+
+        for row in cursor.fetchall():
+            for t in tiles:
+                if row[0] in tile_parent_ids[t] or \
+                        row[9] in tile_connector_ids[t]:
+                    result[t][3].append(row)
+
+    return result
+
+
+def _invalidate_tiles(cursor, project_id, query, params):
+    """ Expects a query that selects location_x, location_y and location_z
+    and removes all tiles containing one of the returned locations.
+    """
+    size = _tile_size()
+    cursor.execute('''
+    SELECT DISTINCT floor(location_x / %%(size)s),
+                    floor(location_y / %%(size)s),
+                    location_z
+    FROM (%s) locations
+    ''' % query, dict(params, size=size))
+    keys = set(_tile_key(project_id, z, int(i), int(j))
+               for i, j, z in cursor.fetchall())
+    if not keys:
+        return
+    cache.delete_many(keys)
+    if not hasattr(_pending, 'keys'):
+        _pending.keys = set()
+    _pending.keys.update(keys)
+
+
+def _invalidate_treenode_neighborhood(cursor, project_id, treenode_ids):
+    # Pair rows of a treenode are stored in its own tile and in the tiles
+    # of its parent and children.
+    _invalidate_tiles(cursor, project_id, '''
+        SELECT location_x, location_y, location_z
+        FROM treenode
+        WHERE id = ANY(%(ids)s)
+           OR parent_id = ANY(%(ids)s)
+           OR id IN (SELECT parent_id FROM treenode WHERE id = ANY(%(ids)s))
+        ''', {'ids': list(treenode_ids)})
+
+
+def invalidate_connectors(cursor, project_id, connector_ids):
+    """ Remove all cached tiles that may contain rows of the given connectors.
+    Must be called before a change, to invalidate the old state, and after it
+    if locations or links were changed.
+    """
+    if not enabled():
+        return
+    connector_ids = [int(c) for c in connector_ids]
+    if not connector_ids:
+        return
+    # Tiles reference a connector if it is located in them, if it is linked
+    # to one of their treenodes or if its parent or a child is referenced.
+    cursor.execute('''
+    SELECT id FROM connector
+    WHERE id = ANY(%(ids)s)
+       OR parent_id = ANY(%(ids)s)
+       OR id IN (SELECT parent_id FROM connector WHERE id = ANY(%(ids)s))
+    ''', {'ids': connector_ids})
+    related_ids = [row[0] for row in cursor.fetchall()]
+    if not related_ids:
+        return
+
+    _invalidate_tiles(cursor, project_id, '''
+        SELECT location_x, location_y, location_z
+        FROM connector
+        WHERE id = ANY(%(ids)s)
+        ''', {'ids': related_ids})
+
+    cursor.execute('''
+    SELECT DISTINCT treenode_id FROM treenode_connector
+    WHERE connector_id = ANY(%(ids)s)
+    ''', {'ids': related_ids})
+    treenode_ids = [row[0] for row in cursor.fetchall()]
+    if treenode_ids:
+        _invalidate_treenode_neighborhood(cursor, project_id, treenode_ids)
+
+
+def invalidate_treenodes(cursor, project_id, treenode_ids):
+    """ Remove all cached tiles that may contain rows of the given treenodes
+    or of connectors linked to them. Must be called before a change, to
+    invalidate the old state, and after it if locations or links changed.
+    """
+    if not enabled():
+        return
+    treenode_ids = [int(t) for t in treenode_ids]
+    if not treenode_ids:
+        return
+    _invalidate_treenode_neighborhood(cursor, project_id, treenode_ids)
+
+    cursor.execute('''
+    SELECT DISTINCT connector_id FROM treenode_connector
+    WHERE treenode_id = ANY(%(ids)s)
+    ''', {'ids': treenode_ids})
+    invalidate_connectors(cursor, project_id,
+                          [row[0] for row in cursor.fetchall()])
+
+
+def invalidate_skeletons(cursor, project_id, skeleton_ids):
+    """ Remove all cached tiles that contain nodes of the given skeletons,
+    e.g. before they are split, joined, rerooted or deleted. Parent and child
+    of a treenode are always part of the same skeleton.
+    """
+    if not enabled():
+        return
+    skeleton_ids = [int(s) for s in skeleton_ids]
+    if not skeleton_ids:
+        return
+    _invalidate_tiles(cursor, project_id, '''
+        SELECT location_x, location_y, location_z
+        FROM treenode
+        WHERE skeleton_id = ANY(%(ids)s)
+        ''', {'ids': skeleton_ids})
+
+    cursor.execute('''
+    SELECT DISTINCT connector_id FROM treenode_connector
+    WHERE skeleton_id = ANY(%(ids)s)
+    ''', {'ids': skeleton_ids})
+    invalidate_connectors(cursor, project_id,
+                          [row[0] for row in cursor.fetchall()])
+
+
+def flush_pending():
+    """ Delete all keys invalidated during this request once more. Called
+    by NodeListCacheMiddleware after the transaction has been committed.
+    """
+    keys = getattr(_pending, 'keys', None)
+    _pending.keys = set()
+    if keys:
+        cache.delete_many(keys)
@@ -6,6 +6,7 @@ from django.shortcuts import get_object_or_404
 
 from catmaid.models import UserRole, Relation, Class, ClassClass, Restriction, \
         CardinalityRestriction
+from catmaid.control import ontologycache
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, get_class_to_id_map
 
@@ -318,6 +319,7 @@ def add_relation_to_ontology(request, project_id=None):
     r = Relation.objects.create(user=request.user,
         project_id = project_id, relation_name = name, uri = uri,
         description = description, isreciprocal = isreciprocal)
+    ontologycache.invalidate(project_id)
 
     return HttpResponse(json.dumps({'relation_id': r.id}))
 
@@ -359,6 +361,7 @@ def rename_class(request, project_id=None):
     # Rename class to new name
     class_obj.class_name = new_name
     class_obj.save()
+    ontologycache.invalidate(class_obj.project_id)
 
     return HttpResponse(json.dumps({'renamed_class': class_id}))
 
@@ -389,6 +392,7 @@ def rename_relation(request, project_id=None):
     # Rename relation to name
     relation.relation_name = new_name
     relation.save()
+    ontologycache.invalidate(relation.project_id)
 
     return HttpResponse(json.dumps({'renamed_relation': rel_id}))
 
@@ -405,6 +409,7 @@ def remove_relation_from_ontology(request, project_id=None):
 
     # Delete, if not used
     relation.delete()
+    ontologycache.invalidate(relation.project_id)
     return HttpResponse(json.dumps({'deleted_relation': relid}))
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -427,6 +432,7 @@ def remove_all_relations_from_ontology(request, project_id=None):
                 r.delete()
             else:
                 not_deleted_ids.append(r.id)
+    ontologycache.invalidate(project_id)
 
     return HttpResponse(json.dumps(
         {'deleted_relations': deleted_ids,
@@ -453,6 +459,7 @@ def add_class_to_ontology(request, project_id=None):
     c = Class.objects.create(user=request.user,
         project_id = project_id, class_name = name,
         description = description)
+    ontologycache.invalidate(project_id)
 
     return HttpResponse(json.dumps({'class_id': c.id}))
 
@@ -477,6 +484,7 @@ def remove_class_from_ontology(request, project_id=None):
 
     # Delete, if not used
     class_instance.delete()
+    ontologycache.invalidate(class_instance.project_id)
     return HttpResponse(json.dumps({'deleted_class': classid}))
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -504,6 +512,7 @@ def remove_all_classes_from_ontology(request, project_id=None):
                 r.delete()
             else:
                 not_deleted_ids.append(r.id)
+    ontologycache.invalidate(project_id)
 
     return HttpResponse(json.dumps(
         {'deleted_classes': deleted_ids,
@@ -0,0 +1,113 @@
+""" A cache for the relation and class ID maps of projects.
+
+Nearly every tracing request needs the IDs of some relations or classes of
+its project, but these change only when the ontology is edited. Both maps are
+kept in the memory of each process and in Django's cache. Every project has a
+version in Django's cache that is replaced whenever one of its relations or
+classes changes. A process uses its own copy of a map for at most
+ONTOLOGY_CACHE_CHECK_INTERVAL seconds before it compares the version again
+and, if it changed, fetches the new map from Django's cache or the database.
+
+Like the node list cache, invalidated projects are remembered for the current
+request and invalidated again by OntologyCacheMiddleware once the transaction
+of the view has been committed, so that no concurrent reader can store a map
+it read before the commit under the new version.
+"""
+
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Maps (kind, project ID) to a tuple of version, time of the last version
+# check and the map itself.
+_local = {}
+_local_lock = threading.Lock()
+
+# Projects invalidated during the current request, invalidated again after
+# commit
+_pending = threading.local()
+
+
+def enabled():
+    return getattr(settings, 'ONTOLOGY_CACHE_ENABLED', False)
+
+def _version_key(project_id):
+    return 'catmaid.ontology.version.%s' % project_id
+
+def _map_key(kind, project_id, version):
+    return 'catmaid.ontology.%s.%s.%s' % (kind, project_id, version)
+
+
+def _version(project_id):
+    """ Return the current version of a project's maps, creating a new one if
+    there is none. Versions are random so that a version that got evicted from
+    the cache is never reused. """
+    key = _version_key(project_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, settings.ONTOLOGY_CACHE_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def get_map(kind, project_id, load):
+    """ Return the map of the given kind ('relation' or 'class') of a project.
+    If it isn't cached, it is created by calling load(project_id). Callers get
+    their own copy of the map. """
+    if not enabled():
+        return load(project_id)
+    project_id = int(project_id)
+    local_key = (kind, project_id)
+    now = time.time()
+    entry = _local.get(local_key)
+    if entry and now - entry[1] < settings.ONTOLOGY_CACHE_CHECK_INTERVAL:
+        return dict(entry[2])
+
+    version = _version(project_id)
+    if entry and entry[0] == version:
+        id_map = entry[2]
+    else:
+        key = _map_key(kind, project_id, version)
+        id_map = cache.get(key)
+        if id_map is None:
+            id_map = load(project_id)
+            cache.set(key, id_map, settings.ONTOLOGY_CACHE_TIMEOUT)
+    with _local_lock:
+        _local[local_key] = (version, now, id_map)
+    return dict(id_map)
+
+
+def _invalidate(project_id):
+    cache.set(_version_key(project_id), uuid.uuid4().hex,
+              settings.ONTOLOGY_CACHE_TIMEOUT)
+    with _local_lock:
+        for key in [k for k in _local if k[1] == project_id]:
+            del _local[key]
+
+
+def invalidate(project_id):
+    """ Drop the relation and class maps of a project. To be called by every
+    operation that creates, renames or deletes relations or classes. """
+    if not enabled():
+        return
+    project_id = int(project_id)
+    _invalidate(project_id)
+    if not hasattr(_pending, 'project_ids'):
+        _pending.project_ids = set()
+    _pending.project_ids.add(project_id)
+
+
+def flush_pending():
+    """ Invalidate all projects invalidated during this request once more.
+    Called by OntologyCacheMiddleware after the transaction has been
+    committed.
+    """
+    project_ids = getattr(_pending, 'project_ids', None)
+    _pending.project_ids = set()
+    if project_ids:
+        for project_id in project_ids:
+            _invalidate(project_id)
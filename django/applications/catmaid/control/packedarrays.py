@@ -0,0 +1,133 @@
+# A compact binary alternative to JSON for responses that are mostly tables
+# of numbers, like the nodes of a skeleton. A response is a list of parts, in
+# the same order as in the JSON version of the response. Each part is either a
+# table, whose columns are stored as typed arrays, or any other JSON value.
+#
+# Layout, all numbers little-endian:
+#   header:  4 bytes 'CATB', uint32 version, uint32 number of blocks, uint32 0
+#   blocks:  for every block four uint32: type, number of elements, offset of
+#            the data from the start and length of the data in bytes
+#   data:    the data of each block, starting at a multiple of 8 bytes
+# Block types are 0 (UTF-8 JSON text), 1 (int32) and 2 (float64), which map
+# directly onto JavaScript typed arrays. The first block is JSON: a list with
+# one entry per part, either {"columns": [names], "rows": n} for a table, in
+# which case the next blocks hold its columns in order, or {"value": v}.
+# NULL values in numeric columns are written as -1, dates as seconds since the
+# epoch. Columns with other values are written as JSON lists.
+
+import json
+import struct
+from calendar import timegm
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+MAGIC = 'CATB'
+VERSION = 1
+MEDIA_TYPE = 'application/x-catmaid-packed'
+
+JSON, INT32, FLOAT64 = 0, 1, 2
+_dtypes = {INT32: np.dtype('<i4'), FLOAT64: np.dtype('<f8')}
+
+_int32_range = np.iinfo(np.int32)
+
+Table = namedtuple('Table', ['columns', 'rows'])
+
+
+def requested(request):
+    """ Whether a client asked for the packed format, either with a 'format'
+    GET or POST parameter set to 'packed' or by accepting MEDIA_TYPE. """
+    if 'packed' == request.GET.get('format', request.POST.get('format')):
+        return True
+    accepted = request.META.get('HTTP_ACCEPT', '').split(',')
+    return MEDIA_TYPE in (a.split(';')[0].strip().lower() for a in accepted)
+
+def _to_number(value):
+    if value is None:
+        return -1
+    if isinstance(value, datetime):
+        return timegm(value.utctimetuple()) + value.microsecond / 1e6
+    return value
+
+def _column_block(values):
+    """ Return a tuple of block type, number of elements and data. """
+    try:
+        column = np.array([_to_number(v) for v in values])
+    except (TypeError, ValueError):
+        column = None
+    if column is not None and 'b' == column.dtype.kind:
+        column = column.astype(np.int32)
+    if column is None or column.dtype.kind not in 'iuf':
+        data = json.dumps(list(values), separators=(',', ':'), cls=DjangoJSONEncoder)
+        return JSON, len(data), data
+    if column.dtype.kind in 'iu' and (0 == len(column) or
+            (column.min() >= _int32_range.min and column.max() <= _int32_range.max)):
+        block_type = INT32
+    else:
+        block_type = FLOAT64
+    return block_type, len(column), column.astype(_dtypes[block_type]).tostring()
+
+def pack(parts):
+    """ Return the packed binary representation of a list of parts, each of
+    which is a Table or any JSON-serializable value. """
+    descriptors = []
+    blocks = []
+    for part in parts:
+        if isinstance(part, Table):
+            descriptors.append({'columns': part.columns, 'rows': len(part.rows)})
+            columns = zip(*part.rows) if part.rows else [()] * len(part.columns)
+            blocks.extend(_column_block(column) for column in columns)
+        else:
+            descriptors.append({'value': part})
+    description = json.dumps(descriptors, separators=(',', ':'), cls=DjangoJSONEncoder)
+    blocks.insert(0, (JSON, len(description), description))
+
+    header = [struct.pack('<4sIII', MAGIC, VERSION, len(blocks), 0)]
+    data = []
+    offset = 16 + 16 * len(blocks)
+    for block_type, count, content in blocks:
+        header.append(struct.pack('<IIII', block_type, count, offset, len(content)))
+        padding = -len(content) % 8
+        data.append(content + '\0' * padding)
+        offset += len(content) + padding
+    return ''.join(header + data)
+
+def unpack(data):
+    """ Return the list of parts of packed data, with tables as lists of row
+    tuples. """
+    magic, version, n_blocks, _ = struct.unpack_from('<4sIII', data)
+    if MAGIC != magic or VERSION != version:
+        raise ValueError("Not packed arrays of version %s" % VERSION)
+    blocks = []
+    for i in xrange(n_blocks):
+        block_type, count, offset, length = struct.unpack_from('<IIII', data, 16 + 16 * i)
+        content = data[offset:offset + length]
+        if JSON == block_type:
+            blocks.append(json.loads(content))
+        else:
+            blocks.append(np.fromstring(content, dtype=_dtypes[block_type]).tolist())
+    parts = []
+    next_block = 1
+    for descriptor in blocks[0]:
+        if 'columns' in descriptor:
+            n_columns = len(descriptor['columns'])
+            columns = blocks[next_block:next_block + n_columns]
+            next_block += n_columns
+            parts.append(zip(*columns) if descriptor['rows'] else [])
+        else:
+            parts.append(descriptor['value'])
+    return parts
+
+def vary_on_accept(response):
+    """ Mark a response of a URL that returns either JSON or the packed format,
+    depending on the Accept header, so that caches store both versions. """
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+def packed_response(parts):
+    return vary_on_accept(HttpResponse(pack(parts), content_type=MEDIA_TYPE))
@@ -97,18 +97,21 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
         num_reviewed = 0
     skeletons = defaultdict(Skeleton)
 
-    # Count nodes of each skeleton
+    skids = ",".join(map(str, skeleton_ids))
+
+    # Count nodes of each skeleton. Without a filter on reviewers, the
+    # summary also has the number of reviewed nodes.
+    count_reviewed = not (whitelist_id or user_ids or excluding_user_ids)
     cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
+    SELECT skeleton_id, num_nodes, num_reviewed_nodes
+    FROM skeleton_summary
     WHERE skeleton_id IN (%s)
-    GROUP BY skeleton_id
-    ''' % ",".join(map(str, skeleton_ids)))
+    ''' % skids)
     for row in cursor.fetchall():
         skeletons[row[0]].num_nodes = row[1]
+        if count_reviewed:
+            skeletons[row[0]].num_reviewed = row[2]
 
-    query_joins = ""
-    # Optionally, add a filter
     if whitelist_id:
         query_joins = """
                 JOIN reviewer_whitelist wl
@@ -117,31 +120,45 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
                       AND r.review_time >= wl.accept_after)
                   """ % (whitelist_id, project_id)
         user_filter = ""
+    elif user_ids and 1 == len(user_ids):
+        # The number of nodes reviewed by a single user is kept per skeleton
+        query_joins = None
+        cursor.execute('''
+        SELECT skeleton_id, num_reviewed_nodes
+        FROM skeleton_reviewer_summary
+        WHERE skeleton_id IN (%s)
+          AND reviewer_id = %s
+        ''' % (skids, int(user_ids[0])))
+        for row in cursor.fetchall():
+            skeletons[row[0]].num_reviewed = row[1]
     elif user_ids:
         # Count number of nodes reviewed by a certain set of users,
         # per skeleton.
+        query_joins = ""
         user_filter = " AND r.reviewer_id IN (%s)" % \
             ",".join(map(str, user_ids))
     elif excluding_user_ids:
         # Count number of nodes reviewed by all users excluding the
         # specified ones, per skeleton.
+        query_joins = ""
         user_filter = " AND r.reviewer_id NOT IN (%s)" % \
             ",".join(map(str, excluding_user_ids))
     else:
-        # Count total number of reviewed nodes per skeleton, regardless
-        # of reviewer.
-        user_filter = ""
-
-    cursor.execute('''
-    SELECT skeleton_id, count(*)
-    FROM (SELECT skeleton_id, treenode_id
-          FROM review r %s
-          WHERE skeleton_id IN (%s)%s
-          GROUP BY skeleton_id, treenode_id) AS sub
-    GROUP BY skeleton_id
-    ''' % (query_joins, ",".join(map(str, skeleton_ids)), user_filter))
-    for row in cursor.fetchall():
-        skeletons[row[0]].num_reviewed = row[1]
+        # The total number of reviewed nodes per skeleton, regardless of
+        # reviewer, is part of the summary.
+        query_joins = None
+
+    if query_joins is not None:
+        cursor.execute('''
+        SELECT skeleton_id, count(*)
+        FROM (SELECT skeleton_id, treenode_id
+              FROM review r %s
+              WHERE skeleton_id IN (%s)%s
+              GROUP BY skeleton_id, treenode_id) AS sub
+        GROUP BY skeleton_id
+        ''' % (query_joins, skids, user_filter))
+        for row in cursor.fetchall():
+            skeletons[row[0]].num_reviewed = row[1]
 
     status = {}
     for skid, s in skeletons.iteritems():
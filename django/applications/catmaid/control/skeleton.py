@@ -5,7 +5,6 @@ import re
 from operator import itemgetter
 from datetime import datetime, timedelta
 from collections import defaultdict
-from itertools import chain
 
 from django.core.serializers.json import DjangoJSONEncoder
 from django.http import HttpResponse
@@ -15,6 +14,8 @@ from django.db import connection
 from catmaid.models import Project, UserRole, Class, ClassInstance, Review, \
         ClassInstanceClassInstance, Relation, Treenode, TreenodeConnector
 from catmaid.objects import Skeleton
+from catmaid.control import nodelistcache
+from catmaid.control.bulkimport import copy_rows
 from catmaid.control.authentication import requires_user_role, \
         can_edit_class_instance_or_fail, can_edit_or_fail
 from catmaid.control.common import insert_into_log, get_class_to_id_map, \
@@ -338,26 +339,23 @@ def split_skeleton(request, project_id=None):
     # Make sure the user has permissions to edit
     can_edit_class_instance_or_fail(request.user, neuron.id, 'neuron')
 
-    # retrieve the id, parent_id of all nodes in the skeleton
-    # with minimal ceremony
+    nodelistcache.invalidate_skeletons(cursor, project_id, [skeleton_id])
+
+    # Collect the IDs of the split node and all nodes downstream of it in a
+    # temporary table, so that only the moved subtree is visited, through the
+    # index on parent_id.
     cursor.execute('''
-    SELECT id, parent_id FROM treenode WHERE skeleton_id=%s
-    ''' % skeleton_id) # no need to sanitize
-    # build the networkx graph from it
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        graph.add_node( row[0] )
-        if row[1]:
-            # edge from parent_id to id
-            graph.add_edge( row[1], row[0] )
-    # find downstream nodes starting from target treenode_id
-    # and generate the list of IDs to change, starting at treenode_id (inclusive)
-    change_list = nx.bfs_tree(graph, treenode_id).nodes()
-    if not change_list:
-        # When splitting an end node, the bfs_tree doesn't return any nodes,
-        # which is surprising, because when the splitted tree has 2 or more nodes
-        # the node at which the split is made is included in the list.
-        change_list.append(treenode_id)
+    DROP TABLE IF EXISTS split_downstream;
+    CREATE TEMPORARY TABLE split_downstream ON COMMIT DROP AS
+    WITH RECURSIVE downstream(id) AS (
+        SELECT %s::bigint
+      UNION ALL
+        SELECT t.id FROM treenode t, downstream d
+        WHERE t.parent_id = d.id
+    )
+    SELECT id FROM downstream;
+    ANALYZE split_downstream;
+    ''' % treenode_id)
     # create a new skeleton
     new_skeleton = ClassInstance()
     new_skeleton.name = 'Skeleton'
@@ -385,19 +383,22 @@ def split_skeleton(request, project_id=None):
     cici.user = skeleton.user # The same user that owned the skeleton to split
     cici.project_id = project_id
     cici.save()
-    # update skeleton_id of list in treenode table
-    # This creates a lazy QuerySet that, upon calling update, returns a new QuerySet
-    # that is then executed. It does NOT create an update SQL query for every treenode.
-    tns = Treenode.objects.filter(id__in=change_list).update(skeleton=new_skeleton)
-    # update the skeleton_id value of the treenode_connector table
-    tc = TreenodeConnector.objects.filter(
-        relation__relation_name__endswith = 'synaptic_to',
-        treenode__in=change_list,
-    ).update(skeleton=new_skeleton)
-    tcgj = TreenodeConnector.objects.filter(
-        relation__relation_name = 'gapjunction_with',
-        treenode__in=change_list,
-    ).update(skeleton=new_skeleton)
+    # update skeleton_id of the moved nodes in the treenode table
+    cursor.execute('''
+    UPDATE treenode t SET skeleton_id = %s
+    FROM split_downstream d WHERE t.id = d.id
+    ''' % new_skeleton.id)
+    # update the skeleton_id value of synaptic and gap junction links in the
+    # treenode_connector table
+    relation_ids = [str(rid) for name, rid in
+                    get_relation_to_id_map(project_id).iteritems()
+                    if name.endswith('synaptic_to') or name == 'gapjunction_with']
+    if relation_ids:
+        cursor.execute('''
+        UPDATE treenode_connector tc SET skeleton_id = %s
+        FROM split_downstream d
+        WHERE tc.treenode_id = d.id AND tc.relation_id IN (%s)
+        ''' % (new_skeleton.id, ','.join(relation_ids)))
     # setting new root treenode's parent to null
     Treenode.objects.filter(id=treenode_id).update(parent=None, editor=request.user)
 
@@ -407,7 +408,11 @@ def split_skeleton(request, project_id=None):
 
     # Update all reviews of the treenodes that are moved to a new neuron to
     # refer to the new skeleton.
-    Review.objects.filter(treenode_id__in=change_list).update(skeleton=new_skeleton)
+    cursor.execute('''
+    UPDATE review r SET skeleton_id = %s
+    FROM split_downstream d WHERE r.treenode_id = d.id;
+    DROP TABLE split_downstream;
+    ''' % new_skeleton.id)
 
     # Update annotations of under skeleton
     _annotate_entities(project_id, [new_neuron.id], downstream_annotation_map)
@@ -515,27 +520,24 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
         return Partner()
     partners = defaultdict(newPartner)
 
-    # Obtain the synapses made by all skeleton_ids considering the desired direction of the synapse, as specified by relation_id_1 and relation_id_2:
-    # Check that treenode_connectors aren't the same, as gap junctions are non-directional and dublicates would appear
+    # Obtain the synapses made by all skeleton_ids considering the desired direction of the synapse, as specified by relation_id_1 and relation_id_2.
+    # The skeleton_connectivity table holds, for every pair of skeletons, the number of pairs of distinct treenode_connector rows with a common connector.
     cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%s)
-      AND t1.relation_id = %s
-      AND t1.connector_id = t2.connector_id
-      AND t1.id <> t2.id
-      AND t2.relation_id = %s
+    SELECT skeleton_a, skeleton_b, count
+    FROM skeleton_connectivity
+    WHERE skeleton_a IN (%s)
+      AND relation_a = %s
+      AND relation_b = %s
     ''' % (','.join(map(str, skeleton_ids)), int(relation_id_1), int(relation_id_2)))
-    
+
     # Sum the number of synapses
-    for srcID, partnerID in cursor.fetchall():
+    for srcID, partnerID, count in cursor.fetchall():
         # For connections with self that are non-directional (gap junctions)
-        # add only half a connection, as they will be in the query twice.
+        # add only half a connection, as they are counted twice.
         if relation_id_1 == relation_id_2 and srcID == partnerID:
-            partners[partnerID].skids[srcID] += 0.5
+            partners[partnerID].skids[srcID] += 0.5 * count
         else:
-            partners[partnerID].skids[srcID] += 1
+            partners[partnerID].skids[srcID] += count
 
     # There may not be any synapses
     if not partners:
@@ -554,40 +556,27 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
     # Obtain a string with unique skeletons
     skids_string = ','.join(map(str, partners.iterkeys()))
 
-    # Count nodes of each partner skeleton
+    # Count nodes and the union of reviewed nodes of each partner skeleton
     cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
+    SELECT skeleton_id, num_nodes, num_reviewed_nodes
+    FROM skeleton_summary
     WHERE skeleton_id IN (%s)
-    GROUP BY skeleton_id
     ''' % skids_string) # no need to sanitize
     for row in cursor.fetchall():
-        partners[row[0]].num_nodes = row[1]
+        partner = partners[row[0]]
+        partner.num_nodes = row[1]
+        partner.union_reviewed = row[2]
 
     # Count nodes that have been reviewed by each user in each partner skeleton
     cursor.execute('''
-    SELECT skeleton_id, reviewer_id, count(*)
-    FROM review
+    SELECT skeleton_id, reviewer_id, num_reviewed_nodes
+    FROM skeleton_reviewer_summary
     WHERE skeleton_id IN (%s)
-    GROUP BY reviewer_id, skeleton_id
     ''' % skids_string) # no need to sanitize
     for row in cursor.fetchall():
         partner = partners[row[0]]
         partner.reviewed[row[1]] = row[2]
 
-    # Count total number of reviewed nodes per skeleton
-    cursor.execute('''
-    SELECT skeleton_id, count(*)
-    FROM (SELECT skeleton_id, treenode_id
-          FROM review
-          WHERE skeleton_id IN (%s)
-          GROUP BY skeleton_id, treenode_id) AS sub
-    GROUP BY skeleton_id
-    ''' % skids_string) # no need to sanitize
-    for row in cursor.fetchall():
-        partner = partners[row[0]]
-        partner.union_reviewed = row[1]
-
     # Obtain name of each skeleton's neuron
     cursor.execute('''
     SELECT class_instance_class_instance.class_instance_a,
@@ -607,16 +596,7 @@ def _skeleton_info_raw(project_id, skeletons, op):
     cursor = connection.cursor()
 
     # Obtain the IDs of the 'presynaptic_to', 'postsynaptic_to' and 'model_of' relations
-    cursor.execute('''
-    SELECT relation_name,
-           id
-    FROM relation
-    WHERE project_id=%s
-      AND (relation_name='presynaptic_to'
-        OR relation_name='postsynaptic_to'
-        OR relation_name='gapjunction_with'
-        OR relation_name='model_of')''' % project_id)
-    relation_ids = dict(cursor.fetchall())
+    relation_ids = get_relation_to_id_map(project_id)
 
     # Obtain partner skeletons and their info
     incoming = _connected_skeletons(skeletons, op, relation_ids['postsynaptic_to'], relation_ids['presynaptic_to'], relation_ids['model_of'], cursor)
@@ -759,44 +739,39 @@ def _reroot_skeleton(treenode_id, project_id):
         # Obtain the treenode from the response
         response_on_error = 'An error occured while rerooting. No valid query result.'
         treenode = q_treenode[0]
-        first_parent = treenode.parent
 
         # If no parent found it is assumed this node is already root
-        if first_parent is None:
+        if treenode.parent_id is None:
             return False
 
-        # Traverse up the chain of parents, reversing the parent relationships so
-        # that the selected treenode (with ID treenode_id) becomes the root.
-        new_parent = treenode
-        new_confidence = treenode.confidence
-        node = first_parent
-
-        while True:
-            response_on_error = 'Failed to update treenode with id %s to have new parent %s' % (node.id, new_parent.id)
-
-            # Store current values to be used in next iteration
-            parent = node.parent
-            confidence = node.confidence
+        nodelistcache.invalidate_skeletons(connection.cursor(), project_id,
+                                           [treenode.skeleton_id])
+
+        # Reverse the parent relationships on the path from the selected
+        # treenode up to the old root in a single statement, so that the
+        # selected treenode becomes the root. Every node on the path takes the
+        # confidence of its new parent edge from its former child, the new
+        # root is reset to maximum confidence.
+        response_on_error = 'Failed to reverse the path from treenode %s to the root' % treenode.id
+        cursor = connection.cursor()
+        cursor.execute('''
+        WITH RECURSIVE path(id, parent_id, confidence, depth) AS (
+            SELECT id, parent_id, confidence, 0
+            FROM treenode WHERE id = %s
+          UNION ALL
+            SELECT t.id, t.parent_id, t.confidence, p.depth + 1
+            FROM treenode t, path p
+            WHERE t.id = p.parent_id
+        )
+        UPDATE treenode t
+        SET parent_id = c.id,
+            confidence = coalesce(c.confidence, 5)
+        FROM path p LEFT OUTER JOIN path c ON c.depth = p.depth - 1
+        WHERE t.id = p.id
+        ''' % treenode.id)
 
-            # Set new values
-            node.parent = new_parent
-            node.confidence = new_confidence
-            node.save()
-
-            if parent is None:
-                # Root has been reached
-                break
-            else:
-                # Prepare next iteration
-                new_parent = node
-                new_confidence = confidence
-                node = parent
-
-        # Finally make treenode root
-        response_on_error = 'Failed to set treenode with ID %s as root.' % treenode.id
         treenode.parent = None
         treenode.confidence = 5 # reset to maximum confidence, now it is root.
-        treenode.save()
 
         return treenode
 
@@ -898,6 +873,9 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
             raise Exception("Annotation distribution is not valid for joining. " \
               "Annotations for which you don't have permissions have to be kept!")
 
+        nodelistcache.invalidate_skeletons(connection.cursor(), project_id,
+                                           [from_skid, to_skid])
+
         if from_skid == to_skid:
             raise Exception('Cannot join treenodes of the same skeleton, this would introduce a loop.')
 
@@ -1052,46 +1030,48 @@ def _import_skeleton(request, project_id, arborescence, neuron_id=None, name=Non
     if root is None:
         raise Exception('No root, provided graph is malformed!')
 
-    # Bulk create the required number of treenodes. This must be done in two
-    # steps because treenode IDs are not known.
+    # Copy the nodes into a staging table, draw their IDs from the location
+    # sequence and insert them all at once, with the parent IDs mapped by a
+    # join.
+    index = dict((n, i) for i, n in enumerate(arborescence.nodes_iter()))
+    parents = dict((nbr, n) for n, nbrs in arborescence.adjacency_iter()
+                   for nbr in nbrs)
     cursor = connection.cursor()
     cursor.execute("""
-        INSERT INTO treenode (project_id, location_x, location_y, location_z,
-            editor_id, user_id, skeleton_id)
-        SELECT t.project_id, t.x, t.x, t.x, t.user_id, t.user_id, t.skeleton_id
-        FROM (VALUES (%(project_id)s, 0, %(user_id)s, %(skeleton_id)s))
-            AS t (project_id, x, user_id, skeleton_id),
-            generate_series(1, %(num_treenodes)s)
-        RETURNING treenode.id;
+        DROP TABLE IF EXISTS import_skeleton_node;
+        CREATE TEMPORARY TABLE import_skeleton_node (
+            node integer, parent integer, x double precision,
+            y double precision, z double precision, id bigint)
+        ON COMMIT DROP;
+        """)
+    copy_rows(cursor, 'import_skeleton_node', ('node', 'parent', 'x', 'y', 'z'),
+            ((index[n], index.get(parents.get(n)), d['x'], d['y'], d['z'])
+             for n, d in arborescence.nodes_iter(data=True)))
+    cursor.execute("""
+        UPDATE import_skeleton_node SET id = nextval('location_id_seq');
+        INSERT INTO treenode (id, project_id, location_x, location_y,
+            location_z, parent_id, editor_id, user_id, skeleton_id)
+        SELECT n.id, %(project_id)s, n.x, n.y, n.z, p.id, %(user_id)s,
+            %(user_id)s, %(skeleton_id)s
+        FROM import_skeleton_node n
+        LEFT OUTER JOIN import_skeleton_node p ON p.node = n.parent;
+        SELECT node, id FROM import_skeleton_node;
         """ % {
             'project_id': project_id,
             'user_id': request.user.id,
-            'skeleton_id': new_skeleton.id,
-            'num_treenodes': arborescence.number_of_nodes()})
-    treenode_ids = cursor.fetchall()
-    # Flatten IDs
-    treenode_ids = list(chain.from_iterable(treenode_ids))
-    nx.set_node_attributes(arborescence, 'id', dict(zip(arborescence.nodes(), treenode_ids)))
-
-    # Set parent node ID
-    for n, nbrs in arborescence.adjacency_iter():
-        for nbr in nbrs:
-            arborescence.node[nbr]['parent_id'] = arborescence.node[n]['id']
-    arborescence.node[root]['parent_id'] = 'NULL'
+            'skeleton_id': new_skeleton.id})
+    treenode_ids = dict(cursor.fetchall())
+    cursor.execute("DROP TABLE import_skeleton_node")
+
+    nx.set_node_attributes(arborescence, 'id',
+            dict((n, treenode_ids[i]) for n, i in index.iteritems()))
+    for n in arborescence.nodes_iter():
+        parent = parents.get(n)
+        arborescence.node[n]['parent_id'] = \
+                'NULL' if parent is None else treenode_ids[index[parent]]
     new_location = tuple([arborescence.node[root][k] for k in ('x', 'y', 'z')])
 
-    treenode_values = \
-            '),('.join([','.join(map(str, [n[1][k] for k in ('id', 'x', 'y', 'z', 'parent_id')])) \
-            for n in arborescence.nodes_iter(data=True)])
-    cursor.execute("""
-        UPDATE treenode SET
-            location_x = v.x,
-            location_y = v.y,
-            location_z = v.z,
-            parent_id = v.parent_id
-        FROM (VALUES (%s)) AS v(id, x, y, z, parent_id)
-        WHERE treenode.id = v.id AND treenode.skeleton_id = %s
-        """ % (treenode_values, new_skeleton.id)) # Include skeleton ID for index performance.
+    nodelistcache.invalidate_skeletons(cursor, project_id, [new_skeleton.id])
 
     # Log import.
     insert_into_log(project_id, request.user.id, 'create_neuron',
@@ -1316,12 +1296,9 @@ def _list_skeletons(project_id, created_by=None, reviewed_by=None, from_date=Non
     if nodecount_gt > 0:
         params.append(nodecount_gt)
         query = '''
-            SELECT sub.skeleton_id
-            FROM (
-                SELECT t.skeleton_id AS skeleton_id, COUNT(*) AS count
-                FROM (%s) q JOIN treenode t ON q.skeleton_id = t.skeleton_id
-                GROUP BY t.skeleton_id
-            ) AS sub WHERE sub.count > %%s
+            SELECT q.skeleton_id
+            FROM (%s) q JOIN skeleton_summary s ON q.skeleton_id = s.skeleton_id
+            WHERE s.num_nodes > %%s
         ''' % query
 
     cursor = connection.cursor()
@@ -1,23 +1,28 @@
 import json
 import networkx as nx
-from itertools import imap
+from itertools import imap, groupby
+from operator import itemgetter
 from functools import partial
 from collections import defaultdict
-from math import sqrt
 from datetime import datetime
 
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db import connection
-from django.http import HttpResponse
+from django.db import connection, transaction
+from django.http import HttpResponse, StreamingHttpResponse
 
 from catmaid.models import UserRole, ClassInstance, Treenode, \
         TreenodeClassInstance, ConnectorClassInstance, Review
 from catmaid.control import export_NeuroML_Level3
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import server_side_rows, json_array_chunks, \
+        get_relation_to_id_map
+from catmaid.control.packedarrays import Table
+from catmaid.control import packedarrays
 from catmaid.control.review import get_treenodes_to_reviews, \
         get_treenodes_to_reviews_with_time
 
-from tree_util import edge_count_to_root, partition
+from arbor import arbors_from_rows
+from tree_util import edge_count_to_root
 try:
     from exportneuroml import neuroml_single_cell, neuroml_network
 except ImportError:
@@ -66,12 +71,117 @@ def export_skeleton_response(request, project_id=None, skeleton_id=None, format=
         raise Exception, "Unknown format ('%s') in export_skeleton_response" % (format,)
 
 
+# Queries shared by the compact skeleton and arbor exports. Each takes the
+# skeleton ID as first parameter.
+_NODES_QUERY = '''
+    SELECT id, parent_id, user_id,
+           location_x, location_y, location_z,
+           radius, confidence
+    FROM treenode
+    WHERE skeleton_id = %s
+'''
+
+_TAGS_QUERY = '''
+    SELECT c.name, tci.treenode_id
+    FROM treenode t,
+         treenode_class_instance tci,
+         class_instance c
+    WHERE t.skeleton_id = %s
+      AND t.id = tci.treenode_id
+      AND tci.relation_id = %s
+      AND c.id = tci.class_instance_id
+'''
+
+# All connectors of a skeleton with their partner treenode IDs
+_SKELETON_CONNECTORS_QUERY = '''
+    SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
+           c.location_x, c.location_y, c.location_z
+    FROM treenode_connector tc,
+         connector c
+    WHERE tc.skeleton_id = %s
+      AND tc.connector_id = c.id
+'''
+
+# All inputs and outputs of a skeleton, with the partner links
+_ARBOR_CONNECTORS_QUERY = '''
+    SELECT tc1.treenode_id, tc1.confidence,
+           tc1.connector_id,
+           tc2.confidence, tc2.treenode_id, tc2.skeleton_id,
+           tc1.relation_id, tc2.relation_id
+    FROM treenode_connector tc1,
+         treenode_connector tc2
+    WHERE tc1.skeleton_id = %s
+      AND tc1.id != tc2.id
+      AND tc1.connector_id = tc2.connector_id
+      AND (tc1.relation_id = %s OR tc1.relation_id = %s)
+'''
+
+# Column names of the tables in packed responses
+_NODE_COLUMNS = ['id', 'parent_id', 'user_id', 'x', 'y', 'z', 'radius', 'confidence']
+_SKELETON_CONNECTOR_COLUMNS = ['treenode_id', 'connector_id', 'relation', 'x', 'y', 'z']
+_ARBOR_CONNECTOR_COLUMNS = ['treenode_id', 'confidence', 'connector_id',
+        'partner_confidence', 'partner_treenode_id', 'partner_skeleton_id',
+        'relation', 'partner_relation']
+
+def _stream_requested(request):
+    """ Streaming is opt-in with a 'stream' GET or POST parameter. The packed
+    binary format is never streamed. """
+    return bool(int(request.GET.get('stream', request.POST.get('stream', 0)))) \
+        and not packedarrays.requested(request)
+
+def _check_skeleton_exists(skeleton_id):
+    if 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
+        raise Exception("Skeleton #%s doesn't exist" % skeleton_id)
+
+def _tags(rows):
+    tags = defaultdict(list)
+    for row in rows:
+        tags[row[0]].append(row[1])
+    return tags
+
+def _compact_skeleton_connectors(rows, relations):
+    post = relations['postsynaptic_to']
+    gj = relations['gapjunction_with']
+    return ((row[0], row[1], 1 if row[2] == post else 0 if row[2] != gj else 2, row[3], row[4], row[5]) for row in rows)
+
+def _compact_arbor_connectors(rows, relations):
+    pre = relations['presynaptic_to']
+    post = relations['postsynaptic_to']
+    for row in rows:
+        # Ignore all other kinds of relation pairs (there shouldn't be any)
+        if row[6] == pre and row[7] == post:
+            yield (row[0], row[1], row[2], row[3], row[4], row[5], 0, 1)
+        elif row[6] == post and row[7] == pre:
+            yield (row[0], row[1], row[2], row[3], row[4], row[5], 1, 0)
+
+def _stream_compact(parts):
+    """ Generator of the JSON array of the given parts, in pieces. Each part
+    is either a function that returns an iterable of rows, which is written as
+    an array, or a function that returns a dictionary. All queries run in one
+    transaction, reading rows through server-side cursors. """
+    with transaction.atomic():
+        separator = '['
+        for part in parts:
+            yield separator
+            separator = ','
+            content = part()
+            if isinstance(content, dict):
+                yield json.dumps(content, separators=(',', ':'))
+            else:
+                for piece in json_array_chunks(content):
+                    yield piece
+        yield ']'
+
+
 @requires_user_role(UserRole.Browse)
 def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors=None, with_tags=None):
     """
         Performance-critical function. Do not edit unless to improve performance.
 
         Returns, in JSON, [[nodes], [connectors], {nodeID: [tags]}], with connectors and tags being empty when 0 == with_connectors and 0 == with_tags, respectively
+
+        With the 'stream' parameter set to 1, the same JSON is streamed
+        while rows are read from the database.
     """
 
     # Sanitize
@@ -82,62 +192,49 @@ def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors
 
     cursor = connection.cursor()
 
-    cursor.execute('''
-        SELECT id, parent_id, user_id,
-               location_x, location_y, location_z,
-               radius, confidence
-        FROM treenode
-        WHERE skeleton_id = %s
-    ''' % skeleton_id)
+    if 0 != with_connectors or 0 != with_tags:
+        relations = get_relation_to_id_map(project_id)
+
+    if _stream_requested(request):
+        _check_skeleton_exists(skeleton_id)
+        parts = [partial(server_side_rows, _NODES_QUERY, (skeleton_id,))]
+        parts.append(partial(_compact_skeleton_connectors,
+            server_side_rows(_SKELETON_CONNECTORS_QUERY, (skeleton_id,)), relations)
+            if 0 != with_connectors else tuple)
+        parts.append(partial(_tags,
+            server_side_rows(_TAGS_QUERY, (skeleton_id, relations['labeled_as'])))
+            if 0 != with_tags else dict)
+        return packedarrays.vary_on_accept(
+                StreamingHttpResponse(_stream_compact(parts)))
+
+    cursor.execute(_NODES_QUERY, (skeleton_id,))
 
     nodes = tuple(cursor.fetchall())
 
     if 0 == len(nodes):
         # Check if the skeleton exists
-        if 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
-            raise Exception("Skeleton #%s doesn't exist" % skeleton_id)
+        _check_skeleton_exists(skeleton_id)
         # Otherwise returns an empty list of nodes
 
     connectors = ()
     tags = defaultdict(list)
 
-    if 0 != with_connectors or 0 != with_tags:
-        # postgres is caching this query
-        cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
-        relations = dict(cursor.fetchall())
-
     if 0 != with_connectors:
         # Fetch all connectors with their partner treenode IDs
-        cursor.execute('''
-            SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
-                   c.location_x, c.location_y, c.location_z
-            FROM treenode_connector tc,
-                 connector c
-            WHERE tc.skeleton_id = %s
-              AND tc.connector_id = c.id
-        ''' % skeleton_id)
-
-        post = relations['postsynaptic_to']
-        gj = relations['gapjunction_with']
-        connectors = tuple((row[0], row[1], 1 if row[2] == post else 0 if row[2] != gj else 2, row[3], row[4], row[5]) for row in cursor.fetchall())
+        cursor.execute(_SKELETON_CONNECTORS_QUERY, (skeleton_id,))
+        connectors = tuple(_compact_skeleton_connectors(cursor.fetchall(), relations))
 
     if 0 != with_tags:
         # Fetch all node tags
-        cursor.execute('''
-            SELECT c.name, tci.treenode_id
-            FROM treenode t,
-                 treenode_class_instance tci,
-                 class_instance c
-            WHERE t.skeleton_id = %s
-              AND t.id = tci.treenode_id
-              AND tci.relation_id = %s
-              AND c.id = tci.class_instance_id
-        ''' % (skeleton_id, relations['labeled_as']))
+        cursor.execute(_TAGS_QUERY, (skeleton_id, relations['labeled_as']))
+        tags = _tags(cursor.fetchall())
 
-        for row in cursor.fetchall():
-            tags[row[0]].append(row[1])
+    if packedarrays.requested(request):
+        return packedarrays.packed_response([Table(_NODE_COLUMNS, nodes),
+                Table(_SKELETON_CONNECTOR_COLUMNS, connectors), tags])
 
-    return HttpResponse(json.dumps((nodes, connectors, tags), separators=(',', ':')))
+    return packedarrays.vary_on_accept(HttpResponse(
+            json.dumps((nodes, connectors, tags), separators=(',', ':'))))
 
 
 @requires_user_role(UserRole.Browse)
@@ -160,6 +257,9 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
     then the next 3 values are from the partner skeleton,
     and finally the two relations: first for the given skeleton_id and then for the other skeleton.
     The relation_id is 0 for pre and 1 for post.
+
+    With the 'stream' parameter set to 1, the same JSON is streamed while
+    rows are read from the database.
     """
 
     # Sanitize
@@ -171,75 +271,164 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
 
     cursor = connection.cursor()
 
+    if 0 != with_connectors or 0 != with_tags:
+        relations = get_relation_to_id_map(project_id)
+
+    if _stream_requested(request):
+        if 0 != with_nodes:
+            _check_skeleton_exists(skeleton_id)
+        parts = [partial(server_side_rows, _NODES_QUERY, (skeleton_id,))
+                 if 0 != with_nodes else tuple]
+        parts.append(partial(_compact_arbor_connectors,
+            server_side_rows(_ARBOR_CONNECTORS_QUERY, (skeleton_id,
+                relations['presynaptic_to'], relations['postsynaptic_to'])),
+            relations)
+            if 0 != with_connectors else tuple)
+        parts.append(partial(_tags,
+            server_side_rows(_TAGS_QUERY, (skeleton_id, relations['labeled_as'])))
+            if 0 != with_tags else dict)
+        return packedarrays.vary_on_accept(
+                StreamingHttpResponse(_stream_compact(parts)))
+
     nodes = ()
     connectors = []
     tags = defaultdict(list)
 
     if 0 != with_nodes:
-        cursor.execute('''
-            SELECT id, parent_id, user_id,
-                location_x, location_y, location_z,
-                radius, confidence
-            FROM treenode
-            WHERE skeleton_id = %s
-        ''' % skeleton_id)
+        cursor.execute(_NODES_QUERY, (skeleton_id,))
 
         nodes = tuple(cursor.fetchall())
 
         if 0 == len(nodes):
             # Check if the skeleton exists
-            if 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
-                raise Exception("Skeleton #%s doesn't exist" % skeleton_id)
+            _check_skeleton_exists(skeleton_id)
             # Otherwise returns an empty list of nodes
 
-    if 0 != with_connectors or 0 != with_tags:
-        # postgres is caching this query
-        cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
-        relations = dict(cursor.fetchall())
-
     if 0 != with_connectors:
         # Fetch all inputs and outputs
+        cursor.execute(_ARBOR_CONNECTORS_QUERY, (skeleton_id,
+            relations['presynaptic_to'], relations['postsynaptic_to']))
+        connectors = list(_compact_arbor_connectors(cursor.fetchall(), relations))
 
-        pre = relations['presynaptic_to']
-        post = relations['postsynaptic_to']
+    if 0 != with_tags:
+        # Fetch all node tags
+        cursor.execute(_TAGS_QUERY, (skeleton_id, relations['labeled_as']))
+        tags = _tags(cursor.fetchall())
 
-        cursor.execute('''
-            SELECT tc1.treenode_id, tc1.confidence,
-                   tc1.connector_id,
-                   tc2.confidence, tc2.treenode_id, tc2.skeleton_id,
-                   tc1.relation_id, tc2.relation_id
-            FROM treenode_connector tc1,
-                 treenode_connector tc2
-            WHERE tc1.skeleton_id = %s
-              AND tc1.id != tc2.id
-              AND tc1.connector_id = tc2.connector_id
-              AND (tc1.relation_id = %s OR tc1.relation_id = %s)
-        ''' % (skeleton_id, pre, post))
+    if packedarrays.requested(request):
+        return packedarrays.packed_response([Table(_NODE_COLUMNS, nodes),
+                Table(_ARBOR_CONNECTOR_COLUMNS, connectors), tags])
 
-        for row in cursor.fetchall():
-            # Ignore all other kinds of relation pairs (there shouldn't be any)
-            if row[6] == pre and row[7] == post:
-                connectors.append((row[0], row[1], row[2], row[3], row[4], row[5], 0, 1))
-            elif row[6] == post and row[7] == pre:
-                connectors.append((row[0], row[1], row[2], row[3], row[4], row[5], 1, 0))
+    return packedarrays.vary_on_accept(HttpResponse(
+            json.dumps((nodes, connectors, tags), separators=(',', ':'))))
 
-    if 0 != with_tags:
-        # Fetch all node tags
-        cursor.execute('''
-            SELECT c.name, tci.treenode_id
-            FROM treenode t,
-                 treenode_class_instance tci,
-                 class_instance c
-            WHERE t.skeleton_id = %s
-              AND t.id = tci.treenode_id
-              AND tci.relation_id = %s
-              AND c.id = tci.class_instance_id
-        ''' % (skeleton_id, relations['labeled_as']))
 
-        for row in cursor.fetchall():
-            tags[row[0]].append(row[1])
+# Batch versions of the compact arbor queries, sorted by skeleton ID, which
+# comes first in every row
+_BATCH_NODES_QUERY = '''
+    SELECT skeleton_id, id, parent_id, user_id,
+           location_x, location_y, location_z,
+           radius, confidence
+    FROM treenode
+    WHERE skeleton_id = ANY(%s)
+    ORDER BY skeleton_id
+'''
+
+_BATCH_ARBOR_CONNECTORS_QUERY = '''
+    SELECT tc1.skeleton_id,
+           tc1.treenode_id, tc1.confidence,
+           tc1.connector_id,
+           tc2.confidence, tc2.treenode_id, tc2.skeleton_id,
+           tc1.relation_id, tc2.relation_id
+    FROM treenode_connector tc1,
+         treenode_connector tc2
+    WHERE tc1.skeleton_id = ANY(%s)
+      AND tc1.id != tc2.id
+      AND tc1.connector_id = tc2.connector_id
+      AND (tc1.relation_id = %s OR tc1.relation_id = %s)
+    ORDER BY tc1.skeleton_id
+'''
+
+_BATCH_TAGS_QUERY = '''
+    SELECT t.skeleton_id, c.name, tci.treenode_id
+    FROM treenode t,
+         treenode_class_instance tci,
+         class_instance c
+    WHERE t.skeleton_id = ANY(%s)
+      AND t.id = tci.treenode_id
+      AND tci.relation_id = %s
+      AND c.id = tci.class_instance_id
+    ORDER BY t.skeleton_id
+'''
+
+def _rows_by_skeleton(rows):
+    """ Given rows sorted by their first value, the skeleton ID, return a
+    function that returns the list of rows of a skeleton, without the skeleton
+    ID. The function has to be called with ascending skeleton IDs. """
+    groups = groupby(rows, itemgetter(0))
+    current = [next(groups, None)]
+    def rows_of(skeleton_id):
+        while current[0] is not None and current[0][0] < skeleton_id:
+            current[0] = next(groups, None)
+        if current[0] is None or current[0][0] != skeleton_id:
+            return []
+        group = [row[1:] for row in current[0][1]]
+        current[0] = next(groups, None)
+        return group
+    return rows_of
+
+def _no_rows(skeleton_id):
+    return ()
+
+def _stream_compact_arbors(skeleton_ids, relations, with_nodes, with_connectors, with_tags):
+    """ Generator of the JSON object of skeleton ID vs compact arbor, in
+    pieces of one skeleton each. The three queries run once for all skeletons
+    and are read in parallel through server-side cursors. """
+    with transaction.atomic():
+        nodes = _rows_by_skeleton(server_side_rows(_BATCH_NODES_QUERY,
+            (skeleton_ids,))) if with_nodes else _no_rows
+        connectors = _rows_by_skeleton(server_side_rows(_BATCH_ARBOR_CONNECTORS_QUERY,
+            (skeleton_ids, relations['presynaptic_to'], relations['postsynaptic_to']))) \
+            if with_connectors else _no_rows
+        tags = _rows_by_skeleton(server_side_rows(_BATCH_TAGS_QUERY,
+            (skeleton_ids, relations['labeled_as']))) if with_tags else _no_rows
+
+        separator = '{'
+        for skeleton_id in skeleton_ids:
+            arbor = (nodes(skeleton_id),
+                     list(_compact_arbor_connectors(connectors(skeleton_id), relations)),
+                     _tags(tags(skeleton_id)))
+            yield '%s"%s":%s' % (separator, skeleton_id,
+                                 json.dumps(arbor, separators=(',', ':')))
+            separator = ','
+        yield '}'
+
 
-    return HttpResponse(json.dumps((nodes, connectors, tags), separators=(',', ':')))
+@requires_user_role(UserRole.Browse)
+def compact_arbors(request, project_id=None):
+    """ Batch version of compact_arbor for the skeleton IDs given as POST
+    parameters skeleton_ids[]. Returns, streamed as JSON, an object of
+    skeleton ID vs [[nodes], [connectors], {tag: [nodeIDs]}], where each entry
+    is as returned by compact_arbor. The POST parameters with_nodes,
+    with_connectors and with_tags (all 1 by default) select what is included.
+    """
+    project_id = int(project_id)
+    skeleton_ids = sorted(set(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids[')))
+    if not skeleton_ids:
+        raise ValueError("No skeleton IDs provided")
+    with_nodes = int(request.POST.get('with_nodes', 1))
+    with_connectors = int(request.POST.get('with_connectors', 1))
+    with_tags = int(request.POST.get('with_tags', 1))
+
+    missing = set(skeleton_ids) - set(ClassInstance.objects.filter(
+            pk__in=skeleton_ids).values_list('id', flat=True))
+    if missing:
+        raise Exception("Skeletons don't exist: %s" % ", ".join(map(str, sorted(missing))))
+
+    relations = get_relation_to_id_map(project_id)
+
+    return StreamingHttpResponse(_stream_compact_arbors(skeleton_ids,
+            relations, with_nodes, with_connectors, with_tags))
 
 
 @requires_user_role([UserRole.Browse])
@@ -256,9 +445,11 @@ def treenode_time_bins(request, project_id=None, skeleton_id=None):
 
 @requires_user_role([UserRole.Browse])
 def compact_arbor_with_minutes(request, project_id=None, skeleton_id=None, with_nodes=None, with_connectors=None, with_tags=None):
+    if packedarrays.requested(request):
+        raise ValueError("Arbors with minutes are only available as JSON")
     r = compact_arbor(request, project_id=project_id, skeleton_id=skeleton_id, with_nodes=with_nodes, with_connectors=with_connectors, with_tags=with_tags)
-    r.content = "%s, %s]" % (r.content[:-1], treenode_time_bins(request, project_id=project_id, skeleton_id=skeleton_id).content)
-    return r
+    content = ''.join(r.streaming_content) if r.streaming else r.content
+    return HttpResponse("%s, %s]" % (content[:-1], treenode_time_bins(request, project_id=project_id, skeleton_id=skeleton_id).content))
 
 
 # DEPRECATED. Will be removed.
@@ -313,8 +504,7 @@ def _skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=True, lean=
 
     if 0 == lean: # meaning not lean
         # Text tags
-        cursor.execute("SELECT id FROM relation WHERE project_id=%s AND relation_name='labeled_as'" % int(project_id))
-        labeled_as = cursor.fetchall()[0][0]
+        labeled_as = get_relation_to_id_map(project_id)['labeled_as']
 
         cursor.execute(
              ''' SELECT treenode_class_instance.treenode_id, class_instance.name
@@ -360,7 +550,17 @@ def _skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=True, lean=
 # DEPRECATED. Will be removed.
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def skeleton_for_3d_viewer(request, project_id=None, skeleton_id=None):
-    return HttpResponse(json.dumps(_skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=request.POST.get('with_connectors', True), lean=int(request.POST.get('lean', 0)), all_field=request.POST.get('all_fields', False)), separators=(',', ':')))
+    all_field = request.POST.get('all_fields', False)
+    result = _skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=request.POST.get('with_connectors', True), lean=int(request.POST.get('lean', 0)), all_field=all_field)
+    if packedarrays.requested(request):
+        name, nodes, tags, connectors, reviews = result
+        times = ['creation_time', 'edition_time'] if all_field else []
+        return packedarrays.packed_response([name,
+                Table(_NODE_COLUMNS + times, nodes), tags,
+                Table(_SKELETON_CONNECTOR_COLUMNS + times[:1], connectors),
+                reviews])
+    return packedarrays.vary_on_accept(HttpResponse(
+            json.dumps(result, separators=(',', ':'))))
 
 # DEPRECATED. Will be removed.
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -390,18 +590,16 @@ def _measure_skeletons(skeleton_ids):
 
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT id, parent_id, skeleton_id, location_x, location_y, location_z
+    SELECT id, COALESCE(parent_id, -1), skeleton_id,
+           location_x, location_y, location_z
     FROM treenode
     WHERE skeleton_id IN (%s)
+    ORDER BY skeleton_id
     ''' % skids_string)
 
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
-
     class Skeleton():
         def __init__(self):
-            self.nodes = {}
+            self.n_nodes = 0
             self.raw_cable = 0
             self.smooth_cable = 0
             self.principal_branch_cable = 0
@@ -410,90 +608,25 @@ def _measure_skeletons(skeleton_ids):
             self.n_pre = 0
             self.n_post = 0
 
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children = {} # node ID vs distance
-
-    skeletons = defaultdict(dict) # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        skeleton = skeletons.get(row[2])
-        if not skeleton:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        skeleton.nodes[row[0]] = Node(row[1], row[3], row[4], row[5])
-
-    for skeleton in skeletons.itervalues():
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in nodes.iteritems():
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(oids.itervalues())
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in oids.iteritems():
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances if sum_distances != 0 else 0
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
+    skeletons = defaultdict(Skeleton) # skeleton ID vs Skeleton
+    for skeleton_id, arbor in arbors_from_rows(cursor.fetchall()):
+        skeleton = skeletons[skeleton_id]
+        skeleton.n_nodes = len(arbor)
+        lengths = arbor.edge_lengths()
+        skeleton.raw_cable = lengths.sum()
+        ends, branches = arbor.end_and_branch_masks()
+        skeleton.n_ends = int(ends.sum())
+        skeleton.n_branch = int(branches.sum())
+        # Smooth the position of slab nodes (root, branch and end nodes
+        # do not move) and measure the cable, also of the principal branch
+        # (the longest sequence of the partition).
+        smooth_lengths = arbor.edge_lengths(arbor.smoothed_locations(lengths))
+        skeleton.smooth_cable = smooth_lengths.sum()
+        sequences = arbor.partition()
+        if sequences:
+            principal_branch = max(sequences, key=len)
+            skeleton.principal_branch_cable = \
+                    float(smooth_lengths[principal_branch].sum())
 
     # Count inputs
     cursor.execute('''
@@ -535,8 +668,13 @@ def _measure_skeletons(skeleton_ids):
 def measure_skeletons(request, project_id=None):
     skeleton_ids = tuple(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids['))
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_branch, sk.n_ends, sk.principal_branch_cable)
-    return HttpResponse(json.dumps([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).iteritems()]))
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_branch, sk.n_ends, sk.principal_branch_cable)
+    rows = [asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).iteritems()]
+    if packedarrays.requested(request):
+        return packedarrays.packed_response([Table(['skeleton_id',
+            'raw_cable', 'smooth_cable', 'n_pre', 'n_post', 'n_nodes',
+            'n_branch', 'n_ends', 'principal_branch_cable'], rows)])
+    return packedarrays.vary_on_accept(HttpResponse(json.dumps(rows)))
 
 
 def _skeleton_neuroml_cell(skeleton_id, preID, postID):
@@ -575,13 +713,7 @@ def skeletons_neuroml(request, project_id=None):
 
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % project_id)
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     preID = relations['presynaptic_to']
     postID = relations['postsynaptic_to']
 
@@ -605,15 +737,7 @@ def export_neuroml_level3_v181(request, project_id=None):
     skeleton_strings = ",".join(map(str, skeleton_ids))
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to'
-           OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     presynaptic_to = relations['presynaptic_to']
     postsynaptic_to = relations['postsynaptic_to']
 
@@ -858,12 +982,12 @@ def within_spatial_distance(request, project_id=None):
     if 0 == distance:
         return HttpResponse(json.dumps({"skeletons": []}))
     size_mode = int(request.POST.get("size_mode", 0))
-    having = ""
+    size_filter = ""
 
     if 0 == size_mode:
-        having = "HAVING count(*) > 1"
+        size_filter = "WHERE s.num_nodes > 1"
     elif 1 == size_mode:
-        having = "HAVING count(*) = 1"
+        size_filter = "WHERE s.num_nodes = 1"
     # else, no constraint
 
     cursor = connection.cursor()
@@ -878,21 +1002,27 @@ def within_spatial_distance(request, project_id=None):
     z0 = pos[2] - distance
     z1 = pos[2] + distance
 
-    # Cheap emulation of the distance
+    # Cheap emulation of the distance. The &&& test against the bounding box
+    # lets PostGIS use the 3D spatial index on treenode locations. The size of
+    # each skeleton is looked up in the skeleton summary.
     cursor.execute('''
-SELECT skeleton_id, count(*)
-FROM treenode
-WHERE project_id = %s
-  AND location_x > %s
-  AND location_x < %s
-  AND location_y > %s
-  AND location_y < %s
-  AND location_z > %s
-  AND location_z < %s
-GROUP BY skeleton_id
+SELECT t.skeleton_id
+FROM (SELECT DISTINCT skeleton_id
+      FROM treenode
+      WHERE ST_MakePoint(location_x, location_y, location_z) &&&
+              ST_MakeLine(ST_MakePoint(%s, %s, %s), ST_MakePoint(%s, %s, %s))
+        AND project_id = %s
+        AND location_x > %s
+        AND location_x < %s
+        AND location_y > %s
+        AND location_y < %s
+        AND location_z > %s
+        AND location_z < %s) t
+JOIN skeleton_summary s ON s.skeleton_id = t.skeleton_id
 %s
 LIMIT %s
-''' % (project_id, x0, x1, y0, y1, z0, z1, having, limit))
+''' % (x0, y0, z0, x1, y1, z1,
+       project_id, x0, x1, y0, y1, z0, z1, size_filter, limit))
 
  
     skeletons = tuple(row[0] for row in cursor.fetchall())
@@ -935,11 +1065,10 @@ WHERE tc1.project_id = %s
         # Filter by size: only those with more than one treenode or with exactly one
         cursor.execute('''
 SELECT skeleton_id
-FROM treenode
-WHERE skeleton_id IN (%s)
-GROUP BY skeleton_id
-HAVING count(*) %s 1
-''' % (",".join(str(row[0]) for row in cursor.fetchall()), ">" if 0 == size_mode else "="))
+FROM skeleton_summary
+WHERE skeleton_id = ANY(%%s)
+  AND num_nodes %s 1
+''' % (">" if 0 == size_mode else "="), ([row[0] for row in cursor.fetchall()],))
 
     return HttpResponse(json.dumps(tuple(row[0] for row in cursor.fetchall())))
 
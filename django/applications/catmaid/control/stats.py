@@ -8,7 +8,7 @@ from django.db.models.aggregates import Count
 from django.db import connection
 
 from catmaid.control.authentication import requires_user_role
-from catmaid.models import ClassInstance, Connector, Treenode, User, UserRole, \
+from catmaid.models import Treenode, User, UserRole, \
         Review, Relation, TreenodeConnector
 
 
@@ -32,52 +32,41 @@ def _process(query, minus1name):
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def stats_nodecount(request, project_id=None):
     return _process('''
-    SELECT user_id, count(*)
-    FROM treenode
+    SELECT user_id, sum(nodes_created)
+    FROM contribution_summary
     WHERE project_id=%s
     GROUP BY user_id
+    HAVING sum(nodes_created) > 0
     ''' % int(project_id), "*anonymous*")
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def stats_editor(request, project_id=None):
     return _process('''
-    SELECT editor_id, count(editor_id)
-    FROM treenode
+    SELECT user_id, sum(nodes_edited)
+    FROM contribution_summary
     WHERE project_id=%s
-      AND editor_id != user_id
-    GROUP BY username
+    GROUP BY user_id
+    HAVING sum(nodes_edited) > 0
     ''' % int(project_id), "*unedited*")
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def stats_summary(request, project_id=None):
-    startdate = datetime.today()
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT nodes_created, connectors_created, skeletons_created
+    FROM contribution_summary
+    WHERE project_id=%s
+      AND user_id=%s
+      AND date=current_date
+    ''', (int(project_id), request.user.id))
+    row = cursor.fetchone() or (0, 0, 0)
     result = {
-        'treenodes_created': Treenode.objects.filter(
-            project=project_id,
-            user=request.user.id,
-            creation_time__year=startdate.year,
-            creation_time__month=startdate.month,
-            creation_time__day=startdate.day).count(),
-        'connectors_created': Connector.objects.filter(
-            project=project_id,
-            user=request.user.id,
-            creation_time__year=startdate.year,
-            creation_time__month=startdate.month,
-            creation_time__day=startdate.day
-            ).count(),
+        'treenodes_created': row[0],
+        'connectors_created': row[1],
+        'skeletons_created': row[2],
     }
-    for key, class_name in [
-            ('skeletons_created', 'skeleton')
-            ]:
-        result[key] = ClassInstance.objects.filter(
-            project=project_id,
-            user=request.user.id,
-            creation_time__year=startdate.year,
-            creation_time__month=startdate.month,
-            creation_time__day=startdate.day,
-            class_column__class_name=class_name).count()
     return HttpResponse(json.dumps(result), content_type='text/json')
 
 
@@ -88,28 +77,23 @@ def stats_history(request, project_id=None):
     start_date = request.GET.get('start_date', datetime.now() - timedelta(30))
     end_date = request.GET.get('end_date', datetime.now())
 
-    # Look up all tree nodes for the project in the given date range.
-    # Also add a computed field which is just the day of the last edited
-    # date/time.
-    tree_nodes = Treenode.objects \
-        .filter(
-            project=project_id,
-            edition_time__range=(start_date, end_date)) \
-        .extra(select={
-            'date': 'to_char("treenode"."edition_time", \'YYYYMMDD\')'}) \
-        .order_by('user', 'date')
-
-    # Get the count of tree nodes for each user/day combination.
-    stats = tree_nodes.values('user__username', 'date') \
-        .annotate(count=Count('id'))
-
-    # Change the 'user__username' field name to just 'name'.
-    # (If <https://code.djangoproject.com/ticket/12222> ever gets implemented
-    # then this wouldn't be necessary.)
+    # Get the count of tree nodes created by each user on each day in the
+    # given date range.
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT u.username, to_char(c.date, 'YYYYMMDD'), c.nodes_created
+    FROM contribution_summary c
+    JOIN auth_user u ON u.id = c.user_id
+    WHERE c.project_id=%s
+      AND c.date BETWEEN %s::date AND %s::date
+      AND c.nodes_created > 0
+    ORDER BY c.user_id, c.date
+    ''', (int(project_id), start_date, end_date))
+
     stats = [{
-        'name': stat['user__username'],
-        'date': stat['date'],
-        'count': stat['count']} for stat in stats]
+        'name': row[0],
+        'date': row[1],
+        'count': row[2]} for row in cursor.fetchall()]
 
     return HttpResponse(json.dumps(stats), content_type='text/json')
 
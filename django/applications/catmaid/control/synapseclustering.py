@@ -7,10 +7,11 @@ from collections import namedtuple
 from catmaid.models import Treenode, TreenodeConnector, ClassInstance, Relation
 
 
-try:
-    from scipy.sparse.csgraph import dijkstra
-except:
-    pass
+# Synapses further away from a node than this many times the largest bandwidth
+# don't contribute to its density: exp(-16) is below 1e-6.
+DENSITY_CUTOFF = 4.0
+
+SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
 
 def synapse_clustering( skeleton_id, h_list ):
 
@@ -26,80 +27,127 @@ def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
         connector_ids: list of connector IDs.
         relations: list of the type of synapse, 'presynaptic_to' or 'postsynaptic_to'.
         The three lists are synchronized by index.
+        The graph must be a tree or a forest. The density of synapses is
+        computed for all bandwidths in h_list at once, and each synapse is
+        assigned to the local maximum of the density that it reaches by
+        hill climbing.
     """
+    nodeList = Gwud.nodes()
+    id2index = {node: i for i, node in enumerate(nodeList)}
+    for node in synNodes:
+        if node not in id2index:
+            id2index[node] = len(nodeList)
+            nodeList.append(node)
+
+    edges = Gwud.edges(data=True)
+    edge_a = np.fromiter((id2index[a] for a, b, d in edges), np.int64, len(edges))
+    edge_b = np.fromiter((id2index[b] for a, b, d in edges), np.int64, len(edges))
+    edge_w = np.fromiter((d.get('weight', 1) for a, b, d in edges), np.float64, len(edges))
+    adjacency = _adjacency(len(nodeList), edge_a, edge_b, edge_w)
+
+    synIndices = np.fromiter(set(id2index[node] for node in synNodes), np.int64)
+    densities = _tree_densities(adjacency, synIndices, h_list)
 
-    D, id2index = distanceMatrix( Gwud, synNodes )
-    
-    SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
     synapseGroups = {}
 
-    for h in h_list:
-        expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
-    
-        targLoc = {}            # targLocs hosts the final destination nodes of the hill climbing
-        densityField = {}            # densityField stores the height of the hill to be climbed
-        for startNode in synNodes:
-            if startNode not in targLoc:    
-                currNode = startNode
-                allOnPath = []
-                
-                if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
-    
-                while True:
-                    allOnPath.append(currNode)
-    
-                    #Make sure I have densityField of all neighbors for comparison
-                    if currNode in targLoc:
-                        currNode = targLoc[ currNode ] # Jump right to the end already.
-                        break
-                    
-                    for nn in Gwud.neighbors( currNode ): 
-                        if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
-                    
-                    prevNode = currNode
-                    for nn in Gwud.neighbors( currNode ):
-                        if densityField[nn] > densityField[currNode]:
-                            currNode = nn
-                                                    
-                    if currNode == prevNode:
-                        break
-                            
-                for node in allOnPath:
-                    targLoc[node] = currNode
-
-        uniqueTargs = set(targLoc[node] for node in synNodes)
+    for h, density in zip(h_list, densities):
+        targLoc = _hill_climb(adjacency, density)
+
+        uniqueTargs = set(targLoc[id2index[node]] for node in synNodes)
 
         loc2group = {}
 
         synapseGroups[h] = {}
         for ind, val in enumerate(uniqueTargs):
             loc2group[val] = ind
-            synapseGroups[h][ind] = SynapseGroup([], [], [], val)
-        
+            synapseGroups[h][ind] = SynapseGroup([], [], [], nodeList[val])
+
         for ind, node in enumerate(synNodes):
-            gi = loc2group[targLoc[node]]
+            gi = loc2group[targLoc[id2index[node]]]
             synapseGroups[h][ gi ].node_ids.append( node )
             synapseGroups[h][ gi ].connector_ids.append( connector_ids[ind] )
             synapseGroups[h][ gi ].relations.append( relations[ind] )
 
     return synapseGroups
 
-def distanceMatrix( G, synNodes ):
-    """ Given a nx graph, produce an all to all distance dict via scipy sparse matrix black magic.
-     Also, you get in 'id2index' the the mapping from a node id to the index in matrix scaledDistance. """
-    dmat = {}
-    nodeList = tuple(G.nodes())
-    synNodes = set(synNodes)
-    synIndices = tuple(i for i,node in enumerate(nodeList) if node in synNodes)
-
-    dmat = dijkstra(nx.to_scipy_sparse_matrix(G, nodeList),
-            directed=False, indices=synIndices)
-
-    return dmat, {node: i for i,node in enumerate(nodeList)}
+def _adjacency(n, edge_a, edge_b, edge_w):
+    """ Return the undirected edges as a tuple of arrays in compressed sparse
+    row form: the offset of the first neighbor of each node (n + 1 entries),
+    the neighbors and the edge weights. """
+    a = np.concatenate((edge_a, edge_b))
+    b = np.concatenate((edge_b, edge_a))
+    w = np.concatenate((edge_w, edge_w))
+    order = np.argsort(a, kind='mergesort')
+    starts = np.searchsorted(a[order], np.arange(n + 1))
+    return starts, b[order], w[order]
+
+def _tree_densities(adjacency, sources, h_list):
+    """ Return an array with one row per bandwidth h in h_list and one column
+    per node, with the sum over all source nodes s of exp(-d(s, node)^2 / h^2),
+    where d is the path length along the tree.
+    All sources walk outwards through the tree at the same time, one edge per
+    step, and stop at DENSITY_CUTOFF times the largest bandwidth. Because the
+    graph is a tree, a walk never has to revisit the node it came from, so no
+    distance matrix is needed and the cost is proportional to the number of
+    (source, node) pairs within the cutoff. """
+    starts, neighbors, weights = adjacency
+    n = len(starts) - 1
+    degrees = np.diff(starts)
+    inv_h2 = 1.0 / np.array(h_list, dtype=np.float64) ** 2
+    cutoff = DENSITY_CUTOFF * max(h_list)
+    densities = np.zeros((len(h_list), n))
+
+    node = np.asarray(sources, dtype=np.int64)
+    previous = -np.ones(len(node), dtype=np.int64)
+    distance = np.zeros(len(node))
+    while len(node):
+        d2 = distance * distance
+        for k in xrange(len(inv_h2)):
+            densities[k] += np.bincount(node, weights=np.exp(-d2 * inv_h2[k]),
+                                        minlength=n)
+        # Step from every node of the frontier to all of its neighbors
+        degree = degrees[node]
+        total = degree.sum()
+        if 0 == total:
+            break
+        walker = np.repeat(np.arange(len(node)), degree)
+        first = np.cumsum(degree) - degree
+        edge = np.repeat(starts[node] - first, degree) + np.arange(total)
+        step_node = neighbors[edge]
+        step_distance = distance[walker] + weights[edge]
+        keep = (step_node != previous[walker]) & (step_distance <= cutoff)
+        previous = node[walker[keep]]
+        node = step_node[keep]
+        distance = step_distance[keep]
+
+    return densities
+
+def _hill_climb(adjacency, density):
+    """ Return for every node the index of the local maximum of the density
+    that is reached by repeatedly moving to the neighbor with the highest
+    density, as long as it is higher than the density of the current node. """
+    starts, neighbors, weights = adjacency
+    n = len(starts) - 1
+    target = np.arange(n)
+    degrees = np.diff(starts)
+    inner = np.flatnonzero(degrees > 0)
+    if len(inner):
+        neighbor_density = density[neighbors]
+        best = np.maximum.reduceat(neighbor_density, starts[inner])
+        # The first neighbor with the highest density
+        is_best = neighbor_density == np.repeat(best, degrees[inner])
+        positions = np.where(is_best, np.arange(len(neighbors)), len(neighbors))
+        first_best = np.minimum.reduceat(positions, starts[inner])
+        climb = best > density[inner]
+        target[inner[climb]] = neighbors[first_best[climb]]
+    # Follow the uphill pointers to their ends. Density strictly increases
+    # along them, hence there are no cycles.
+    while True:
+        next_target = target[target]
+        if (next_target == target).all():
+            break
+        target = next_target
+    return target
 
 def countTargets( skeleton_id ):
     nTargets = {}
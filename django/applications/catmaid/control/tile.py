@@ -1,6 +1,7 @@
 import os
 import cStringIO
-from contextlib import closing
+import threading
+from collections import OrderedDict
 import h5py
 import numpy as np
 import base64
@@ -13,6 +14,165 @@ except:
 
 from django.http import HttpResponse
 
+
+class LRUCache(object):
+    """ A dictionary that holds at most max_size units, as measured by the
+    size function passed, by removing the least recently used entries. """
+
+    def __init__(self, max_size, size=lambda value: 1, on_evict=None):
+        self.max_size = max_size
+        self.size = size
+        self.on_evict = on_evict
+        self.total = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.pop(key)
+        self.entries[key] = value
+        self.total += self.size(value)
+        while self.total > self.max_size and len(self.entries) > 1:
+            self.pop(next(iter(self.entries)))
+
+    def pop(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.total -= self.size(value)
+            if self.on_evict:
+                self.on_evict(key, value)
+        return value
+
+    def clear(self):
+        for key in list(self.entries):
+            self.pop(key)
+
+
+class HDF5TileServer(object):
+    """ Serves tiles from HDF5 files and stores labels in them. It keeps up to
+    HDF5_TILE_MAX_OPEN_FILES files open, caches decoded blocks of
+    HDF5_TILE_CHUNK_SIZE x HDF5_TILE_CHUNK_SIZE pixels up to a total of
+    HDF5_TILE_CHUNK_CACHE_SIZE bytes and PNG encoded tiles up to a total of
+    HDF5_TILE_CACHE_SIZE bytes. Cached data is keyed by the version of a
+    file, its modification time and size together with the number of writes
+    of this process, so that changes to a file make them unreachable.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Open files, keyed by path, as (h5py file, mode, version opened) tuples
+        self.files = LRUCache(settings.HDF5_TILE_MAX_OPEN_FILES,
+                on_evict=lambda path, entry: entry[0].close())
+        self.chunks = LRUCache(settings.HDF5_TILE_CHUNK_CACHE_SIZE,
+                size=lambda chunk: chunk.nbytes)
+        self.tiles = LRUCache(settings.HDF5_TILE_CACHE_SIZE, size=len)
+        self.writes = {}
+
+    def version(self, path):
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size, self.writes.get(path, 0)
+
+    def open(self, path, mode='r'):
+        """ Return an open h5py file, which is reopened if it has been
+        changed by others since it was opened for reading. A file that is
+        opened for writing can be read, too. """
+        entry = self.files.get(path)
+        if entry:
+            hfile, open_mode, opened_version = entry
+            if 'a' == open_mode or ('r' == mode and
+                    opened_version == self.version(path)):
+                return hfile
+            self.files.pop(path)
+        version = self.version(path) if os.path.exists(path) else None
+        hfile = h5py.File(path, mode)
+        self.files.put(path, (hfile, mode, version))
+        return hfile
+
+    def read_region(self, path, version, hdfpath, x, y, width, height):
+        """ Return the same array as reading [y:y+height, x:x+width] of a two
+        dimensional dataset, assembled from cached chunks. """
+        dataset = self.open(path)[hdfpath]
+        rows, cols = dataset.shape[:2]
+        y_end = min(y + height, rows)
+        x_end = min(x + width, cols)
+        if x < 0 or y < 0 or y_end <= y or x_end <= x:
+            return dataset[y:y+height, x:x+width]
+        size = settings.HDF5_TILE_CHUNK_SIZE
+        data = np.empty((y_end - y, x_end - x), dtype=dataset.dtype)
+        for cy in xrange(y // size, (y_end - 1) // size + 1):
+            for cx in xrange(x // size, (x_end - 1) // size + 1):
+                key = (path, version, hdfpath, cy, cx)
+                chunk = self.chunks.get(key)
+                if chunk is None:
+                    chunk = dataset[cy*size:(cy+1)*size, cx*size:(cx+1)*size]
+                    self.chunks.put(key, chunk)
+                y0, y1 = max(y, cy * size), min(y_end, (cy + 1) * size)
+                x0, x1 = max(x, cx * size), min(x_end, (cx + 1) * size)
+                data[y0-y:y1-y, x0-x:x1-x] = \
+                        chunk[y0-cy*size:y1-cy*size, x0-cx*size:x1-cx*size]
+        return data
+
+    def get_tile(self, path, scale, z, x, y, width, height):
+        """ Return a PNG encoded tile, which is blank if the file or the scale
+        doesn't exist. """
+        with self.lock:
+            if not os.path.exists(path):
+                return self.blank_tile(width, height)
+            version = self.version(path)
+            key = (path, version, scale, z, x, y, width, height)
+            tile = self.tiles.get(key)
+            if tile is None:
+                hfile = self.open(path)
+                if not str(int(scale)) in hfile['/'].keys():
+                    return self.blank_tile(width, height)
+                hdfpath = '/' + str(int(scale)) + '/' + str(z) + '/data'
+                data = self.read_region(path, version, hdfpath, x, y,
+                                        width, height)
+                tile = encode_tile(data, width, height)
+                self.tiles.put(key, tile)
+            return tile
+
+    def blank_tile(self, width, height):
+        key = ('blank', width, height)
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = encode_tile(np.zeros((height, width)), width, height)
+            self.tiles.put(key, tile)
+        return tile
+
+    def put_labels(self, path, scale, z, x, y, width, height, labels):
+        with self.lock:
+            hfile = self.open(path, 'a')
+            hdfpath = '/labels/scale/' + str(int(scale)) + '/data'
+            hfile[hdfpath][y:y+height,x:x+width,z] = labels
+            hfile.flush()
+            self.writes[path] = self.writes.get(path, 0) + 1
+            # Don't keep the file open for writing, this closes it
+            self.files.pop(path)
+
+
+def encode_tile(data, width, height):
+    pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
+    output = cStringIO.StringIO()
+    pilImage.save(output, "PNG")
+    return output.getvalue()
+
+_server = None
+_server_pid = None
+
+def get_server():
+    """ The tile server of this process, created on first use. """
+    global _server, _server_pid
+    # Open files can't be shared with forked processes
+    if _server is None or _server_pid != os.getpid():
+        _server = HDF5TileServer()
+        _server_pid = os.getpid()
+    return _server
+
 def get_tile(request, project_id=None, stack_id=None):
 
     scale = float(request.GET.get('scale', '0'))
@@ -29,33 +189,8 @@ def get_tile(request, project_id=None, stack_id=None):
     # need to know the stack name
     fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}_{2}.hdf'.format( project_id, stack_id, basename ) )
 
-    if not os.path.exists( fpath ):
-        data=np.zeros( (height, width) )
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
-        # return HttpResponse(json.dumps({'error': 'HDF5 file does not exists: {0}'.format(fpath)}))
-
-    with closing(h5py.File(fpath, 'r')) as hfile:
-        #import math
-        #zoomlevel = math.log(int(scale), 2)
-        hdfpath = '/' + str(int(scale)) + '/' + str(z) + '/data'
-        if not str(int(scale)) in hfile['/'].keys():
-            data=np.zeros( (height, width) )
-            pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-            response = HttpResponse(content_type="image/png")
-            pilImage.save(response, "PNG")
-            return response            
-            # return HttpResponse(json.dumps({'error': 'HDF5 file does not contain scale: {0}'.format(str(int(scale)))}))
-        image_data=hfile[hdfpath]
-        data=image_data[y:y+height,x:x+width]
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
-
-    return response
+    tile = get_server().get_tile(fpath, scale, z, x, y, width, height)
+    return HttpResponse(tile, content_type="image/png")
 
 def put_tile(request, project_id=None, stack_id=None):
     """ Store labels to HDF5 """
@@ -74,11 +209,8 @@ def put_tile(request, project_id=None, stack_id=None):
     fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}.hdf'.format( project_id, stack_id ) )
     #print >> sys.stderr, 'fpath', fpath
 
-    with closing(h5py.File(fpath, 'a')) as hfile:
-        hdfpath = '/labels/scale/' + str(int(scale)) + '/data'
-        #print >> sys.stderr, 'storage', x,y,z,height,width,hdfpath
-        #print >> sys.stderr, 'image', base64.decodestring(image)
-        image_from_canvas = np.asarray( Image.open( cStringIO.StringIO(base64.decodestring(image)) ) )
-        hfile[hdfpath][y:y+height,x:x+width,z] = image_from_canvas[:,:,0]
+    image_from_canvas = np.asarray( Image.open( cStringIO.StringIO(base64.decodestring(image)) ) )
+    get_server().put_labels(fpath, scale, z, x, y, width, height,
+                            image_from_canvas[:,:,0])
 
     return HttpResponse("Image pushed to HDF5.", content_type="plain/text")
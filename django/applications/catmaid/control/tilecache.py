@@ -0,0 +1,152 @@
+""" A cache for image tiles on the local disk, shared by all processes.
+
+The cropping tool and the treenode and connector exports request the same
+tiles over and over, because the regions of neighboring nodes overlap. Tiles
+are stored once per content: objects/<SHA-1 of content> holds the data and
+refs/<SHA-1 of URL> the SHA-1 of the content of a URL. Empty tiles, which are
+common at the borders of a stack, are therefore stored only once.
+
+Every hit updates the modification times of both files. Whenever a process
+has written a tenth of CROPPING_TILE_CACHE_SIZE bytes, it removes the least
+recently used objects until the cache takes up at most 90% of this size,
+together with all references that haven't been used since. Files are written
+to temporary files first and renamed, so concurrent readers see either the
+complete file or none.
+"""
+
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+
+from time import time
+
+from django.conf import settings
+
+
+_lock = threading.Lock()
+# The number of bytes this process wrote since the last eviction
+_written = [0]
+
+
+def enabled():
+    return settings.CROPPING_TILE_CACHE_SIZE > 0
+
+def _root():
+    return os.path.join(settings.MEDIA_ROOT,
+            settings.MEDIA_TILE_CACHE_SUBDIRECTORY)
+
+def _path(kind, digest):
+    return os.path.join(_root(), kind, digest[:2], digest)
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def get(url):
+    """ Return the cached content of the given URL or None if it isn't
+    cached. """
+    if not enabled():
+        return None
+    ref_path = _path('refs', _digest(url))
+    try:
+        with open(ref_path, 'rb') as f:
+            object_path = _path('objects', f.read())
+        with open(object_path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+    # Mark both files as recently used
+    now = time()
+    for path in (ref_path, object_path):
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+    return data
+
+
+def put(url, data):
+    """ Store the content of a URL. Errors are ignored, the cache is only an
+    optimization. """
+    if not enabled():
+        return
+    digest = _digest(data)
+    try:
+        object_path = _path('objects', digest)
+        if os.path.exists(object_path):
+            os.utime(object_path, None)
+        else:
+            _write(object_path, data)
+        _write(_path('refs', _digest(url)), digest)
+    except (IOError, OSError):
+        return
+
+    with _lock:
+        _written[0] += len(data)
+        evict_now = _written[0] > settings.CROPPING_TILE_CACHE_SIZE / 10
+        if evict_now:
+            _written[0] = 0
+    if evict_now:
+        evict()
+
+
+def _write(path, data):
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def _files(kind):
+    """ Return a list of (modification time, size, path) tuples of all
+    existing files of the given kind. """
+    files = []
+    for directory, _, names in os.walk(os.path.join(_root(), kind)):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    return files
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def evict():
+    """ If the cache is larger than CROPPING_TILE_CACHE_SIZE, remove the least
+    recently used objects until it takes up at most 90% of it. References that
+    haven't been used since the last removed object are removed, too. """
+    objects = _files('objects')
+    total = sum(f[1] for f in objects)
+    if total <= settings.CROPPING_TILE_CACHE_SIZE:
+        return
+    target = 0.9 * settings.CROPPING_TILE_CACHE_SIZE
+    cutoff = None
+    for mtime, size, path in sorted(objects):
+        if total <= target:
+            break
+        _remove(path)
+        total -= size
+        cutoff = mtime
+    for mtime, size, path in _files('refs'):
+        if mtime <= cutoff:
+            _remove(path)
@@ -3,6 +3,7 @@ import json
 from django.http import HttpResponse
 
 from catmaid.models import Class, ClassInstance, Relation, UserRole
+from catmaid.control import ontologycache
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_class_to_id_map, get_relation_to_id_map
 
@@ -120,6 +121,7 @@ def setup_tracing(project_id, user):
             project_id=project_id,
             defaults={'user': user,
                       'description': needed_relations[r]})
+    ontologycache.invalidate(project_id)
     # Add root node
     ClassInstance.objects.get_or_create(
         class_column=available_classes['root'],
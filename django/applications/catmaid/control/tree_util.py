@@ -3,9 +3,10 @@
 from operator import itemgetter
 from networkx import Graph, DiGraph
 from collections import defaultdict
-from math import sqrt
 from itertools import izip, islice
+from numpy import array, sqrt, sum as npsum
 from catmaid.models import Treenode
+from catmaid.control.arbor import Arbor
 
 def find_root(tree):
     """ Search and return the first node that has zero predecessors.
@@ -124,23 +125,11 @@ def partition(tree, root_node=None):
     """ Partition the tree as a list of sequences of node IDs,
     with branch nodes repeated as ends of all sequences except the longest
     one that finishes at the root.
-    Each sequence runs from an end node to either the root or a branch node. """
-    distances = edge_count_to_root(tree, root_node=root_node) # distance in number of edges from root
-    seen = set()
-    # Iterate end nodes sorted from highest to lowest distance to root
-    endNodeIDs = (nID for nID in tree.nodes() if 0 == len(tree.successors(nID)))
-    for nodeID in sorted(endNodeIDs, key=distances.get, reverse=True):
-        sequence = [nodeID]
-        parentID = next(tree.predecessors_iter(nodeID), None)
-        while parentID is not None:
-            sequence.append(parentID)
-            if parentID in seen:
-                break
-            seen.add(parentID)
-            parentID = next(tree.predecessors_iter(parentID), None)
-
-        if len(sequence) > 1:
-            yield sequence
+    Each sequence runs from an end node to either the root or a branch node.
+    The root_node argument is ignored, the root is found by the Arbor. """
+    arbor = Arbor.from_digraph(tree)
+    for sequence in arbor.partition():
+        yield arbor.node_ids[sequence].tolist()
 
 
 def spanning_tree(tree, preserve):
@@ -183,10 +172,28 @@ def spanning_tree(tree, preserve):
 
     return spanning
 
+def _edge_lengths(edges, locations):
+    a = array([locations[e[0]] for e in edges], dtype=float)
+    b = array([locations[e[1]] for e in edges], dtype=float)
+    delta = b - a
+    return sqrt((delta * delta).sum(axis=1))
+
 def cable_length(tree, locations):
     """ locations: a dictionary of nodeID vs iterable of node position (1d, 2d, 3d, ...)
     Returns the total cable length. """
-    return sum(sqrt(sum(pow(loc2 - loc1, 2) for loc1, loc2 in izip(locations[a], locations[b]))) for a,b in tree.edges_iter())
+    edges = tree.edges()
+    if not edges:
+        return 0
+    return float(npsum(_edge_lengths(edges, locations)))
+
+def set_edge_weights(tree, locations):
+    """ Set the 'weight' property of every edge to the distance between its
+    nodes. locations: a dictionary of nodeID vs node position. """
+    edges = tree.edges()
+    if not edges:
+        return
+    for (a, b), length in izip(edges, _edge_lengths(edges, locations).tolist()):
+        tree[a][b]['weight'] = length
 
 
 def lazy_load_trees(skeleton_ids, node_properties):
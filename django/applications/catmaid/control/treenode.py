@@ -9,6 +9,7 @@ from django.http import HttpResponse
 
 from catmaid.models import UserRole, Treenode, BrokenSlice, ClassInstance, \
         ClassInstanceClassInstance
+from catmaid.control import nodelistcache
 from catmaid.control.authentication import requires_user_role, \
         can_edit_class_instance_or_fail, can_edit_or_fail
 from catmaid.control.common import get_relation_to_id_map, \
@@ -94,6 +95,8 @@ def create_treenode(request, project_id=None):
         if parent_id:
             new_treenode.parent_id = parent_id
         new_treenode.save()
+        nodelistcache.invalidate_treenodes(connection.cursor(), project_id,
+                                           [new_treenode.id])
         return new_treenode
 
     def relate_neuron_to_skeleton(neuron, skeleton):
@@ -253,6 +256,7 @@ def _create_interpolated_treenode(request, params, project_id, skip_last):
         # Loop the creation of treenodes in z resolution steps until target
         # section is reached
         parent_id = params['parent_id']
+        new_treenode_ids = []
         atn_slice_index = ((parent_z - params['stack_translation_z']) / params['resz']) \
             .quantize(decimal.Decimal('1'), rounding=decimal.ROUND_FLOOR)
         for i in range(1, steps + (0 if skip_last else 1)):
@@ -273,6 +277,10 @@ def _create_interpolated_treenode(request, params, project_id, skip_last):
             new_treenode.save()
 
             parent_id = new_treenode.id
+            new_treenode_ids.append(parent_id)
+
+        nodelistcache.invalidate_treenodes(connection.cursor(), project_id,
+                                           new_treenode_ids)
 
         # parent_id contains the ID of the last added node
         return parent_id, parent_skeleton_id
@@ -293,8 +301,11 @@ def update_parent(request, project_id=None, treenode_id=None):
         raise Exception("Child node %s is in skeleton %s but parent node %s is in skeleton %s!", \
                         treenode_id, child.skeleton_id, parent_id, parent.skeleton_id)
 
+    cursor = connection.cursor()
+    nodelistcache.invalidate_treenodes(cursor, project_id, [treenode_id])
     child.parent_id = parent_id
     child.save()
+    nodelistcache.invalidate_treenodes(cursor, project_id, [treenode_id])
 
     return HttpResponse(json.dumps({'success': True}))
 
@@ -310,10 +321,16 @@ def update_radius(request, project_id=None, treenode_id=None):
 
     if 0 == option:
         # Update radius only for the treenode
+        nodelistcache.invalidate_treenodes(cursor, project_id, [treenode_id])
         Treenode.objects.filter(pk=treenode_id).update(editor=request.user,
                                                        radius=radius)
         return HttpResponse(json.dumps({'success': True}))
 
+    # All other options update a part of the skeleton
+    nodelistcache.invalidate_skeletons(cursor, project_id,
+            Treenode.objects.filter(pk=treenode_id).values_list('skeleton_id',
+                                                                flat=True))
+
     cursor.execute('''
     SELECT id, parent_id, radius
     FROM treenode
@@ -412,6 +429,11 @@ def delete_treenode(request, project_id=None):
     treenode = Treenode.objects.get(pk=treenode_id)
     parent_id = treenode.parent_id
 
+    # Invalidate the node list tiles of the treenode, its parent and children
+    # and of all linked connectors while they still exist.
+    nodelistcache.invalidate_treenodes(connection.cursor(), project_id,
+                                       [treenode_id])
+
     response_on_error = ''
     try:
         if not parent_id:
@@ -1,10 +1,13 @@
 import os.path
-import shutil
 import tarfile
 import json
 
+from cStringIO import StringIO
+from time import time
+
 from django.conf import settings
 from django.http import HttpResponse
+from django.db import connection
 from django.db.models import Count
 
 from catmaid.control.authentication import requires_user_role
@@ -13,7 +16,12 @@ from catmaid.control.cropping import CropJob, extract_substack, ImageRetrievalEr
 from catmaid.models import ClassInstanceClassInstance, TreenodeConnector, \
         Message, User, UserRole, Treenode
 
+from pgmagick import Blob
+
 from celery.task import task
+# Unlike multiprocessing, billiard allows daemonic processes like Celery's
+# prefork workers to start a pool of their own.
+from billiard import Pool
 
 
 # The path were archive files get stored in
@@ -76,57 +84,50 @@ class TreenodeExporter:
         # Store meta data for each node
         self.metadata = {}
 
+        # The message that informs the user about the progress
+        self.message = None
+
     def create_message(self, title, message, url):
-        msg = Message()
+        """ Creates a message for the user. Every further call updates the
+        same message, so that progress reports are replaced by the result.
+        """
+        msg = self.message or Message()
         msg.user = User.objects.get(pk=int(self.job.user.id))
         msg.read = False
         msg.title = title
         msg.text = message
         msg.action = url
         msg.save()
+        self.message = msg
 
     def create_basic_output_path(self):
-        """ Will create a random output folder name prefixed with the entity
-        name as well as the actual directory.
+        """ Will create a random output name prefixed with the entity name. It
+        is used as name of the archive and of the folder in it.
         """
-        # Find non-existing random folder name
+        # Find non-existing random archive name
         while True:
             folder_name = self.entity_name + '_archive_' + id_generator()
             output_path = os.path.join(treenode_output_path, folder_name)
-            if not os.path.exists(output_path):
+            if not os.path.exists(output_path + '.tar.gz'):
                 break
-        # Create folder and store path as field
-        os.makedirs(output_path)
         self.output_path = output_path
 
     def create_path(self, treenode):
-        """ Based on the output path, this function will create a folder
-        structure for a particular skeleton. Things that are supposedly
-        needed multiple times, will be cached. This function will also make
-        sure the path exists and is ready to be written to.
+        """ Returns the path of the folder for a particular skeleton, relative
+        to the archive. Things that are supposedly needed multiple times, will
+        be cached.
         """
         # Get (and create if needed) cache entry for string of neuron id
         treenode_path = self.skid_to_neuron_folder.get(treenode.skeleton_id)
-        if treenode_path:
-            return treenode_path
-        else:
+        if not treenode_path:
             neuron_cici = ClassInstanceClassInstance.objects.get(
                     relation_id=self.relation_map['model_of'],
                     project_id=self.job.project_id,
                     class_instance_a=treenode.skeleton.id)
-            treenode_path = os.path.join(self.output_path,
+            treenode_path = os.path.join(os.path.basename(self.output_path),
                     str(neuron_cici.class_instance_b_id))
             self.skid_to_neuron_folder[treenode.skeleton.id] = treenode_path
-
-            # Create path output_path/neuron_id
-            try:
-                os.makedirs(treenode_path)
-                return treenode_path
-            except OSError as e:
-                # Everything is fine if the path exists and is writable
-                if not os.path.exists(treenode_path) or not \
-                        os.access(treenode_path, os.W_OK):
-                    raise e
+        return treenode_path
 
     def get_entities_to_export(self):
         """ Returns a list of treenode links. If the job asks only for a
@@ -145,37 +146,44 @@ class TreenodeExporter:
             return Treenode.objects.filter(project_id=self.job.project_id,
                     skeleton_id__in=self.job.skeleton_ids)
 
-    def export_single_node(self, treenode):
-        """ Exports a treenode and expects the output path to be existing
-        and writable.
+    def get_location(self, treenode):
+        return treenode.location_x, treenode.location_y, treenode.location_z
+
+    def create_crop_job(self, node):
+        """ Creates the job to crop the region around a node.
         """
-        # Calculate bounding box for current connector
-        x_min = treenode.location_x - self.job.x_radius
-        x_max = treenode.location_x + self.job.x_radius
-        y_min = treenode.location_y - self.job.y_radius
-        y_max = treenode.location_y + self.job.y_radius
-        z_min = treenode.location_z - self.job.z_radius
-        z_max = treenode.location_z + self.job.z_radius
+        # Calculate bounding box for current node
+        x, y, z = self.get_location(node)
+        x_min = x - self.job.x_radius
+        x_max = x + self.job.x_radius
+        y_min = y - self.job.y_radius
+        y_max = y + self.job.y_radius
+        z_min = z - self.job.z_radius
+        z_max = z + self.job.z_radius
         rotation_cw = 0
         zoom_level = 0
 
         # Create a single file for each section (instead of a mulipage TIFF)
-        crop_self = CropJob(self.job.user, self.job.project_id,
+        return CropJob(self.job.user, self.job.project_id,
                 self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
                 rotation_cw, zoom_level, single_channel=True)
-        cropped_stack = extract_substack(crop_self)
-        # Save each file in output path
-        output_path = self.create_path(treenode)
-        for i, img in enumerate(cropped_stack):
-            # Save image in output path, named <treenode-id>.tiff
-            image_name = "%s.tiff" % treenode.id
-            treenode_image_path = os.path.join(output_path, image_name)
-            img.write(treenode_image_path)
+
+    def get_image_paths(self, treenode, crop_job, n_images):
+        """ Returns the path in the archive for each image of a treenode, or
+        None for images that aren't stored. Every image is named
+        <treenode-id>.tiff, so only the last one is kept.
+        """
+        if not n_images:
+            return []
+        image_name = "%s.tiff" % treenode.id
+        path = os.path.join(self.create_path(treenode), image_name)
+        return [None] * (n_images - 1) + [path]
 
     def post_process(self, nodes):
         """ Create a meta data file for all the nodes passed (usually all of the
         ones queries before). This file is a table with the following columns:
         <treenode id> <parent id> <#presynaptic sites> <#postsynaptic sites> <x> <y> <z>
+        Returns a list of path and content tuples of the files to add.
         """
         # Get pre- and post synaptic sites
         presynaptic_to_rel = self.relation_map['presynaptic_to']
@@ -199,11 +207,13 @@ class TreenodeExporter:
         # Create log info for each treenode. Each line will contain treenode-id,
         # parent-id, nr. presynaptic sites, nr. postsynaptic sites, x, y, z
         skid_to_metadata = {}
+        skid_to_path = {}
         for n in nodes:
             ls = skid_to_metadata.get(n.skeleton.id)
             if not ls:
                 ls = []
                 skid_to_metadata[n.skeleton.id] = ls
+                skid_to_path[n.skeleton.id] = self.create_path(n)
             p = n.parent.id if n.parent else 'null'
             n_pre = presynaptic_map.get(n.id, 0)
             n_post = postsynaptic_map.get(n.id, 0)
@@ -213,16 +223,19 @@ class TreenodeExporter:
             line = ', '.join([str(e) for e in (n.id, p, n_pre, n_post, x, y, z)])
             ls.append(line)
 
-        # Save metdata for each skeleton to files
+        # Create a metdata file for each skeleton
+        files = []
         for skid, metadata in skid_to_metadata.items():
-            path = self.skid_to_neuron_folder.get(skid)
-            with open(os.path.join(path, 'metadata.csv'), 'w') as f:
-                f.write("This CSV file contains meta data for CATMAID skeleton " \
-                        "%s. The columns represent the following data:\n" % skid)
-                f.write("treenode-id, parent-id, # presynaptic sites, " \
-                        "# postsynaptic sites, x, y, z\n")
-                for line in metadata:
-                    f.write("%s\n" % line)
+            path = skid_to_path[skid]
+            f = StringIO()
+            f.write("This CSV file contains meta data for CATMAID skeleton " \
+                    "%s. The columns represent the following data:\n" % skid)
+            f.write("treenode-id, parent-id, # presynaptic sites, " \
+                    "# postsynaptic sites, x, y, z\n")
+            for line in metadata:
+                f.write("%s\n" % line)
+            files.append((os.path.join(path, 'metadata.csv'), f.getvalue()))
+        return files
 
 class ConnectorExporter(TreenodeExporter):
     """ Most of the infrastructure can be used for both treenodes and
@@ -234,10 +247,9 @@ class ConnectorExporter(TreenodeExporter):
         self.entity_name = "connector"
 
     def create_path(self, connector_link):
-        """ Based on the output path, this function will create a folder
-        structure for a particular connector. Things that are supposedly
-        needed multiple times, will be cached. This function will also make
-        sure the path exists and is ready to be written to.
+        """ Returns the path of the folder for a particular connector,
+        relative to the archive. Things that are supposedly needed multiple
+        times, will be cached.
         """
         # Get (and create if needed) cache entry for string of neuron id
         if connector_link.skeleton_id not in self.skid_to_neuron_folder:
@@ -260,18 +272,9 @@ class ConnectorExporter(TreenodeExporter):
             self.relid_to_rel_folder[connector_link.relation_id] = rel_folder
         relation_folder =  self.relid_to_rel_folder[connector_link.relation_id]
 
-        # Create path output_path/neuron_id/relation_name/connector_id
-        connector_path = os.path.join(self.output_path, neuron_folder,
+        # Path output_path/neuron_id/relation_name/connector_id
+        return os.path.join(os.path.basename(self.output_path), neuron_folder,
                 relation_folder, str(connector_link.connector.id))
-        try:
-            os.makedirs(connector_path)
-        except OSError as e:
-            # Everything is fine if the path exists and is writable
-            if not os.path.exists(connector_path) or not \
-                    os.access(connector_path, os.W_OK):
-                raise e
-
-        return connector_path
 
     def get_entities_to_export(self):
         """ Returns a list of connector links. If the job asks only for a
@@ -309,49 +312,69 @@ class ConnectorExporter(TreenodeExporter):
 
         return connector_links
 
-    def export_single_node(self, connector_link):
-        """ Exports a single connector and expects the output path to be existing
-        and writable.
-        """
+    def get_location(self, connector_link):
         connector = connector_link.connector
+        return connector.location_x, connector.location_y, connector.location_z
 
-        # Calculate bounding box for current connector
-        x_min = connector.location_x - self.job.x_radius
-        x_max = connector.location_x + self.job.x_radius
-        y_min = connector.location_y - self.job.y_radius
-        y_max = connector.location_y + self.job.y_radius
-        z_min = connector.location_z - self.job.z_radius
-        z_max = connector.location_z + self.job.z_radius
-        rotation_cw = 0
-        zoom_level = 0
-
-        # Create a single file for each section (instead of a mulipage TIFF)
-        crop_self = CropJob(self.job.user, self.job.project_id,
-                self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
-                rotation_cw, zoom_level, single_channel=True)
-        cropped_stack = extract_substack(crop_self)
-        # Save each file in output path
+    def get_image_paths(self, connector_link, crop_job, n_images):
+        """ Returns the path in the archive for each image of a connector.
+        Images are named after the image center's coordinates, rounded to
+        full integers.
+        """
+        connector = connector_link.connector
         connector_path = self.create_path(connector_link)
-        for i, img in enumerate(cropped_stack):
-            # Save image in output path, named after the image center's coordinates,
-            # rounded to full integers.
-            x = int(connector.location_x + 0.5)
-            y = int(connector.location_y + 0.5)
-            z = int(z_min + i * crop_self.stacks[0].resolution_z  + 0.5)
+        x = int(connector.location_x + 0.5)
+        y = int(connector.location_y + 0.5)
+        paths = []
+        for i in range(n_images):
+            z = int(crop_job.z_min + i * crop_job.ref_stack.resolution.z + 0.5)
             image_name = "%s_%s_%s.tiff" % (x, y, z)
-            connector_image_path = os.path.join(connector_path, image_name)
-            img.write(connector_image_path)
+            paths.append(os.path.join(connector_path, image_name))
+        return paths
 
     def post_process(self, nodes):
-        pass
+        return []
+
+def _crop_node(task):
+    """ Crops the region of a single node and returns its index, a list of
+    TIFF images and, if an image couldn't be retrieved, the error and URL.
+    Runs in the processes of the export pool.
+    """
+    index, crop_job = task
+    try:
+        cropped_stack = extract_substack(crop_job)
+    except ImageRetrievalError as e:
+        return index, [], (e.error, e.path)
+    images = []
+    for img in cropped_stack:
+        img.magick('TIFF')
+        blob = Blob()
+        img.write(blob)
+        images.append(blob.data)
+    return index, images, None
+
+def _add_file(tar, path, content):
+    info = tarfile.TarInfo(path)
+    info.size = len(content)
+    info.mtime = time()
+    tar.addfile(info, StringIO(content))
+
+def _create_pool():
+    """ Creates a pool of NODE_EXPORT_WORKERS processes, also within a
+    Celery worker.
+    """
+    # Forked processes must not share the database connection
+    connection.close()
+    return Pool(settings.NODE_EXPORT_WORKERS)
 
 @task()
 def process_export_job(exporter):
     """ This method does the actual archive creation. It controls the data
     extraction and the creation of all sub-stacks. It can be executed as Celery
-    task.
+    task. The regions of all nodes are cropped in parallel by a pool of
+    workers and their images are written to the archive as they arrive.
     """
-    nodes = exporter.get_entities_to_export()
+    nodes = list(exporter.get_entities_to_export())
 
     # Abort if there are no nodes to process
     if not nodes:
@@ -360,47 +383,67 @@ def process_export_job(exporter):
         exporter.create_message("Nothing to export", msg, '#')
         return msg
 
-    # Create a working directoy to create subfolders and images in
+    # Find a name for the archive and the folder in it
     exporter.create_basic_output_path()
+    tarfile_path = exporter.output_path.rstrip(os.sep) + '.tar.gz'
+
+    crop_jobs = [exporter.create_crop_job(node) for node in nodes]
+
+    title = "Export of %ss running" % exporter.entity_name
+    exporter.create_message(title, "0 of %s %ss have been exported." % \
+            (len(nodes), exporter.entity_name), '#')
 
     # Store error codes and URLs for unreachable images for each failed link
     error_urls = {}
+    pool = _create_pool()
     try:
-        # Export every node
-        for node in nodes:
-            try:
-                exporter.export_single_node(node)
-            except ImageRetrievalError as e:
-                error_urls[node] = (e.error, e.path)
-        # Create error log, if needed
-        if error_urls:
-            error_path = os.path.join(exporter.output_path, "error_log.txt")
-            with open(error_path, 'w') as f:
-                f.write("The following %ss couldn't be exported. At " \
-                        "least one image URL of each of them couldn't be " \
-                        "reached.\n" % exporter.entity_name)
-                f.write("%s-id http-error-code url\n" % exporter.entity_name)
+        tar = tarfile.open(tarfile_path, 'w:gz')
+        try:
+            last_report = time()
+            results = pool.imap_unordered(_crop_node, enumerate(crop_jobs))
+            for n_done, (index, images, error) in enumerate(results, 1):
+                if error:
+                    error_urls[nodes[index]] = error
+                paths = exporter.get_image_paths(nodes[index],
+                        crop_jobs[index], len(images))
+                for path, image in zip(paths, images):
+                    if path:
+                        _add_file(tar, path, image)
+                # Report progress
+                if time() - last_report > settings.NODE_EXPORT_PROGRESS_INTERVAL:
+                    exporter.create_message(title, "%s of %s %ss have been " \
+                            "exported." % (n_done, len(nodes),
+                            exporter.entity_name), '#')
+                    last_report = time()
+
+            # Create error log, if needed
+            folder = os.path.basename(exporter.output_path)
+            if error_urls:
+                lines = ["The following %ss couldn't be exported. At least " \
+                        "one image URL of each of them couldn't be reached.\n" \
+                        % exporter.entity_name,
+                        "%s-id http-error-code url\n" % exporter.entity_name]
                 for node, eu in error_urls.items():
-                    f.write("%s %s %s\n" % (node.id, eu[0], eu[1]))
-    except IOError as e:
+                    lines.append("%s %s %s\n" % (node.id, eu[0], eu[1]))
+                _add_file(tar, os.path.join(folder, "error_log.txt"),
+                        ''.join(lines))
+
+            # Give an exporter the chance to add some more files
+            for path, content in exporter.post_process(nodes):
+                _add_file(tar, path, content)
+        finally:
+            tar.close()
+    except Exception as e:
+        if os.path.exists(tarfile_path):
+            os.remove(tarfile_path)
         msg = "The export of the data set has been aborted, because an " \
                 "error occured: %s" % str(e)
         exporter.create_message("The %s export failed" % exporter.entity_name,
                 msg, '#')
         return "An error occured during the %s export: %s" % \
                 (exporter.entity_name, str(e))
-
-    # Give an exporter the chance to do some postprocessing
-    exporter.post_process(nodes)
-
-    # Make working directory an archive
-    tarfile_path = exporter.output_path.rstrip(os.sep) + '.tar.gz'
-    tar = tarfile.open(tarfile_path, 'w:gz')
-    tar.add(exporter.output_path, arcname=os.path.basename(exporter.output_path))
-    tar.close()
-
-    # Delete working directory
-    shutil.rmtree(exporter.output_path)
+    finally:
+        pool.terminate()
 
     # Create message
     tarfile_name = os.path.basename(tarfile_path)
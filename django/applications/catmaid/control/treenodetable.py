@@ -2,6 +2,7 @@ import json
 import math
 from string import upper
 
+from django.db import connection
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.db.models import Count
@@ -9,6 +10,7 @@ from django.db.models import Count
 from catmaid.fields import Double3D
 from catmaid.models import ProjectStack, Stack, Treenode, \
         TreenodeClassInstance, User, UserRole
+from catmaid.control import nodelistcache
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map
 from catmaid.control.review import get_treenodes_to_reviews
@@ -45,6 +47,8 @@ def update_treenode_table(request, project_id=None):
                                      id=treenode_id)
         response_on_error = 'Could not update %s for treenode with ID %s.' % \
             (property_name, treenode_id)
+        nodelistcache.invalidate_treenodes(connection.cursor(), project_id,
+                                           [treenode_id])
         setattr(treenode, property_name, property_value)
         treenode.user = request.user
         treenode.save()
@@ -1,10 +1,14 @@
 import numpy as np
 
+from cStringIO import StringIO
 from datetime import timedelta, datetime
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 from django.http import HttpResponse
 
-from catmaid.models import Connector, Treenode, Review
+from catmaid.models import Treenode
 from catmaid.control.user_evaluation import _parse_date
 
 
@@ -19,30 +23,19 @@ from pylab import figure
 from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 class Bout(object):
-    """ Represents one bout, based on a list of events. The first event ist the
-    start date/time, the last event the end.
+    """ Represents one bout, based on a number of events. The first event is
+    the start date/time, the last event the end.
     """
-    def __init__(self, start, end=None):
-        self.events = [start]
-        if end:
-            self.events.append(end)
+    def __init__(self, start, end=None, nrEvents=None):
+        self.start = start
+        self.end = end or start
+        self.nrEvents = nrEvents or (2 if end else 1)
 
     def addEvent(self, e):
-        """ Increments the event counter.
+        """ Increments the event counter and extends the bout to the event.
         """
-        self.events.append(e)
-
-    @property
-    def nrEvents(self):
-        return len(self.events)
-
-    @property
-    def start(self):
-        return self.events[0]
-
-    @property
-    def end(self):
-        return self.events[-1]
+        self.end = e
+        self.nrEvents += 1
 
     def __str__(self):
         return "Bout with %s events [%s, %s]" % \
@@ -50,49 +43,59 @@ class Bout(object):
 
 def plot_useranalytics(request):
     """ Creates a PNG image containing different plots for analzing the
-    performance of individual users over time.
+    performance of individual users over time. Reports are cached per user
+    and requested date range for USER_ANALYTICS_CACHE_TIMEOUT seconds.
     """
     userid = request.GET.get('userid', -1)
     start_date = request.GET.get('start')
     end_date = request.GET.get('end')
 
-    print userid, start_date, end_date
-
     if request.user.is_superuser:
-        end = _parse_date(end_date) if end_date else datetime.now()
-        start = _parse_date(start_date) if start_date else end - timedelta(end.isoweekday() + 7)
-        f = generateReport( userid, 10, start, end )
+        key = 'catmaid.useranalytics.%s.%s.%s' % (userid, start_date, end_date)
+        png = cache.get(key)
+        if png is None:
+            end = _parse_date(end_date) if end_date else datetime.now()
+            start = _parse_date(start_date) if start_date else end - timedelta(end.isoweekday() + 7)
+            png = render_png(generateReport( userid, 10, start, end ))
+            cache.set(key, png, settings.USER_ANALYTICS_CACHE_TIMEOUT)
     else:
-        f = figure(1, figsize=(6,6))
+        png = render_png(figure(1, figsize=(6,6)))
 
-    canvas = FigureCanvasAgg( f )
-    response = HttpResponse(content_type='image/png')
-    canvas.print_png(response)
-    return response
-
-def eventTimes(user_id, start_date, end_date):
-    """ Returns a tuple containing a list of tree node edition times, connector
-    edition times and tree node review times within the date range specified
-    where the editor/reviewer is the given user.
+    return HttpResponse(png, content_type='image/png')
+
+def render_png(f):
+    """ Returns the figure as PNG image and frees it.
     """
-    dr = (start_date, end_date)
-    tns = Treenode.objects.filter(
-        editor_id = user_id,
-        edition_time__range=dr).values_list('edition_time', flat=True)
-    cns = Connector.objects.filter(
-        editor_id = user_id,
-        edition_time__range=dr).values_list('edition_time', flat=True)
-    rns = Review.objects.filter(
-        reviewer_id = user_id,
-        review_time__range=dr).values_list('review_time', flat=True)
-
-    return list(tns), list(cns), list(rns)
-
-def eventsPerInterval(times, start_date, end_date, interval='day'):
-    """ Creates a histogram of how many events fall into all intervals between
-    <start_data> and <end_date>. The interval type can be day, hour and
-    halfhour. Returned is a tuple containing two elemens: the histogram and a
-    time axis, labeling every bin.
+    canvas = FigureCanvasAgg( f )
+    output = StringIO()
+    canvas.print_png(output)
+    plt.close(f)
+    return output.getvalue()
+
+# The events of a user: nodes and connectors edited and nodes reviewed
+EVENTS_SQL = '''
+    SELECT edition_time AS event_time, 1 AS annotations, 0 AS reviews
+    FROM treenode
+    WHERE editor_id = %(user_id)s
+      AND edition_time BETWEEN %(start)s AND %(end)s
+    UNION ALL
+    SELECT edition_time, 1, 0
+    FROM connector
+    WHERE editor_id = %(user_id)s
+      AND edition_time BETWEEN %(start)s AND %(end)s
+    UNION ALL
+    SELECT review_time, 0, 1
+    FROM review
+    WHERE reviewer_id = %(user_id)s
+      AND review_time BETWEEN %(start)s AND %(end)s
+'''
+
+def eventsPerInterval(user_id, start_date, end_date, interval='day'):
+    """ Creates histograms of how many annotation and review events of a user
+    fall into all intervals between <start_data> and <end_date>. The interval
+    type can be day, hour and halfhour. Events are counted by the database.
+    Returned is a tuple containing three elemens: the annotation and review
+    histograms and a time axis, labeling every bin.
     """
     if interval=='day':
         intervalsPerDay = 1
@@ -111,48 +114,50 @@ def eventsPerInterval(times, start_date, end_date, interval='day'):
     dt = timedelta(0, secondsPerInterval)
     timeaxis = [start_date + n*dt for n in xrange(intervalsPerDay * daycount)]
     # Calculate bins
-    timebins = np.zeros(intervalsPerDay * daycount)
-    intervalsPerSecond = 1.0 / secondsPerInterval
-    for t in times:
-        i = int((t - start_date).total_seconds() * intervalsPerSecond)
-        timebins[i] += 1
-    
-    return timebins, timeaxis
-
-def activeTimes( alltimes, gapThresh ):
-    """ Goes through the sorted array of time differences between all events
-    stored in <alltimes>. If two events are closer together than <gapThresh>
-    minutes, they are counted as events within one bout. A tuple containing a
-    list of bout start dates as well as a list with total numbers of events for
-    each bout is returned.
+    annotationbins = np.zeros(intervalsPerDay * daycount)
+    reviewbins = np.zeros(intervalsPerDay * daycount)
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT floor(extract(epoch FROM e.event_time - %%(start)s) / %(seconds)s)::int,
+               sum(e.annotations), sum(e.reviews)
+        FROM (%(events)s) e
+        GROUP BY 1
+    ''' % {'seconds': secondsPerInterval, 'events': EVENTS_SQL},
+        {'user_id': int(user_id), 'start': start_date, 'end': end_date})
+    for i, annotations, reviews in cursor.fetchall():
+        if i < len(timeaxis):
+            annotationbins[i] = annotations
+            reviewbins[i] = reviews
+
+    return annotationbins, reviewbins, timeaxis
+
+def activeTimes(user_id, start_date, end_date, gapThresh):
+    """ Finds the bouts of activity of a user between <start_date> and
+    <end_date>. If two consecutive events are closer together than
+    <gapThresh> minutes, they are counted as events within one bout. Bouts
+    are detected by the database, a list of them is returned in order.
     """
-    # Sort all events and create a list of (time) differences between them
-    alltimes.sort()
-    dts = np.diff(alltimes)
-    # Threshold between to events to be counted as separate bouts (seconds)
-    threshold = 60 * gapThresh
-    # Indicates whether we are currently in a bout and since we haven't even
-    # looked at the first event, we are initially not.
-    bout = None
-    # Go through all events
-    for i, e in enumerate(alltimes):
-        if i > 0 and dts[i-1].total_seconds() < threshold:
-            # Increment current bout's event counter and continue with the
-            # next element as long as the time difference to the next
-            # element is below our threshold.
-            bout.addEvent(e)
-            continue
-        else:
-            # Return current bout (not available in first iteration) and create
-            # a new one.
-            if bout:
-                yield bout
-            bout = Bout(e)
-
-    # Return last bout, if it hasn't been returned, yet
-    if bout:
-        yield bout
-    
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT min(event_time), max(event_time), count(*)
+        FROM (
+            SELECT event_time, sum(new_bout) OVER (ORDER BY event_time) AS bout
+            FROM (
+                SELECT event_time,
+                       CASE WHEN event_time - lag(event_time)
+                                 OVER (ORDER BY event_time)
+                                 < %%(gap)s * interval '1 minute'
+                            THEN 0 ELSE 1 END AS new_bout
+                FROM (%(events)s) e
+            ) gaps
+        ) bouts
+        GROUP BY bout
+        ORDER BY bout
+    ''' % {'events': EVENTS_SQL},
+        {'user_id': int(user_id), 'start': start_date, 'end': end_date,
+         'gap': gapThresh})
+    return [Bout(start, end, n) for start, end, n in cursor.fetchall()]
+
 def activeTimesPerDay(active_bouts):
     """ Creates a tuple containing the active time in hours for every day
     between the first event of the first bout and the last event of the last
@@ -284,20 +289,17 @@ def generateErrorImage(msg):
     return fig
 
 def generateReport( user_id, activeTimeThresh, start_date, end_date ):
-    """ nts: node times
-        cts: connector times
-        rts: review times """
-    nts, cts, rts = eventTimes( user_id, start_date, end_date )
-
+    """ Plots the events and active bouts of a user between <start_date>
+    and <end_date>. """
     # If no nodes have been found, return an image with a descriptive text.
-    if len(nts) == 0:
+    if not Treenode.objects.filter(editor_id=user_id,
+            edition_time__range=(start_date, end_date)).exists():
         return generateErrorImage("No tree nodes were edited during the " +
                 "defined period if time.")
-    
-    annotationEvents, ae_timeaxis = eventsPerInterval( nts + cts, start_date, end_date )
-    reviewEvents, re_timeaxis = eventsPerInterval( rts, start_date, end_date )
 
-    activeBouts = list(activeTimes( nts+cts+rts, activeTimeThresh ))
+    annotationEvents, reviewEvents, timeaxis = eventsPerInterval( user_id, start_date, end_date )
+
+    activeBouts = activeTimes( user_id, start_date, end_date, activeTimeThresh )
     netActiveTime, at_timeaxis = activeTimesPerDay( activeBouts )
 
     dayformat = DateFormatter('%b %d')
@@ -306,8 +308,8 @@ def generateReport( user_id, activeTimeThresh, start_date, end_date ):
 
     # Top left plot: created and edited nodes per day
     ax1 = plt.subplot2grid((2,2), (0,0))
-    an = ax1.bar( ae_timeaxis, annotationEvents, color='#0000AA')
-    rv = ax1.bar( re_timeaxis, reviewEvents, bottom=annotationEvents, color='#AA0000')
+    an = ax1.bar( timeaxis, annotationEvents, color='#0000AA')
+    rv = ax1.bar( timeaxis, reviewEvents, bottom=annotationEvents, color='#AA0000')
     ax1.set_xlim((start_date,end_date))
     
     ax1.legend( (an, rv), ('Annotated', 'Reviewed'), loc=2,frameon=False )
@@ -2,57 +2,43 @@ import json
 import networkx as nx
 from networkx.readwrite import json_graph
 
+from django.db import connection
 from django.http import HttpResponse
 from django.db.models import Count
 
-from catmaid.models import Treenode, TreenodeConnector, UserRole
+from catmaid.models import Treenode, UserRole
 from catmaid.control.authentication import requires_user_role
 
 
 def get_wiring_diagram(project_id=None, lower_treenode_number_limit=0):
 
-    # result dictionary: {connectorid: presyn_skeletonid}
-    tmp={}
+    # result dictionary: {presyn_skeletonid: {postsyn_skeletonid: count}}
     result={}
-    # get the presynaptic connections
-    qs = TreenodeConnector.objects.filter(
-        project=project_id,
-        relation__relation_name = 'presynaptic_to'
-    )
-    for e in qs:
-        if not e.connector_id in tmp:
-            tmp[e.connector_id]=e.skeleton_id
-            result[e.skeleton_id]={}
-        else:
-            # connector with multiple presynaptic connections
-            pass
 
     skeletons={}
     qs = Treenode.objects.filter(project=project_id).values('skeleton').annotate(Count('skeleton'))
     for e in qs:
         skeletons[ e['skeleton'] ]=e['skeleton__count']
 
-    # get the postsynaptic connections
-    qs = TreenodeConnector.objects.filter(
-        project=project_id,
-        relation__relation_name = 'postsynaptic_to'
-    )
-    for e in qs:
-        if e.connector_id in tmp:
-
-            # limit the skeletons to include
-            if skeletons[ tmp[e.connector_id] ] < lower_treenode_number_limit or\
-               skeletons[ e.skeleton_id ] < lower_treenode_number_limit:
-                continue
-
-            # an existing connector, so we add a connection
-            if e.skeleton_id in result[tmp[e.connector_id]]:
-                result[tmp[e.connector_id]][e.skeleton_id] += 1
-            else:
-                result[tmp[e.connector_id]][e.skeleton_id] = 1
-        else:
-            # connector with only postsynaptic connections
-            pass
+    # get the number of synapses between each pair of skeletons
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT sc.skeleton_a, sc.skeleton_b, sc.count
+    FROM skeleton_connectivity sc,
+         relation r1,
+         relation r2
+    WHERE sc.project_id = %s
+      AND sc.relation_a = r1.id
+      AND r1.relation_name = 'presynaptic_to'
+      AND sc.relation_b = r2.id
+      AND r2.relation_name = 'postsynaptic_to'
+    ''', (project_id,))
+    for pre, post, count in cursor.fetchall():
+        # limit the skeletons to include
+        if skeletons[ pre ] < lower_treenode_number_limit or\
+           skeletons[ post ] < lower_treenode_number_limit:
+            continue
+        result.setdefault(pre, {})[post] = count
 
     nodes_tmp={}
     edges=[]
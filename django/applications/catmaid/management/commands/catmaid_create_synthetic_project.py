@@ -0,0 +1,260 @@
+import csv
+import math
+import random
+import tempfile
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection, transaction
+
+from catmaid.control.bulkimport import BulkImporter, TABLES
+from catmaid.control.tracing import setup_tracing
+from catmaid.fields import Double3D, Integer3D
+from catmaid.models import Project, ProjectStack, Stack, User
+
+
+# Classes and relations of the generated data, they are mapped to those of
+# the project by name.
+CLASSES = ('neuron', 'skeleton', 'annotation', 'label')
+RELATIONS = ('model_of', 'presynaptic_to', 'postsynaptic_to',
+             'annotated_with', 'labeled_as')
+TAGS = ('ends', 'uncertain end', 'uncertain continuation', 'soma',
+        'not a branch', 'microtubules end')
+
+
+class Generator(object):
+    """ Writes a synthetic tracing data set into temporary CSV files in the
+    format of BulkImporter. Every neuron is a single arbor that grows from a
+    random point in the volume: each node continues the current branch or,
+    with the branch probability, starts a new branch at a random earlier node
+    of the arbor. Nodes are tagged, reviewed and become presynaptic sites
+    with the given probabilities. Postsynaptic partners are picked among
+    nodes of earlier neurons close to a synapse, of which a bounded sample
+    is kept in a grid. All random choices depend only on the seed and only
+    the nodes of the current arbor are kept in memory.
+    """
+
+    def __init__(self, options, user_id):
+        self.options = options
+        self.user_id = user_id
+        self.random = random.Random(options['seed'])
+        self.last_id = 0
+
+        self.files = {}
+        self.writers = {}
+        for table, columns in TABLES.iteritems():
+            self.files[table] = tempfile.TemporaryFile()
+            self.writers[table] = csv.writer(self.files[table])
+            self.writers[table].writerow(columns)
+
+        resolution = options['resolution']
+        self.size = (options['width'] * resolution[0],
+                     options['height'] * resolution[1],
+                     (options['depth'] - 1) * resolution[2])
+        self.section = resolution[2]
+        self.step = options['step']
+        self.cell_size = options['cell_size']
+        # Maps grid cells to lists of (treenode ID, skeleton ID) tuples
+        self.cells = {}
+
+        self.classes = {}
+        for name in CLASSES:
+            self.classes[name] = self.write('class', name, '')
+        self.relations = {}
+        for name in RELATIONS:
+            self.relations[name] = self.write('relation', name, '', '', 'f')
+        self.annotations = [self.write('class_instance',
+                                       self.classes['annotation'],
+                                       'Synthetic annotation %s' % (i + 1))
+                            for i in range(options['annotations'])]
+        self.labels = [self.write('class_instance', self.classes['label'], t)
+                       for t in TAGS]
+
+    def write(self, table, *values):
+        """ Write a row of a table and return its new ID. The user and time
+        columns, which follow the ID in all tables but reviews, are filled
+        in. """
+        self.last_id += 1
+        if table == 'review':
+            row = (self.last_id,) + values
+        else:
+            row = (self.last_id, self.user_id, '', '') + values
+        self.writers[table].writerow(row)
+        return self.last_id
+
+    def cell(self, x, y, z):
+        return (int(x // self.cell_size), int(y // self.cell_size),
+                int(z // self.cell_size))
+
+    def clamp(self, value, dimension):
+        return min(max(value, 0), self.size[dimension])
+
+    def generate(self):
+        for i in range(self.options['neurons']):
+            self.neuron(i)
+        for f in self.files.itervalues():
+            f.seek(0)
+
+    def neuron(self, index):
+        o = self.options
+        r = self.random
+        neuron_id = self.write('class_instance', self.classes['neuron'],
+                               'Neuron %s' % (index + 1))
+        skeleton_id = self.write('class_instance', self.classes['skeleton'],
+                                 'Skeleton %s' % (index + 1))
+        self.write('class_instance_class_instance', self.relations['model_of'],
+                   skeleton_id, neuron_id)
+        if self.annotations:
+            for a in r.sample(self.annotations,
+                              r.randint(1, min(3, len(self.annotations)))):
+                self.write('class_instance_class_instance',
+                           self.relations['annotated_with'], neuron_id, a)
+
+        nodes = []
+        for i in range(o['nodes']):
+            if not nodes:
+                parent_id = ''
+                x = r.uniform(0, self.size[0])
+                y = r.uniform(0, self.size[1])
+                z = r.randint(0, o['depth'] - 1) * self.section
+            else:
+                if r.random() < o['branch_probability']:
+                    parent = nodes[r.randrange(len(nodes))]
+                else:
+                    parent = nodes[-1]
+                parent_id = parent[0]
+                angle = r.uniform(0, 2 * math.pi)
+                distance = r.uniform(0.5, 1.5) * self.step
+                x = self.clamp(parent[1] + math.cos(angle) * distance, 0)
+                y = self.clamp(parent[2] + math.sin(angle) * distance, 1)
+                z = self.clamp(parent[3] + r.choice((-1, 0, 1)) * self.section, 2)
+            node_id = self.write('treenode', self.user_id, x, y, z, parent_id,
+                                 -1, 5, skeleton_id)
+            nodes.append((node_id, x, y, z))
+
+            if r.random() < o['tag_probability']:
+                self.write('treenode_class_instance',
+                           self.relations['labeled_as'], node_id,
+                           r.choice(self.labels))
+            if r.random() < o['review_probability']:
+                self.write('review', self.user_id, '', skeleton_id, node_id)
+            if r.random() < o['synapse_probability']:
+                self.synapse(node_id, skeleton_id, x, y, z)
+
+        # Make the nodes of this neuron available as synaptic partners
+        limit = o['cell_capacity']
+        for node_id, x, y, z in nodes:
+            partners = self.cells.setdefault(self.cell(x, y, z), [])
+            if len(partners) < limit:
+                partners.append((node_id, skeleton_id))
+            else:
+                partners[r.randrange(limit)] = (node_id, skeleton_id)
+
+    def synapse(self, node_id, skeleton_id, x, y, z):
+        r = self.random
+        x = self.clamp(x + r.uniform(-1, 1) * self.step, 0)
+        y = self.clamp(y + r.uniform(-1, 1) * self.step, 1)
+        connector_id = self.write('connector', self.user_id, x, y, z, 5)
+        self.write('treenode_connector', self.relations['presynaptic_to'],
+                   node_id, connector_id, skeleton_id, 5)
+        candidates = self.cells.get(self.cell(x, y, z), [])
+        n = min(r.randint(1, self.options['max_partners']), len(candidates))
+        for partner_id, partner_skeleton_id in r.sample(candidates, n):
+            self.write('treenode_connector', self.relations['postsynaptic_to'],
+                       partner_id, connector_id, partner_skeleton_id, 5)
+
+
+class Command(NoArgsCommand):
+    """ Call e.g. like
+        ./manage.py catmaid_create_synthetic_project --user 1 --neurons 1000 \
+                --nodes 10000
+    """
+    help = "Create a new project with a synthetic, deterministic tracing data " \
+           "set of configurable size, e.g. for benchmarks"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--user', dest='user_id',
+            help='The ID of the user who owns all created data'),
+        make_option('--title', dest='title', default='Synthetic project',
+            help='The title of the new project'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help='The seed of the random generator, the same seed and '
+                 'options create the same data'),
+        make_option('--neurons', dest='neurons', type='int', default=100,
+            help='The number of neurons'),
+        make_option('--nodes', dest='nodes', type='int', default=1000,
+            help='The number of nodes of every neuron'),
+        make_option('--branch-probability', dest='branch_probability',
+            type='float', default=0.02,
+            help='The probability of a node to start a new branch'),
+        make_option('--step', dest='step', type='float', default=200.0,
+            help='The mean distance between nodes in the XY plane, in nm'),
+        make_option('--synapse-probability', dest='synapse_probability',
+            type='float', default=0.02,
+            help='The probability of a node to be presynaptic to a connector'),
+        make_option('--max-partners', dest='max_partners', type='int',
+            default=4, help='The maximum number of postsynaptic partners of '
+                            'a connector'),
+        make_option('--tag-probability', dest='tag_probability',
+            type='float', default=0.005,
+            help='The probability of a node to be tagged'),
+        make_option('--review-probability', dest='review_probability',
+            type='float', default=0.3,
+            help='The probability of a node to be reviewed'),
+        make_option('--annotations', dest='annotations', type='int',
+            default=20, help='The number of annotations, every neuron gets '
+                             'up to three of them'),
+        make_option('--width', dest='width', type='int', default=20000,
+            help='The width of the stack in pixels'),
+        make_option('--height', dest='height', type='int', default=20000,
+            help='The height of the stack in pixels'),
+        make_option('--depth', dest='depth', type='int', default=1000,
+            help='The number of sections of the stack'),
+        make_option('--resolution', dest='resolution', type='float', nargs=3,
+            default=(4.0, 4.0, 50.0),
+            help='The resolution of the stack in nm, as three numbers'),
+        make_option('--cell-size', dest='cell_size', type='float',
+            default=2000.0, help='The edge length of the cubes in which '
+                                 'synaptic partners are searched, in nm'),
+        make_option('--cell-capacity', dest='cell_capacity', type='int',
+            default=32, help='The number of nodes kept per cube as possible '
+                             'synaptic partners'),
+        )
+
+    def handle_noargs(self, **options):
+        if not options['user_id']:
+            raise CommandError("You must specify a user ID with --user")
+        if options['neurons'] < 1 or options['nodes'] < 1 or \
+                options['depth'] < 1:
+            raise CommandError("At least one neuron, node and section are "
+                               "needed")
+        user = User.objects.get(pk=options['user_id'])
+
+        print("Generating %s neurons with %s nodes each" % (options['neurons'],
+              options['nodes']))
+        generator = Generator(options, user.id)
+        generator.generate()
+
+        with transaction.atomic():
+            project = Project.objects.create(title=options['title'])
+            stack = Stack.objects.create(title='%s stack' % options['title'],
+                    dimension=Integer3D(options['width'], options['height'],
+                                        options['depth']),
+                    resolution=Double3D(*options['resolution']),
+                    image_base='', comment='Synthetic data, without images')
+            ProjectStack.objects.create(project=project, stack=stack)
+            setup_tracing(project.id, user)
+
+            print("Importing data into project %s" % project.id)
+            cursor = connection.cursor()
+            cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+            importer = BulkImporter(cursor, project.id)
+            for table, data in generator.files.iteritems():
+                importer.stage(table, data)
+                data.close()
+            counts = importer.insert()
+
+        for table, count in counts.iteritems():
+            print("Created %s rows in table %s" % (count, table))
+        print("Created project %s with stack %s" % (project.id, stack.id))
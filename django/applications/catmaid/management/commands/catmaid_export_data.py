@@ -1,12 +1,24 @@
-from itertools import chain
+import tarfile
+import tempfile
+import time
+
 from optparse import make_option
-from django.core import serializers
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from catmaid.control.bulkimport import TABLES
+from catmaid.control.common import get_class_to_id_map, \
+        get_relation_to_id_map
 from catmaid.control.tracing import check_tracing_setup
-from catmaid.models import Class, ClassInstance, ClassInstanceClassInstance, \
-         Relation, Connector, Project, Treenode, TreenodeConnector
+from catmaid.models import ClassInstance, Project
 
 class Exporter():
+    """ Writes the tracing data of a project into a compressed tar archive of
+    CSV files, one per table, which catmaid_import_data can import. The rows
+    to export are selected into temporary tables of IDs and every table is
+    written with COPY ... TO STDOUT through a temporary file, so that memory
+    use doesn't depend on the size of the project. Everything is read in one
+    repeatable read transaction to get a consistent snapshot.
+    """
     def __init__(self, project, options):
         self.project = project
         self.options = options
@@ -15,181 +27,239 @@ class Exporter():
         self.export_annotations = options['export_annotations']
         self.export_tags = options['export_tags']
         self.required_annotations = options['required_annotations']
-        self.target_file = 'export_pid_%s.json' % project.id
+        self.target_file = 'export_pid_%s.tar.gz' % project.id
 
         self.show_traceback = True
-        self.format = 'json'
-        self.indent = 2
 
-        self.to_serialize = []
-        self.seen = {}
+    def select(self, table, query):
+        """ Create a temporary table of the IDs returned by the query. """
+        self.cursor.execute('''
+            DROP TABLE IF EXISTS %s;
+            CREATE TEMPORARY TABLE %s ON COMMIT DROP AS %s
+        ''' % (table, table, query % self.params))
 
-    def collect_data(self):
-        self.to_serialize = []
+    def count(self, table):
+        self.cursor.execute('SELECT count(*) FROM %s' % table)
+        return self.cursor.fetchone()[0]
 
-        classes = dict(Class.objects.filter(
-                project=self.project).values_list('class_name', 'id'))
-        relations = dict(Relation.objects.filter(
-                project=self.project).values_list('relation_name', 'id'))
+    def collect_data(self):
+        """ Select the IDs of all rows to export into temporary tables named
+        export_<table>. """
+        classes = get_class_to_id_map(self.project.id)
+        relations = get_relation_to_id_map(self.project.id)
 
         if not check_tracing_setup(self.project.id, classes, relations):
             raise ValueError("Project with ID %s is no tracing project." % self.project.id)
 
-        skeleton_id_constraints = None
-        entities = ClassInstance.objects.filter(project=self.project,
-                class_column__in=[classes['neuron']])
-        skeleton_links = ClassInstanceClassInstance.objects.filter(
-                project_id=self.project.id, relation=relations['model_of'],
-                class_instance_a__class_column=classes['skeleton'])
-        skeletons = ClassInstance.objects.filter(project=self.project,
-                class_column__in=[classes['skeleton']])
-
-        if self.required_annotations:
+        self.params = {
+            'project_id': self.project.id,
+            'neuron': classes['neuron'],
+            'skeleton': classes['skeleton'],
+            'model_of': relations['model_of'],
+            'annotated_with': relations.get('annotated_with', -1),
+            'labeled_as': relations.get('labeled_as', -1),
+        }
+
+        filtered = bool(self.required_annotations)
+        if filtered:
             # Get mapping from annotations to IDs
             a_to_id = dict(ClassInstance.objects.filter(
                     project=self.project, class_column=classes['annotation'],
                     name__in=self.required_annotations).values_list('name', 'id'))
             print("Found entities with the following annotations: %s" % \
                   ", ".join(a_to_id.keys()))
-
-            entities = ClassInstance.objects.filter(project=self.project,
-                class_column=classes['neuron'],
-                cici_via_a__relation_id=relations['annotated_with'],
-                cici_via_a__class_instance_b_id__in=a_to_id.values())
-
-            # Get the corresponding skeleton IDs
-            skeleton_links = ClassInstanceClassInstance.objects.filter(
-                    project_id=self.project.id, relation=relations['model_of'],
-                    class_instance_a__class_column=classes['skeleton'],
-                    class_instance_b__in=entities)
-            skeleton_id_constraints = set(skeleton_links.values_list(
-                    'class_instance_a', flat=True))
-            skeletons = ClassInstance.objects.filter(project=self.project,
-                    id__in=skeleton_id_constraints)
-
-        print("Will export %s entities" % entities.count())
-
-        # Export classes and relations
-        self.to_serialize.append(Class.objects.filter(project=self.project))
-        self.to_serialize.append(Relation.objects.filter(project=self.project))
-
-        # Export skeleton-neuron links
-        self.to_serialize.append(entities)
-        self.to_serialize.append(skeleton_links)
-        self.to_serialize.append(skeletons)
-
-        if skeleton_id_constraints:
-            # Export treenodes
-            if self.export_treenodes:
-                treenodes = Treenode.objects.filter(
-                        project=self.project,
-                        skeleton_id__in=skeleton_id_constraints)
-                self.to_serialize.append(treenodes)
-
-                exported_tids = set(treenodes.values_list('id', flat=True))
-                print("Exporting %s treenodes" % len(exported_tids))
-
-            # Export connectors and connector links
-            if self.export_connectors:
-                connector_links = TreenodeConnector.objects.filter(
-                        project=self.project, skeleton_id__in=skeleton_id_constraints).values_list('id', 'connector', 'treenode')
-
-                # Add matching connecots
-                connector_ids = set(c for _,c,_ in connector_links)
-                self.to_serialize.append(Connector.objects.filter(
-                        id__in=connector_ids))
-                print("Exporting %s connectors" % len(connector_ids))
-
-                # Add matching connector links
-                self.to_serialize.append(TreenodeConnector.objects.filter(
-                        id__in=[l for l,_,_ in connector_links]))
-
-                # Add addition placeholde treenodes
-                connector_tids = set(TreenodeConnector.objects \
-                    .filter(project=self.project, connector__in=connector_ids) \
-                    .exclude(skeleton_id__in=skeleton_id_constraints) \
-                    .values_list('treenode', flat=True))
-                extra_tids = connector_tids - exported_tids
-                print("Exporting %s placeholder nodes" % len(extra_tids))
-                self.to_serialize.append(Treenode.objects.filter(id__in=extra_tids))
-
-                # Add additional skeletons and neuron-skeleton links
-                extra_skids = set(Treenode.objects.filter(id__in=extra_tids,
-                        project=self.project).values_list('skeleton_id', flat=True))
-                self.to_serialize.append(ClassInstance.objects.filter(id__in=extra_skids))
-
-                extra_links = ClassInstanceClassInstance.objects \
-                        .filter(project=self.project,
-                                class_instance_a__in=extra_skids,
-                                relation=relations['model_of'])
-                self.to_serialize.append(extra_links)
-
-                extra_nids = extra_links.values_list('class_instance_b', flat=True)
-                self.to_serialize.append(ClassInstance.objects.filter(
-                    project=self.project, id__in=extra_nids))
-
-            # Export annotations and annotation-neuron links, liked to selected
-            # entities.
-            if self.export_annotations and 'annotated_with' in relations:
-                annotation_links = ClassInstanceClassInstance.objects.filter(
-                    project_id=self.project.id, relation=relations['annotated_with'],
-                    class_instance_a__in=entities)
-                annotations = ClassInstance.objects.filter(project_id=self.project.id,
-                                                           cici_via_b__in=annotation_links)
-                self.to_serialize.append(annotations)
-                self.to_serialize.append(annotation_links)
-
-            # TODO: Export reviews
+            self.params['annotations'] = ','.join(
+                    str(a) for a in a_to_id.values()) or 'NULL'
+
+            self.select('export_neuron', '''
+                SELECT DISTINCT ci.id FROM class_instance ci
+                JOIN class_instance_class_instance cici
+                  ON cici.class_instance_a = ci.id
+                WHERE ci.project_id = %(project_id)s
+                  AND ci.class_id = %(neuron)s
+                  AND cici.relation_id = %(annotated_with)s
+                  AND cici.class_instance_b IN (%(annotations)s)
+            ''')
+            # Links of the skeletons modeling these neurons
+            self.select('export_model_of', '''
+                SELECT cici.id, cici.class_instance_a AS skeleton_id,
+                       cici.class_instance_b AS neuron_id
+                FROM class_instance_class_instance cici
+                JOIN class_instance s ON s.id = cici.class_instance_a
+                JOIN export_neuron n ON n.id = cici.class_instance_b
+                WHERE cici.project_id = %(project_id)s
+                  AND cici.relation_id = %(model_of)s
+                  AND s.class_id = %(skeleton)s
+            ''')
+            self.select('export_skeleton', '''
+                SELECT DISTINCT skeleton_id AS id FROM export_model_of
+            ''')
+        else:
+            self.select('export_neuron', '''
+                SELECT id FROM class_instance
+                WHERE project_id = %(project_id)s AND class_id = %(neuron)s
+            ''')
+            self.select('export_model_of', '''
+                SELECT cici.id, cici.class_instance_a AS skeleton_id,
+                       cici.class_instance_b AS neuron_id
+                FROM class_instance_class_instance cici
+                JOIN class_instance s ON s.id = cici.class_instance_a
+                WHERE cici.project_id = %(project_id)s
+                  AND cici.relation_id = %(model_of)s
+                  AND s.class_id = %(skeleton)s
+            ''')
+            self.select('export_skeleton', '''
+                SELECT id FROM class_instance
+                WHERE project_id = %(project_id)s AND class_id = %(skeleton)s
+            ''')
+
+        print("Will export %s entities" % self.count('export_neuron'))
+
+        if self.export_treenodes:
+            self.select('export_treenode', '''
+                SELECT t.id FROM treenode t
+                JOIN export_skeleton s ON s.id = t.skeleton_id
+            ''')
         else:
-            # Export treenodes
-            if self.export_treenodes:
-                if skeleton_id_constraints:
-                    pass
-                else:
-                    self.to_serialize.append(Treenode.objects.filter(
-                            project=self.project))
-
-            # Export connectors and connector links
-            if self.export_connectors:
-                self.to_serialize.append(Connector.objects.filter(
-                        project=self.project))
-                self.to_serialize.append(TreenodeConnector.objects.filter(
-                        project=self.project))
-
-            # Export annotations and annotation-neuron links
-            if self.export_annotations and 'annotated_with' in relations:
-                annotation_links = ClassInstanceClassInstance.objects.filter(
-                    project_id=self.project.id, relation=relations['annotated_with'],
-                    class_instance_a__in=entities)
-                annotations = ClassInstance.objects.filter(project_id=self.project.id,
-                                                           cici_via_b__in=annotation_links)
-                self.to_serialize.append(annotations)
-                self.to_serialize.append(annotation_links)
-
-            # TODO: Export reviews
+            self.select('export_treenode', 'SELECT NULL::bigint AS id LIMIT 0')
+
+        if self.export_connectors:
+            self.select('export_treenode_connector', '''
+                SELECT tc.id, tc.connector_id FROM treenode_connector tc
+                JOIN export_skeleton s ON s.id = tc.skeleton_id
+            ''')
+            if filtered:
+                self.select('export_connector', '''
+                    SELECT DISTINCT connector_id AS id
+                    FROM export_treenode_connector
+                ''')
+            else:
+                self.select('export_connector', '''
+                    SELECT id FROM connector WHERE project_id = %(project_id)s
+                ''')
+        else:
+            self.select('export_treenode_connector',
+                    'SELECT NULL::bigint AS id LIMIT 0')
+            self.select('export_connector', 'SELECT NULL::bigint AS id LIMIT 0')
+
+        if filtered:
+            print("Exporting %s treenodes" % self.count('export_treenode'))
+        if filtered and self.export_connectors:
+            print("Exporting %s connectors" % self.count('export_connector'))
+
+            # Add placeholder treenodes of other skeletons linked to the
+            # exported connectors, together with their skeletons and neurons.
+            self.select('export_placeholder', '''
+                SELECT DISTINCT tc.treenode_id AS id, tc.skeleton_id
+                FROM treenode_connector tc
+                JOIN export_connector c ON c.id = tc.connector_id
+                WHERE tc.project_id = %(project_id)s
+                  AND tc.skeleton_id NOT IN (SELECT id FROM export_skeleton)
+            ''')
+            print("Exporting %s placeholder nodes" % \
+                    self.count('export_placeholder'))
+            self.cursor.execute('''
+                INSERT INTO export_treenode
+                SELECT id FROM export_placeholder;
+                INSERT INTO export_model_of
+                SELECT cici.id, cici.class_instance_a, cici.class_instance_b
+                FROM class_instance_class_instance cici
+                WHERE cici.project_id = %(project_id)s
+                  AND cici.relation_id = %(model_of)s
+                  AND cici.class_instance_a IN (
+                      SELECT skeleton_id FROM export_placeholder);
+                INSERT INTO export_skeleton
+                SELECT DISTINCT skeleton_id FROM export_placeholder;
+            ''' % self.params)
+
+        # Export annotations and annotation-neuron links, linked to selected
+        # entities.
+        if self.export_annotations:
+            self.select('export_annotated_with', '''
+                SELECT cici.id, cici.class_instance_b AS annotation_id
+                FROM class_instance_class_instance cici
+                JOIN export_neuron n ON n.id = cici.class_instance_a
+                WHERE cici.relation_id = %(annotated_with)s
+            ''')
+        else:
+            self.select('export_annotated_with', '''
+                SELECT NULL::bigint AS id, NULL::bigint AS annotation_id LIMIT 0
+            ''')
+
+        # Export tags of exported treenodes
+        if self.export_tags:
+            self.select('export_treenode_class_instance', '''
+                SELECT tci.id, tci.class_instance_id
+                FROM treenode_class_instance tci
+                JOIN export_treenode t ON t.id = tci.treenode_id
+                WHERE tci.relation_id = %(labeled_as)s
+            ''')
+        else:
+            self.select('export_treenode_class_instance', '''
+                SELECT NULL::bigint AS id, NULL::bigint AS class_instance_id
+                LIMIT 0
+            ''')
+
+        self.select('export_class_instance', '''
+            SELECT neuron_id AS id FROM export_model_of
+            UNION SELECT id FROM export_neuron
+            UNION SELECT id FROM export_skeleton
+            UNION SELECT annotation_id FROM export_annotated_with
+            UNION SELECT class_instance_id FROM export_treenode_class_instance
+        ''')
+        self.select('export_class_instance_class_instance', '''
+            SELECT id FROM export_model_of
+            UNION SELECT id FROM export_annotated_with
+        ''')
+
+        # Export reviews of exported treenodes
+        self.select('export_review', '''
+            SELECT r.id FROM review r
+            JOIN export_treenode t ON t.id = r.treenode_id
+        ''')
+
+    def write_table(self, archive, table):
+        """ Add the CSV file of a table to the archive. """
+        if table in ('class', 'relation'):
+            condition = 'project_id = %s' % self.project.id
+        else:
+            condition = 'id IN (SELECT id FROM export_%s)' % table
+        with tempfile.TemporaryFile() as data:
+            self.cursor.copy_expert('''
+                COPY (SELECT %s FROM %s WHERE %s)
+                TO STDOUT WITH CSV HEADER
+            ''' % (', '.join(TABLES[table]), table, condition), data)
+            info = tarfile.TarInfo('%s.csv' % table)
+            info.size = data.tell()
+            info.mtime = time.time()
+            data.seek(0)
+            archive.addfile(info, data)
 
     def export(self):
-        """ Writes all objects matching
+        """ Writes all objects matching the options into the target file.
         """
         try:
-            self.collect_data()
-
-            data = list(chain(*self.to_serialize))
-
-            CurrentSerializer = serializers.get_serializer(self.format)
-            serializer = CurrentSerializer()
-            with open(self.target_file, "w") as out:
-                serializer.serialize(data, indent=self.indent, stream=out)
+            outermost = not connection.in_atomic_block
+            with transaction.atomic():
+                self.cursor = connection.cursor()
+                if outermost:
+                    self.cursor.execute(
+                            'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                self.collect_data()
+
+                with tarfile.open(self.target_file, 'w:gz') as archive:
+                    for table in TABLES:
+                        self.write_table(archive, table)
         except Exception, e:
             if self.show_traceback:
                 raise
-            raise CommandError("Unable to serialize database: %s" % e)
+            raise CommandError("Unable to export data: %s" % e)
 
 class Command(BaseCommand):
     """ Call e.g. like
         ./manage.py catmaid_export_data --source 1 --required-annotation "Kenyon cells"
     """
-    help = "Export CATMAID data into a JSON representation"
+    help = "Export CATMAID data into a compressed archive of CSV files"
     option_list = BaseCommand.option_list + (
         make_option('--source', dest='source', default=None,
             help='The ID of the source project'),
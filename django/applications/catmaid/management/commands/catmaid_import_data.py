@@ -1,8 +1,12 @@
+import os
+import tarfile
+
 from optparse import make_option
 from django.core import serializers
 from django.core.management.base import NoArgsCommand, CommandError
 from django.db import connection, transaction
 from catmaid.control.annotationadmin import copy_annotations
+from catmaid.control.bulkimport import import_files, TABLES
 from catmaid.models import Project, User
 
 class FileImporter:
@@ -49,6 +53,37 @@ class FileImporter:
         ''')
 
 
+class BulkFileImporter:
+    """ Imports a directory or tar archive of CSV files, one per table, as
+    written by catmaid_export_data. Rows are copied into staging tables,
+    mapped to new IDs and inserted all at once, which is much faster than
+    importing JSON data.
+    """
+    def __init__(self, source, target, user, options):
+        self.source = source
+        self.target = target
+        self.options = options
+        self.user = user
+
+    @transaction.atomic
+    def import_data(self):
+        cursor = connection.cursor()
+        cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+        # Links of tables that are left out are skipped, too
+        excluded = set()
+        if not self.options['import_treenodes']:
+            excluded.add('treenode')
+        if not self.options['import_connectors']:
+            excluded.update(('connector', 'treenode_connector'))
+        if not self.options['import_tags']:
+            excluded.add('treenode_class_instance')
+        tables = [t for t in TABLES if t not in excluded]
+        counts = import_files(cursor, self.source, self.target.id,
+                self.user.id if self.user else None, tables)
+        for table, count in counts.iteritems():
+            print("Imported %s rows into table %s" % (count, table))
+
+
 class InternalImporter:
     def __init__(self, source, target, user, options):
         self.source = source
@@ -154,8 +189,12 @@ class Command(NoArgsCommand):
                 Importer = InternalImporter
             except ValueError:
                 source = options['source']
-                print("Using file importer")
-                Importer = FileImporter
+                if os.path.isdir(source) or tarfile.is_tarfile(source):
+                    print("Using bulk file importer")
+                    Importer = BulkFileImporter
+                else:
+                    print("Using file importer")
+                    Importer = FileImporter
         else:
             source = self.ask_for_project('source')
 
@@ -1,11 +1,18 @@
 import json
 import re
+import time
+
+from collections import Counter
 
 from django.http import HttpResponse
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.db import connection
 from traceback import format_exc
 
+from catmaid.control import authcache, instrumentation, nodelistcache, \
+        ontologycache
+
 class AnonymousAuthenticationMiddleware(object):
     """ This middleware class tests whether the current user is the
     anonymous user. If so, it replaces the request.user object with
@@ -48,3 +55,97 @@ class FlyTEMMiddleware(object):
             request.path_info = '/flytem' + request.path_info
             request.path = '/flytem' + request.path
 
+
+class NodeListCacheMiddleware(object):
+    """ Node list cache tiles are invalidated by write operations within the
+    transaction of a request. Deleting the same keys again once the
+    transaction has been committed makes sure no tile read by a concurrent
+    request before the commit stays in the cache.
+    """
+    def process_request(self, request):
+        nodelistcache.flush_pending()
+        return None
+
+    def process_response(self, request, response):
+        nodelistcache.flush_pending()
+        return response
+
+
+class AuthorizationCacheMiddleware(object):
+    """ Keeps a memo of the authorization data looked up during a request and
+    invalidates cached authorization data once more if it was changed by the
+    request, after its transaction has been committed.
+    """
+    def process_request(self, request):
+        authcache.start_request()
+        return None
+
+    def process_response(self, request, response):
+        authcache.end_request()
+        return response
+
+
+class OntologyCacheMiddleware(object):
+    """ Invalidates the cached relation and class maps of projects whose
+    ontology was changed by a request once more, after its transaction has
+    been committed.
+    """
+    def process_request(self, request):
+        ontologycache.flush_pending()
+        return None
+
+    def process_response(self, request, response):
+        ontologycache.flush_pending()
+        return response
+
+
+class InstrumentationMiddleware(object):
+    """ Records the wall time, database time, number of queries, duplicate
+    queries and response size of every request by view, if
+    REQUEST_INSTRUMENTATION_ENABLED is set. To see all of a request, it has to
+    be the first middleware. Queries are only seen if they are executed before
+    the response is returned, not while a streaming response is consumed.
+    """
+    def process_request(self, request):
+        if not instrumentation.enabled():
+            return None
+        request._instrumentation = {
+            'start': time.time(),
+            'debug_cursor': connection.use_debug_cursor,
+            'first_query': len(connection.queries),
+            'view': None,
+        }
+        connection.use_debug_cursor = True
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = getattr(request, '_instrumentation', None)
+        if state is not None:
+            state['view'] = '%s.%s' % (view_func.__module__,
+                    getattr(view_func, '__name__', type(view_func).__name__))
+        return None
+
+    def process_response(self, request, response):
+        state = getattr(request, '_instrumentation', None)
+        if state is None:
+            return response
+        del request._instrumentation
+        wall = (time.time() - state['start']) * 1000
+        queries = connection.queries[state['first_query']:]
+        connection.use_debug_cursor = state['debug_cursor']
+
+        db = sum(float(q['time']) for q in queries) * 1000
+        fingerprints = Counter(instrumentation.fingerprint(q['sql'])
+                               for q in queries)
+        duplicates = dict((sql, n) for sql, n in fingerprints.iteritems()
+                          if n > 1)
+        size = None if response.streaming else len(response.content)
+        # Requests that weren't resolved to a view are grouped by status
+        view = state['view'] or 'unresolved (%s)' % response.status_code
+        instrumentation.record(view, wall, db, len(queries), size, duplicates)
+
+        if getattr(settings, 'REQUEST_INSTRUMENTATION_SERVER_TIMING', False):
+            response['Server-Timing'] = 'db;desc="%s queries, %s duplicates";' \
+                    'dur=%.1f, total;dur=%.1f' % (len(queries),
+                    sum(duplicates.itervalues()) - len(duplicates), db, wall)
+        return response
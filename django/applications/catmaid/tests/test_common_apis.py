@@ -1,24 +1,45 @@
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Group, Permission
 from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
+from django.core.management import call_command
 from django.http import HttpResponse
 from django.db import connection, transaction
 from django.shortcuts import get_object_or_404
-from guardian.shortcuts import assign_perm
+from guardian.shortcuts import assign_perm, remove_perm
 import os
 import re
+import shutil
+import socket
+import tempfile
 import urllib
+import urllib2
 import json
 import datetime
+import h5py
+import networkx as nx
+import numpy as np
+from cStringIO import StringIO
+from PIL import Image
 
 from catmaid.models import Project, Stack, ProjectStack
 from catmaid.models import ClassInstance, Log, Message, TextlabelLocation
 from catmaid.models import Treenode, Connector, TreenodeConnector, User, Review, ReviewerWhitelist
 from catmaid.models import Textlabel, TreenodeClassInstance, ClassInstanceClassInstance
+from catmaid.models import Relation
 from catmaid.fields import Double3D, Integer3D
+from catmaid.control.arbor import Arbor
+from catmaid.control.bulkimport import import_files
+from catmaid.control import cropping, instrumentation, packedarrays, \
+        tilecache, useranalytics
+from catmaid.control.synapseclustering import tree_max_density
+from catmaid.control.tile import HDF5TileServer, LRUCache
 from catmaid.control.common import get_relation_to_id_map, get_class_to_id_map
+from catmaid.control.authentication import project_permissions, \
+        user_domain, user_can_edit
 from catmaid.control.neuron_annotations import _annotate_entities, create_annotation_query
+from catmaid.management.commands.catmaid_export_data import Exporter
 
 
 class TransactionTests(TransactionTestCase):
@@ -1929,6 +1950,33 @@ class ViewPageTests(TestCase):
         assertHasParent(377, 405)
         assertHasParent(407, None)
 
+    def test_reroot_skeleton_confidence(self):
+        self.fake_authentication()
+
+        # The path 409 -> 407 -> 405 -> 377 (root) and 403, which is off the
+        # path, with different confidences
+        confidences = {409: 1, 407: 2, 405: 3, 377: 4, 403: 0}
+        for treenode_id, confidence in confidences.iteritems():
+            Treenode.objects.filter(id=treenode_id).update(confidence=confidence)
+
+        response = self.client.post(
+                '/%d/skeleton/reroot' % self.test_project_id,
+                {'treenode_id': 409})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({'newroot': 409}, json.loads(response.content))
+
+        # Every node on the path takes the confidence of its former child,
+        # the new root has full confidence.
+        nodes = dict((n.id, (n.parent_id, n.confidence)) for n in
+                Treenode.objects.filter(id__in=confidences.keys()))
+        self.assertEqual({
+            409: (None, 5),
+            407: (409, 1),
+            405: (407, 2),
+            377: (405, 3),
+            403: (377, 0),
+        }, nodes)
+
     def test_reroot_and_join_skeletons(self):
         self.fake_authentication()
 
@@ -1977,6 +2025,427 @@ class ViewPageTests(TestCase):
 
         self.assertEqual(new_skeleton_id, get_object_or_404(TreenodeConnector, id=2405).skeleton_id)
 
+    def test_split_skeleton(self):
+        self.fake_authentication()
+
+        split_at = 265 # Skeleton ID: 235
+        downstream = [265, 267, 269, 271, 273, 275, 277, 279, 281, 283, 285,
+                      289, 415, 417]
+
+        response = self.client.post(
+                '/%d/skeleton/split' % self.test_project_id, {
+                    'treenode_id': split_at,
+                    'upstream_annotation_map': '{}',
+                    'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({}, json.loads(response.content))
+
+        new_skeleton_id = get_object_or_404(Treenode, id=split_at).skeleton_id
+        self.assertNotEqual(235, new_skeleton_id)
+        self.assertEqual(None, get_object_or_404(Treenode, id=split_at).parent_id)
+        self.assertEqual(sorted(downstream), sorted(Treenode.objects.filter(
+                skeleton_id=new_skeleton_id).values_list('id', flat=True)))
+        self.assertEqual(14, Treenode.objects.filter(skeleton_id=235).count())
+
+        # Synapses of moved nodes follow them
+        self.assertEqual(new_skeleton_id, get_object_or_404(TreenodeConnector, id=360).skeleton_id)
+        self.assertEqual(new_skeleton_id, get_object_or_404(TreenodeConnector, id=425).skeleton_id)
+        self.assertEqual(235, get_object_or_404(TreenodeConnector, id=437).skeleton_id)
+
+    def test_bulk_import(self):
+        files = {
+            'class': 'id,user_id,creation_time,edition_time,class_name,description\n'
+                     '1,3,,,skeleton,\n'
+                     '2,3,,,neuron,\n',
+            'relation': 'id,user_id,creation_time,edition_time,relation_name,uri,description,isreciprocal\n'
+                        '5,3,,,model_of,,,f\n'
+                        '6,3,,,imported_relation,,,f\n',
+            'class_instance': 'id,user_id,creation_time,edition_time,class_id,name\n'
+                              '10,3,,,1,Imported skeleton\n'
+                              '11,3,,,2,Imported neuron\n',
+            'class_instance_class_instance': 'id,user_id,creation_time,edition_time,relation_id,class_instance_a,class_instance_b\n'
+                                             '20,3,,,5,10,11\n',
+            'treenode': 'id,user_id,creation_time,edition_time,editor_id,location_x,location_y,location_z,parent_id,radius,confidence,skeleton_id\n'
+                        '31,3,,,3,1.0,2.0,0.0,30,-1,5,10\n'
+                        '30,3,,,3,0.0,0.0,0.0,,-1,5,10\n'
+                        '32,3,,,3,5.0,2.0,0.0,31,-1,4,10\n',
+        }
+        source = tempfile.mkdtemp()
+        try:
+            for table, content in files.iteritems():
+                with open(os.path.join(source, table + '.csv'), 'w') as f:
+                    f.write(content)
+            with self.settings(ONTOLOGY_CACHE_ENABLED=True):
+                self.assertNotIn('imported_relation',
+                                 get_relation_to_id_map(self.test_project_id))
+                counts = import_files(connection.cursor(), source,
+                                      self.test_project_id)
+                # New relations invalidate the cached relation map
+                self.assertIn('imported_relation',
+                              get_relation_to_id_map(self.test_project_id))
+        finally:
+            shutil.rmtree(source)
+
+        # Classes and relations of the project are reused
+        self.assertEqual(0, counts['class'])
+        self.assertEqual(1, counts['relation'])
+        self.assertEqual(2, counts['class_instance'])
+        self.assertEqual(1, counts['class_instance_class_instance'])
+        self.assertEqual(3, counts['treenode'])
+
+        skeleton = ClassInstance.objects.get(project=self.test_project_id,
+                                             name='Imported skeleton')
+        self.assertEqual(get_class_to_id_map(self.test_project_id)['skeleton'],
+                         skeleton.class_column_id)
+        neuron = ClassInstance.objects.get(cici_via_b__class_instance_a=skeleton,
+                cici_via_b__relation__relation_name='model_of')
+        self.assertEqual('Imported neuron', neuron.name)
+
+        nodes = dict(((n.location_x, n.location_y), n) for n in
+                Treenode.objects.filter(skeleton=skeleton))
+        root, child, leaf = nodes[(0, 0)], nodes[(1, 2)], nodes[(5, 2)]
+        self.assertEqual(None, root.parent_id)
+        self.assertEqual(root.id, child.parent_id)
+        self.assertEqual(child.id, leaf.parent_id)
+        self.assertEqual(4, leaf.confidence)
+
+    def test_export_and_bulk_import(self):
+        project = Project.objects.get(pk=self.test_project_id)
+        num_treenodes = Treenode.objects.filter(project=project).count()
+        num_connectors = Connector.objects.filter(project=project).count()
+        labels = ClassInstance.objects.filter(project=project,
+                class_column__class_name='label')
+        num_labels = labels.count()
+        self.assertTrue(num_labels > 0)
+
+        exporter = Exporter(project, {
+            'export_treenodes': True,
+            'export_connectors': True,
+            'export_annotations': True,
+            'export_tags': True,
+            'required_annotations': None})
+        target = tempfile.mkdtemp()
+        try:
+            exporter.target_file = os.path.join(target, 'export.tar.gz')
+            exporter.export()
+            # Import a copy of the project into itself
+            counts = import_files(connection.cursor(), exporter.target_file,
+                                  self.test_project_id)
+        finally:
+            shutil.rmtree(target)
+
+        self.assertEqual(0, counts['class'])
+        self.assertEqual(0, counts['relation'])
+        self.assertEqual(num_treenodes, counts['treenode'])
+        self.assertEqual(num_connectors, counts['connector'])
+        self.assertEqual(2 * num_treenodes,
+                Treenode.objects.filter(project=project).count())
+        # Tags are matched by name like annotations
+        self.assertEqual(num_labels, labels.count())
+
+        # Summaries are updated without the row triggers, which are used
+        # again afterwards
+        self.assertConnectivityIsCurrent()
+        self.assertSkeletonSummaryIsCurrent()
+        self.assertContributionSummaryIsCurrent()
+        cursor = connection.cursor()
+        cursor.execute("SELECT current_setting('catmaid.skip_summary_triggers')")
+        self.assertEqual('off', cursor.fetchone()[0])
+
+    def test_create_synthetic_project(self):
+        options = {'user_id': self.test_user_id, 'neurons': 3, 'nodes': 50,
+                   'seed': 1, 'width': 1000, 'height': 1000, 'depth': 10}
+        call_command('catmaid_create_synthetic_project', **options)
+        project = Project.objects.get(title='Synthetic project')
+        skeleton_ids = set(ClassInstance.objects.filter(project=project,
+                class_column__class_name='skeleton').values_list('id', flat=True))
+        self.assertEqual(3, len(skeleton_ids))
+        self.assertEqual(150, Treenode.objects.filter(project=project).count())
+        for skeleton_id in skeleton_ids:
+            self.assertEqual(1, Treenode.objects.filter(skeleton=skeleton_id,
+                                                        parent=None).count())
+
+        # The same seed creates the same data
+        call_command('catmaid_create_synthetic_project', title='Copy', **options)
+        copy = Project.objects.get(title='Copy')
+        def locations(p):
+            return list(Treenode.objects.filter(project=p).order_by('id') \
+                    .values_list('location_x', 'location_y', 'location_z'))
+        self.assertEqual(locations(project), locations(copy))
+        self.assertConnectivityIsCurrent()
+        self.assertSkeletonSummaryIsCurrent()
+        self.assertContributionSummaryIsCurrent()
+
+    def assertConnectivityIsCurrent(self):
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT t1.skeleton_id, t1.relation_id,
+                   t2.skeleton_id, t2.relation_id, count(*)
+            FROM treenode_connector t1, treenode_connector t2
+            WHERE t1.connector_id = t2.connector_id AND t1.id <> t2.id
+            GROUP BY t1.skeleton_id, t1.relation_id,
+                     t2.skeleton_id, t2.relation_id
+            ORDER BY 1, 2, 3, 4''')
+        expected = cursor.fetchall()
+        cursor.execute('''
+            SELECT skeleton_a, relation_a, skeleton_b, relation_b, count
+            FROM skeleton_connectivity
+            ORDER BY 1, 2, 3, 4''')
+        self.assertEqual(expected, cursor.fetchall())
+        return expected
+
+    def test_skeleton_connectivity(self):
+        self.fake_authentication()
+
+        self.assertTrue(self.assertConnectivityIsCurrent())
+
+        # Join the skeletons of 2394 and 2415, both of which have synapses
+        response = self.client.post(
+                '/%d/skeleton/reroot' % self.test_project_id,
+                {'treenode_id': 2394})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(
+                '/%d/skeleton/join' % self.test_project_id, {
+                    'from_id': 2415,
+                    'to_id': 2394,
+                    'annotation_set': '{}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertConnectivityIsCurrent()
+
+        response = self.client.post(
+                '/%d/link/delete' % self.test_project_id,
+                {'connector_id': 356, 'treenode_id': 377})
+        self.assertEqual(response.status_code, 200)
+        self.assertConnectivityIsCurrent()
+
+    def assertSkeletonSummaryIsCurrent(self):
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT t.skeleton_id, count(*),
+                   (SELECT count(DISTINCT treenode_id) FROM review r
+                    WHERE r.skeleton_id = t.skeleton_id),
+                   round(coalesce(sum(sqrt((t.location_x - p.location_x)^2 +
+                                           (t.location_y - p.location_y)^2 +
+                                           (t.location_z - p.location_z)^2)),
+                                  0)::numeric, 3)
+            FROM treenode t LEFT JOIN treenode p ON t.parent_id = p.id
+            GROUP BY t.skeleton_id
+            ORDER BY t.skeleton_id''')
+        expected = cursor.fetchall()
+        cursor.execute('''
+            SELECT skeleton_id, num_nodes, num_reviewed_nodes,
+                   round(cable_length::numeric, 3)
+            FROM skeleton_summary
+            ORDER BY skeleton_id''')
+        self.assertEqual(expected, cursor.fetchall())
+        cursor.execute('''
+            SELECT skeleton_id, reviewer_id, count(DISTINCT treenode_id)
+            FROM review
+            GROUP BY skeleton_id, reviewer_id
+            ORDER BY 1, 2''')
+        expected = cursor.fetchall()
+        cursor.execute('''
+            SELECT skeleton_id, reviewer_id, num_reviewed_nodes
+            FROM skeleton_reviewer_summary
+            ORDER BY 1, 2''')
+        self.assertEqual(expected, cursor.fetchall())
+
+    def test_skeleton_summary(self):
+        self.fake_authentication()
+
+        self.assertSkeletonSummaryIsCurrent()
+
+        # Move a node
+        response = self.client.post(
+                '/%d/node/update' % self.test_project_id, {
+                    't[0][0]': 2368, 't[0][1]': 2990,
+                    't[0][2]': 5200, 't[0][3]': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertSkeletonSummaryIsCurrent()
+
+        response = self.client.post(
+                '/%d/node/%d/reviewed' % (self.test_project_id, 2368))
+        self.assertEqual(response.status_code, 200)
+        self.assertSkeletonSummaryIsCurrent()
+
+        # Delete a node with children
+        response = self.client.post(
+                '/%d/treenode/delete' % self.test_project_id,
+                {'treenode_id': 265})
+        self.assertEqual(response.status_code, 200)
+        self.assertSkeletonSummaryIsCurrent()
+
+        # Join two skeletons
+        response = self.client.post(
+                '/%d/skeleton/reroot' % self.test_project_id,
+                {'treenode_id': 2394})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(
+                '/%d/skeleton/join' % self.test_project_id, {
+                    'from_id': 2415,
+                    'to_id': 2394,
+                    'annotation_set': '{}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertSkeletonSummaryIsCurrent()
+
+    def assertContributionSummaryIsCurrent(self):
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT project_id, user_id, date, sum(nodes_created),
+                   sum(nodes_edited), sum(connectors_created),
+                   sum(skeletons_created), sum(reviews)
+            FROM (
+                SELECT project_id, user_id, creation_time::date AS date,
+                       1 AS nodes_created, 0 AS nodes_edited,
+                       0 AS connectors_created, 0 AS skeletons_created,
+                       0 AS reviews
+                FROM treenode
+                UNION ALL
+                SELECT project_id, editor_id, edition_time::date,
+                       0, 1, 0, 0, 0
+                FROM treenode WHERE editor_id <> user_id
+                UNION ALL
+                SELECT project_id, user_id, creation_time::date,
+                       0, 0, 1, 0, 0
+                FROM connector
+                UNION ALL
+                SELECT ci.project_id, ci.user_id, ci.creation_time::date,
+                       0, 0, 0, 1, 0
+                FROM class_instance ci JOIN class c ON c.id = ci.class_id
+                WHERE c.class_name = 'skeleton'
+                UNION ALL
+                SELECT project_id, reviewer_id, review_time::date,
+                       0, 0, 0, 0, 1
+                FROM review
+            ) c
+            GROUP BY 1, 2, 3
+            ORDER BY 1, 2, 3''')
+        expected = cursor.fetchall()
+        cursor.execute('''
+            SELECT project_id, user_id, date, nodes_created, nodes_edited,
+                   connectors_created, skeletons_created, reviews
+            FROM contribution_summary
+            WHERE nodes_created <> 0 OR nodes_edited <> 0
+               OR connectors_created <> 0 OR skeletons_created <> 0
+               OR reviews <> 0
+            ORDER BY 1, 2, 3''')
+        self.assertEqual(expected, cursor.fetchall())
+
+    def test_contribution_summary(self):
+        self.fake_authentication()
+
+        self.assertContributionSummaryIsCurrent()
+
+        response = self.client.post(
+                '/%d/treenode/create' % self.test_project_id, {
+                    'x': 5, 'y': 10, 'z': 15, 'confidence': 5,
+                    'parent_id': -1, 'radius': 2})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(
+                '/%d/connector/create' % self.test_project_id,
+                {'x': 111, 'y': 222, 'z': 333, 'confidence': 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertContributionSummaryIsCurrent()
+
+        # Edit and review nodes of other users
+        response = self.client.post(
+                '/%d/node/update' % self.test_project_id, {
+                    't[0][0]': 2368, 't[0][1]': 2990,
+                    't[0][2]': 5200, 't[0][3]': 1})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(
+                '/%d/node/%d/reviewed' % (self.test_project_id, 2368))
+        self.assertEqual(response.status_code, 200)
+        self.assertContributionSummaryIsCurrent()
+
+        response = self.client.post(
+                '/%d/treenode/delete' % self.test_project_id,
+                {'treenode_id': 265})
+        self.assertEqual(response.status_code, 200)
+        self.assertContributionSummaryIsCurrent()
+
+        response = self.client.get('/%d/stats/summary' % self.test_project_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({'treenodes_created': 1, 'connectors_created': 1,
+                          'skeletons_created': 1}, json.loads(response.content))
+
+    def test_compact_skeleton_streaming(self):
+        self.fake_authentication()
+
+        for url in ('/%d/235/1/1/compact-skeleton',
+                    '/%d/235/1/1/1/compact-arbor',
+                    '/%d/235/0/1/0/compact-arbor'):
+            url = url % self.test_project_id
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            expected = json.loads(response.content)
+            self.assertTrue(expected[0] or expected[1])
+
+            response = self.client.get(url, {'stream': 1})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            streamed = json.loads(''.join(response.streaming_content))
+            self.assertEqual(len(expected), len(streamed))
+            for e, s in zip(expected, streamed):
+                if isinstance(e, dict):
+                    self.assertEqual(e, s)
+                else:
+                    self.assertEqual(sorted(e), sorted(s))
+
+    def test_compact_skeleton_packed(self):
+        self.fake_authentication()
+
+        url = '/%d/235/1/1/compact-skeleton' % self.test_project_id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # JSON and packed responses of the same URL are cached separately
+        self.assertIn('Accept', response['Vary'])
+        nodes, connectors, tags = json.loads(response.content)
+
+        # Generic binary data is still answered with JSON
+        response = self.client.get(url,
+                HTTP_ACCEPT='application/octet-stream, application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([nodes, connectors, tags], json.loads(response.content))
+
+        for params, headers in (({'format': 'packed'}, {}),
+                ({}, {'HTTP_ACCEPT': packedarrays.MEDIA_TYPE}),
+                ({}, {'HTTP_ACCEPT': 'application/json;q=0.5, '
+                                     'application/x-catmaid-packed'})):
+            response = self.client.get(url, params, **headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(packedarrays.MEDIA_TYPE, response['Content-Type'])
+            self.assertIn('Accept', response['Vary'])
+            p_nodes, p_connectors, p_tags = packedarrays.unpack(response.content)
+            # The root's parent is -1 instead of null
+            self.assertEqual(sorted(tuple(-1 if v is None else v for v in n) for n in nodes),
+                             sorted(p_nodes))
+            self.assertEqual(sorted(tuple(c) for c in connectors), sorted(p_connectors))
+            self.assertEqual(tags, p_tags)
+
+    def test_compact_arbors(self):
+        self.fake_authentication()
+        skeleton_ids = [235, 361, 2388]
+
+        response = self.client.post(
+                '/%d/skeletons/compact-arbor' % self.test_project_id,
+                dict(('skeleton_ids[%s]' % i, skid)
+                     for i, skid in enumerate(skeleton_ids)))
+        self.assertEqual(response.status_code, 200)
+        arbors = json.loads(''.join(response.streaming_content))
+        self.assertEqual(sorted(map(str, skeleton_ids)), sorted(arbors.keys()))
+
+        for skid in skeleton_ids:
+            response = self.client.get('/%d/%d/1/1/1/compact-arbor' % (
+                    self.test_project_id, skid))
+            self.assertEqual(response.status_code, 200)
+            expected = json.loads(response.content)
+            arbor = arbors[str(skid)]
+            self.assertEqual(sorted(expected[0]), sorted(arbor[0]))
+            self.assertEqual(sorted(expected[1]), sorted(arbor[1]))
+            self.assertEqual(dict((k, sorted(v)) for k, v in expected[2].iteritems()),
+                             dict((k, sorted(v)) for k, v in arbor[2].iteritems()))
+
     def test_treenode_info_nonexisting_treenode_failure(self):
         self.fake_authentication()
         treenode_id = 55555
@@ -2479,12 +2948,13 @@ class ViewPageTests(TestCase):
                     't[0][3]': z})
         self.assertEqual(response.status_code, 200)
         parsed_response = json.loads(response.content)
-        expected_result = {'updated': 1}
-        self.assertEqual(expected_result, parsed_response)
+        self.assertEqual(1, parsed_response['updated'])
         treenode = Treenode.objects.filter(id=treenode_id)[0]
         self.assertEqual(x, treenode.location_x)
         self.assertEqual(y, treenode.location_y)
         self.assertEqual(z, treenode.location_z)
+        self.assertEqual({str(treenode_id): treenode.edition_time.isoformat()},
+                         parsed_response['edition_times'])
 
     def test_node_update_invalid_location(self):
         self.fake_authentication()
@@ -2541,8 +3011,7 @@ class ViewPageTests(TestCase):
                 '/%d/node/update' % self.test_project_id, param_dict)
         self.assertEqual(response.status_code, 200)
         parsed_response = json.loads(response.content)
-        expected_result = {'updated': 4}
-        self.assertEqual(expected_result, parsed_response)
+        self.assertEqual(4, parsed_response['updated'])
         i = 0
         for n_id in node_id:
             if types[i] == 't':
@@ -2552,6 +3021,8 @@ class ViewPageTests(TestCase):
             self.assertEqual(x[i], node.location_x)
             self.assertEqual(y[i], node.location_y)
             self.assertEqual(z[i], node.location_z)
+            self.assertEqual(node.edition_time.isoformat(),
+                             parsed_response['edition_times'][str(n_id)])
             i += 1
 
     def test_node_no_update_many_nodes(self):
@@ -2667,6 +3138,160 @@ class ViewPageTests(TestCase):
         for row in expected_c_result:
             self.assertTrue(row in parsed_response[1])
 
+    def test_node_list_cache(self):
+        self.fake_authentication()
+        cache.clear()
+        params = {
+                'sid': 3,
+                'z': 0,
+                'top': 2280,
+                'left': 4430,
+                'width': 8000,
+                'height': 3450,
+                'zres': 9,
+                'as': 373,
+                'labels': False}
+
+        def node_list():
+            response = self.client.post(
+                    '/%d/node/list' % (self.test_project_id,), params)
+            self.assertEqual(response.status_code, 200)
+            treenodes, connectors, labels, limit_reached = \
+                    json.loads(response.content)
+            # Relations of connectors are not ordered
+            connectors = [c[:5] + [sorted(r) for r in c[5:8]] + c[8:]
+                          for c in connectors]
+            return sorted(treenodes), sorted(connectors), labels, limit_reached
+
+        expected_result = node_list()
+        with self.settings(NODE_LIST_CACHE_ENABLED=True):
+            # The first request fills the cache, the second uses it
+            self.assertEqual(expected_result, node_list())
+            self.assertEqual(expected_result, node_list())
+
+            # Moving a node has to invalidate the tiles it is cached in
+            response = self.client.post(
+                    '/%d/node/update' % self.test_project_id, {
+                        't[0][0]': 289,
+                        't[0][1]': 5690,
+                        't[0][2]': 3340,
+                        't[0][3]': 0})
+            self.assertEqual(response.status_code, 200)
+            cached_result = node_list()
+
+        self.assertEqual(node_list(), cached_result)
+        moved_node = [n for n in cached_result[0] if n[0] == 289][0]
+        self.assertEqual([5690, 3340, 0], moved_node[2:5])
+
+    def test_authorization_cache(self):
+        self.fake_authentication()
+        user = User.objects.get(username='test2')
+        other_user = User.objects.get(username='test0')
+        project = Project.objects.get(pk=self.test_project_id)
+        url = '/accounts/%d/all-usernames' % self.test_project_id
+        with self.settings(AUTHORIZATION_CACHE_ENABLED=True):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('permission_error', json.loads(response.content))
+            self.assertIn('can_annotate',
+                          project_permissions(user, self.test_project_id))
+
+            # Removing a permission has to invalidate the cache
+            remove_perm('can_annotate', user, project)
+            self.assertNotIn('can_annotate',
+                             project_permissions(user, self.test_project_id))
+            response = self.client.get(url)
+            self.assertTrue(json.loads(response.content)['permission_error'])
+
+            # And so has joining a group
+            cursor = connection.cursor()
+            self.assertNotIn(other_user.id, user_domain(cursor, user.id))
+            self.assertFalse(user_can_edit(cursor, user.id, other_user.id))
+            user.groups.add(Group.objects.create(name=other_user.username))
+            self.assertIn(other_user.id, user_domain(cursor, user.id))
+            self.assertTrue(user_can_edit(cursor, user.id, other_user.id))
+
+    def test_ontology_cache(self):
+        self.fake_authentication()
+        expected_relations = get_relation_to_id_map(self.test_project_id)
+        with self.settings(ONTOLOGY_CACHE_ENABLED=True,
+                           ONTOLOGY_CACHE_CHECK_INTERVAL=60):
+            self.assertEqual(expected_relations,
+                             get_relation_to_id_map(self.test_project_id))
+            # Changes outside of the ontology views aren't seen
+            relation = Relation.objects.get(project=self.test_project_id,
+                                            relation_name='labeled_as')
+            Relation.objects.filter(id=relation.id).update(relation_name='tagged_as')
+            self.assertEqual(expected_relations,
+                             get_relation_to_id_map(self.test_project_id))
+            Relation.objects.filter(id=relation.id).update(relation_name='labeled_as')
+
+            response = self.client.post(
+                    '/%d/ontology/relations/rename' % self.test_project_id,
+                    {'relid': relation.id, 'newname': 'tagged_as'})
+            self.assertEqual(response.status_code, 200)
+            relations = get_relation_to_id_map(self.test_project_id)
+            self.assertNotIn('labeled_as', relations)
+            self.assertEqual(relation.id, relations['tagged_as'])
+
+            response = self.client.post(
+                    '/%d/ontology/classes/add' % self.test_project_id,
+                    {'classname': 'new_class'})
+            self.assertEqual(response.status_code, 200)
+            class_id = json.loads(response.content)['class_id']
+            self.assertEqual(class_id,
+                    get_class_to_id_map(self.test_project_id)['new_class'])
+
+    def test_user_analytics(self):
+        user_id = Treenode.objects.values_list('editor_id', flat=True)[0]
+        annotations = list(Treenode.objects.filter(editor_id=user_id) \
+                .values_list('edition_time', flat=True)) + \
+                list(Connector.objects.filter(editor_id=user_id) \
+                .values_list('edition_time', flat=True))
+        reviews = list(Review.objects.filter(reviewer_id=user_id) \
+                .values_list('review_time', flat=True))
+        times = sorted(annotations + reviews)
+        start = times[0].replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + datetime.timedelta((times[-1] - start).days + 1)
+
+        annotation_bins, review_bins, timeaxis = \
+                useranalytics.eventsPerInterval(user_id, start, end)
+        self.assertEqual(len(annotations), sum(annotation_bins))
+        self.assertEqual(len(reviews), sum(review_bins))
+        for t in annotations:
+            self.assertTrue(annotation_bins[(t - start).days] > 0)
+
+        bouts = useranalytics.activeTimes(user_id, start, end, 10)
+        expected_bouts = [[times[0], times[0], 1]]
+        for previous, t in zip(times, times[1:]):
+            if (t - previous).total_seconds() < 600:
+                expected_bouts[-1][1:] = [t, expected_bouts[-1][2] + 1]
+            else:
+                expected_bouts.append([t, t, 1])
+        self.assertEqual(expected_bouts,
+                         [[b.start, b.end, b.nrEvents] for b in bouts])
+
+    def test_request_instrumentation(self):
+        self.fake_authentication()
+        url = '/%d/skeleton/235/neuronname' % self.test_project_id
+        with self.settings(REQUEST_INSTRUMENTATION_ENABLED=True,
+                           REQUEST_INSTRUMENTATION_SERVER_TIMING=True,
+                           REQUEST_INSTRUMENTATION_FLUSH_INTERVAL=0):
+            instrumentation.reset()
+            for i in range(2):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+            self.assertIn('Server-Timing', response)
+            stats = instrumentation.snapshot()
+            view = stats['catmaid.control.skeleton.neuronname']
+            self.assertEqual(2, view.requests)
+            self.assertTrue(view.queries.max > 0)
+            self.assertEqual(len(response.content), view.size.max)
+
+        self.assertEqual('SELECT id FROM treenode WHERE id IN (?) AND name = ?',
+                instrumentation.fingerprint("SELECT id FROM treenode\n"
+                        "WHERE id IN (1, 2, 3) AND name = 'a''b'"))
+
     def test_textlabels_empty(self):
         self.fake_authentication()
         expected_result = {}
@@ -2973,6 +3598,288 @@ class TreenodeTests(TestCase):
             treenodeconnector__treenode__treenodeclassinstance__class_instance=skeleton)
         self.assertEqual(len(connectors), 3)
 
+class ArborTests(TestCase):
+
+    def setUp(self):
+        # A branched tree with the root 1, branch node 2 and end nodes 3 and 5
+        self.arbor = Arbor.from_ids(
+                [3, 1, 5, 2, 4],
+                [2, -1, 4, 1, 2],
+                [(0, 20, 0), (0, 0, 0), (20, 10, 0), (0, 10, 0), (10, 10, 0)])
+
+    def node_values(self, values):
+        return dict(zip(self.arbor.node_ids.tolist(), values.tolist()))
+
+    def test_topology(self):
+        self.assertEqual({1: 0, 2: 1, 3: 2, 4: 2, 5: 3},
+                         self.node_values(self.arbor.depths()))
+        ends, branches = self.arbor.end_and_branch_masks()
+        # The root has a single child and counts as an end
+        self.assertEqual(3, ends.sum())
+        self.assertEqual(1, branches.sum())
+        sequences = [self.arbor.node_ids[s].tolist()
+                     for s in self.arbor.partition()]
+        self.assertEqual([[5, 4, 2, 1], [3, 2]], sequences)
+        self.assertEqual({1: 2, 2: 2, 3: 1, 4: 1, 5: 1},
+                         self.node_values(self.arbor.strahler()))
+
+    def test_measurements(self):
+        self.assertAlmostEqual(40.0, self.arbor.cable_length())
+        self.assertEqual({1: 5, 2: 4, 3: 1, 4: 2, 5: 1},
+                         self.node_values(self.arbor.subtree_sums([1] * 5)))
+        # Only node 4 is a slab node and it lies between its neighbors
+        smooth = self.arbor.smoothed_locations()
+        self.assertEqual(self.arbor.locations.tolist(), smooth.tolist())
+
+    def test_single_node(self):
+        arbor = Arbor.from_ids([7], [-1], [(1, 2, 3)])
+        self.assertEqual([0], arbor.n_children().tolist())
+        self.assertEqual([0], arbor.depths().tolist())
+        # Like before, a lone root is neither an end nor a branch node
+        ends, branches = arbor.end_and_branch_masks()
+        self.assertEqual([False], ends.tolist())
+        self.assertEqual([False], branches.tolist())
+        self.assertEqual(0.0, arbor.cable_length())
+        self.assertEqual(0.0,
+                arbor.edge_lengths(arbor.smoothed_locations()).sum())
+        self.assertEqual([1], arbor.strahler().tolist())
+
+    def test_synapse_centrality(self):
+        # One output at end node 3 and one input at end node 5
+        inputs = self.node_values(self.arbor.node_ids * 0)
+        inputs[5] = 1
+        outputs = self.node_values(self.arbor.node_ids * 0)
+        outputs[3] = 1
+        ids = self.arbor.node_ids.tolist()
+        centrality = self.arbor.synapse_centrality(
+                [inputs[i] for i in ids], [outputs[i] for i in ids])[3]
+        # Paths are counted on the edge of each node towards the root. Only
+        # the edges of 3, 4 and 5 separate the input from the output.
+        self.assertEqual({1: 0, 2: 0, 3: 1, 4: 1, 5: 1},
+                         self.node_values(centrality))
+
+
+class SynapseClusteringTests(TestCase):
+
+    def test_tree_max_density(self):
+        # A chain of nodes 0 to 10, 100 units apart, with two clusters of
+        # synapses at either end
+        G = nx.Graph()
+        for i in xrange(10):
+            G.add_edge(i, i + 1, weight=100)
+        nodes = [0, 1, 1, 9, 10]
+        groups = tree_max_density(G, nodes, [20, 21, 22, 23, 24],
+                                  ['pre', 'post', 'pre', 'post', 'post'],
+                                  [50, 10000])
+        small = sorted((g.local_max, g.node_ids, g.connector_ids)
+                       for g in groups[50].itervalues())
+        self.assertEqual([(0, [0], [20]), (1, [1, 1], [21, 22]),
+                          (9, [9], [23]), (10, [10], [24])], small)
+        large = groups[10000].values()
+        self.assertEqual(1, len(large))
+        self.assertEqual(nodes, large[0].node_ids)
+        self.assertEqual(['pre', 'post', 'pre', 'post', 'post'],
+                         large[0].relations)
+
+
+class CroppingTests(TestCase):
+
+    def setUp(self):
+        self.tile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tile_dir)
+
+    def tile_url(self, name):
+        return 'file://' + os.path.join(self.tile_dir, name)
+
+    def test_fetch_images(self):
+        # Grayscale tiles of different widths, in the plain PGM format
+        parts = []
+        for width in xrange(1, 21):
+            name = '%s.pgm' % width
+            with open(os.path.join(self.tile_dir, name), 'w') as f:
+                f.write('P2\n%s 1\n255\n%s\n' % (width, ' 0' * width))
+            parts.append(cropping.ImagePart(self.tile_url(name),
+                                            0, width, 0, 1, 0, 0))
+        with self.settings(CROPPING_TILE_WORKERS=2,
+                           CROPPING_TILE_CACHE_SIZE=0):
+            images = cropping.fetch_images(parts)
+            self.assertEqual(range(1, 21),
+                             [image.size().width() for image in images])
+
+    def test_fetch_retries(self):
+        with open(os.path.join(self.tile_dir, 'tile.jpg'), 'w') as f:
+            f.write('tile')
+        # The first two requests time out
+        calls = []
+        timeouts = [2]
+        read_url = cropping._read_url
+        def flaky_read_url(path):
+            calls.append(path)
+            if timeouts[0]:
+                timeouts[0] -= 1
+                raise urllib2.URLError(socket.timeout('timed out'))
+            return read_url(path)
+        cropping._read_url = flaky_read_url
+        self.addCleanup(setattr, cropping, '_read_url', read_url)
+
+        with self.settings(CROPPING_TILE_RETRIES=3,
+                           CROPPING_TILE_RETRY_DELAY=0):
+            # Timeouts are repeated
+            part = cropping.ImagePart(self.tile_url('tile.jpg'),
+                                      0, 1, 0, 1, 0, 0)
+            self.assertEqual('tile', part.fetch())
+            self.assertEqual(3, len(calls))
+
+            # Missing tiles fail right away
+            del calls[:]
+            part = cropping.ImagePart(self.tile_url('missing.jpg'),
+                                      0, 1, 0, 1, 0, 0)
+            self.assertRaises(cropping.ImageRetrievalError, part.fetch)
+            self.assertEqual(1, len(calls))
+
+        self.assertTrue(cropping._is_transient(urllib2.HTTPError(
+                'http://a/0/0_0.jpg', 503, 'Unavailable', None, None)))
+        self.assertFalse(cropping._is_transient(urllib2.HTTPError(
+                'http://a/0/0_0.jpg', 404, 'Not Found', None, None)))
+        self.assertTrue(cropping._is_transient(urllib2.URLError(
+                socket.error(111, 'Connection refused'))))
+
+
+class TileCacheTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+
+    def put(self, url, data, used):
+        """ Store a tile and mark it as last used at the given time, which
+        doesn't depend on the resolution of the file system's timestamps. """
+        tilecache.put(url, data)
+        for path in (tilecache._path('refs', tilecache._digest(url)),
+                     tilecache._path('objects', tilecache._digest(data))):
+            os.utime(path, (used, used))
+
+    def test_tile_cache(self):
+        # Nothing is evicted while the tiles are stored
+        with self.settings(MEDIA_ROOT=self.media_root,
+                           CROPPING_TILE_CACHE_SIZE=10000):
+            self.assertEqual(None, tilecache.get('http://a/0/0_0.jpg'))
+            # Tiles with the same content are stored once
+            self.put('http://a/0/0_0.jpg', 'x' * 100, 1000)
+            self.put('http://a/0/0_1.jpg', 'x' * 100, 1001)
+            self.assertEqual(1, len(tilecache._files('objects')))
+
+            for i in xrange(20):
+                self.put('http://a/1/%s.jpg' % i, str(i % 10) * 90 + str(i),
+                         1002 + i)
+            self.assertEqual(1930,
+                    sum(f[1] for f in tilecache._files('objects')))
+
+        # Old tiles are removed once the cache grows too large, until it takes
+        # up at most 90% of its size.
+        with self.settings(MEDIA_ROOT=self.media_root,
+                           CROPPING_TILE_CACHE_SIZE=1000):
+            tilecache.evict()
+            objects = tilecache._files('objects')
+            self.assertEqual(9, len(objects))
+            self.assertTrue(sum(f[1] for f in objects) <= 900)
+            self.assertEqual(None, tilecache.get('http://a/0/0_0.jpg'))
+            self.assertEqual(None, tilecache.get('http://a/0/0_1.jpg'))
+            self.assertEqual(None, tilecache.get('http://a/1/10.jpg'))
+            self.assertEqual('1' * 90 + '11', tilecache.get('http://a/1/11.jpg'))
+            self.assertEqual('9' * 90 + '19', tilecache.get('http://a/1/19.jpg'))
+
+        # A size of 0 disables the cache
+        with self.settings(MEDIA_ROOT=self.media_root,
+                           CROPPING_TILE_CACHE_SIZE=0):
+            self.assertEqual(None, tilecache.get('http://a/1/19.jpg'))
+
+
+class LRUCacheTests(TestCase):
+
+    def test_lru_cache(self):
+        evicted = []
+        cache = LRUCache(10, size=len,
+                on_evict=lambda key, value: evicted.append(key))
+        cache.put('a', 'xxxx')
+        cache.put('b', 'xxxx')
+        self.assertEqual(8, cache.total)
+        # Reading an entry makes it the most recently used one
+        self.assertEqual('xxxx', cache.get('a'))
+        cache.put('c', 'xxxx')
+        self.assertEqual(['b'], evicted)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(['a', 'c'], list(cache.entries))
+        # Replacing an entry updates the total
+        cache.put('a', 'xx')
+        self.assertEqual(6, cache.total)
+        # An entry larger than the cache is kept on its own
+        cache.put('d', 'x' * 20)
+        self.assertEqual(['d'], list(cache.entries))
+        self.assertEqual(20, cache.total)
+        cache.clear()
+        self.assertEqual({}, dict(cache.entries))
+        self.assertEqual(0, cache.total)
+        self.assertEqual(['b', 'a', 'c', 'a', 'd'], evicted)
+
+
+class HDF5TileServerTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'stack.hdf')
+        self.data = np.arange(50 * 70, dtype=np.uint8).reshape(50, 70)
+        with h5py.File(self.path, 'w') as hfile:
+            hfile['/0/0/data'] = self.data
+            hfile.create_dataset('/labels/scale/0/data', (50, 70, 2),
+                                 dtype=np.uint8)
+        self.server = HDF5TileServer()
+        self.addCleanup(self.server.files.clear)
+
+    def test_read_region(self):
+        version = self.server.version(self.path)
+        dataset = self.server.open(self.path)['/0/0/data']
+        regions = [
+            (0, 0, 16, 16),    # A single chunk
+            (10, 5, 30, 20),   # Straddling several chunks
+            (60, 40, 20, 20),  # Beyond the right and lower edges
+            (0, 32, 70, 18),   # Full width, partly cached
+            (80, 60, 10, 10),  # Outside of the dataset
+        ]
+        with self.settings(HDF5_TILE_CHUNK_SIZE=16):
+            # The second time, all chunks come from the cache
+            for i in xrange(2):
+                for x, y, width, height in regions:
+                    region = self.server.read_region(self.path, version,
+                            '/0/0/data', x, y, width, height)
+                    self.assertEqual(dataset[y:y+height, x:x+width].tolist(),
+                                     region.tolist())
+            self.assertEqual(16, len(self.server.chunks.entries))
+
+    def test_blank_tile(self):
+        tile = self.server.blank_tile(30, 20)
+        self.assertEqual((30, 20), Image.open(StringIO(tile)).size)
+        self.assertTrue(tile is self.server.blank_tile(30, 20))
+        # Tiles of missing files and scales are blank
+        self.assertEqual(tile, self.server.get_tile(self.path + '.missing',
+                                                    0, 0, 0, 0, 30, 20))
+        self.assertEqual(tile, self.server.get_tile(self.path,
+                                                    1, 0, 0, 0, 30, 20))
+        self.assertNotEqual(tile, self.server.get_tile(self.path,
+                                                       0, 0, 0, 0, 30, 20))
+
+    def test_put_labels(self):
+        labels = np.ones((10, 20), dtype=np.uint8)
+        self.server.put_labels(self.path, 0, 1, 5, 15, 20, 10, labels)
+        # The file isn't kept open for writing
+        self.assertEqual(None, self.server.files.get(self.path))
+        with h5py.File(self.path, 'r') as hfile:
+            written = hfile['/labels/scale/0/data'][:, :, 1]
+        self.assertEqual(200, written.sum())
+        self.assertEqual(labels.tolist(), written[15:25, 5:25].tolist())
+
+
 class PermissionTests(TestCase):
     fixtures = ['catmaid_testdata']
 
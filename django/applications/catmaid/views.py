@@ -1,6 +1,11 @@
+import json
+
 from django.conf import settings
+from django.http import HttpResponse, HttpResponseRedirect
 from django.views.generic import TemplateView
 
+from catmaid.control import instrumentation
+
 class CatmaidView(TemplateView):
     """ This view adds extra context to its template. This extra context is
     needed for some CATMAID templates.
@@ -36,3 +41,49 @@ class ExportWidgetView(TemplateView):
         context = super(ExportWidgetView, self).get_context_data(**kwargs)
         context['catmaid_url'] = settings.CATMAID_URL
         return context
+
+class InstrumentationView(TemplateView):
+    """ Shows the request statistics collected by InstrumentationMiddleware
+    per view, sorted by total wall time. With format=json, the complete
+    histograms are returned instead. A POST request resets all statistics.
+    """
+    template_name = "catmaid/instrumentation.html"
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('format') == 'json':
+            stats = dict((view, {
+                'requests': s.requests,
+                'wall': s.wall.as_dict(),
+                'db': s.db.as_dict(),
+                'queries': s.queries.as_dict(),
+                'size': s.size.as_dict(),
+                'duplicates': s.top_duplicates(),
+            }) for view, s in instrumentation.snapshot().iteritems())
+            return HttpResponse(json.dumps(stats),
+                                content_type='application/json')
+        return super(InstrumentationView, self).get(request, *args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        instrumentation.reset()
+        return HttpResponseRedirect(request.path)
+
+    def get_context_data(self, **kwargs):
+        context = super(InstrumentationView, self).get_context_data(**kwargs)
+        context['enabled'] = instrumentation.enabled()
+        views = []
+        for view, s in instrumentation.snapshot().iteritems():
+            views.append({
+                'name': view,
+                'requests': s.requests,
+                'wall_total': s.wall.total / 1000.0,
+                'wall': [s.wall.mean(), s.wall.percentile(50),
+                         s.wall.percentile(90), s.wall.percentile(99),
+                         s.wall.max],
+                'db': [s.db.mean(), s.db.percentile(90), s.db.max],
+                'queries': [s.queries.mean(), s.queries.percentile(90),
+                            s.queries.max],
+                'size': [s.size.mean(), s.size.max],
+                'duplicates': s.top_duplicates(),
+            })
+        context['views'] = sorted(views, key=lambda v: -v['wall_total'])
+        return context
@@ -1,5 +1,6 @@
 import sys
 import gc
+import math
 import timeit
 import subprocess
 
@@ -7,6 +8,65 @@ from django.conf import settings
 from .models import TestResult
 
 
+def get_version():
+    """
+    Returns the output of 'git describe' for the current code or an empty
+    string if it isn't available.
+    """
+    try:
+        return subprocess.check_output(['git', 'describe']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of a list of values, using the nearest rank
+    method, or None if the list is empty.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def summarize(results):
+    """
+    Returns a dictionary of statistics of a list of results of a single view:
+    the number of runs, the 50th, 90th and 99th percentile of the time in
+    milliseconds and the maximum number of queries and bytes returned.
+    """
+    times = [r.time for r in results]
+    queries = [r.queries for r in results if r.queries is not None]
+    sizes = [r.size for r in results if r.size is not None]
+    return {
+        'runs': len(results),
+        'p50': percentile(times, 50),
+        'p90': percentile(times, 90),
+        'p99': percentile(times, 99),
+        'queries': max(queries) if queries else None,
+        'size': max(sizes) if sizes else None,
+    }
+
+
+def find_regressions(summary, baseline, threshold):
+    """
+    Compares the summary of a view's results with the summary of a baseline
+    and returns a list of messages for every statistic that got worse by more
+    than the given fraction. The median time is compared as well as the
+    number of queries, which is expected to be stable.
+    """
+    regressions = []
+    for key in ('p50', 'p90', 'queries', 'size'):
+        current, previous = summary[key], baseline[key]
+        if current is None or previous is None:
+            continue
+        if current > previous * (1.0 + threshold) and current > previous:
+            regressions.append("%s: %s -> %s" % (key, previous, current))
+    return regressions
+
+
 class PerformanceTest(object):
     """
     Test query performance for a set of views. It will create a new database
@@ -60,6 +120,10 @@ class PerformanceTest(object):
 
             # Optionally, make results persistent
             r.save()
+
+    The catmaid_run_performance_tests management command does this for all
+    views stored in the database, repeats every request and compares the
+    results with those of an earlier version.
     """
 
     def __init__(self, connection, username, password, template_db_name):
@@ -70,6 +134,7 @@ class PerformanceTest(object):
         """
         from django.test.client import Client
         self.connection = connection
+        self.version = get_version()
         self.username = username
         self.password = password
         self.client = Client()
@@ -169,28 +234,36 @@ class PerformanceTest(object):
 
     def test(self, view):
         """
-        Calls the given view and measures the time for it to return. The
-        garbage collector is diabled during execution.
+        Calls the given view and measures the time for it to return, together
+        with the number of SQL queries it made and the number of bytes it
+        returned. The garbage collector is diabled during execution.
         """
+        from django.test.utils import CaptureQueriesContext
         gc_old = gc.isenabled()
         gc.disable()
         try:
-            start = timeit.default_timer()
-            if view.method == 'GET':
-                response = self.client.get(view.url, view.data)
-            elif view.method == 'POST':
-                response = self.client.post(view.url, view.data)
-            else:
-                raise ValueError('Unknown view method: %s' % view.method)
-
-            end = timeit.default_timer()
+            with CaptureQueriesContext(self.connection) as queries:
+                start = timeit.default_timer()
+                if view.method == 'GET':
+                    response = self.client.get(view.url, view.data)
+                elif view.method == 'POST':
+                    response = self.client.post(view.url, view.data)
+                else:
+                    raise ValueError('Unknown view method: %s' % view.method)
+                # Streamed responses do their work while they are read
+                if response.streaming:
+                    content = ''.join(response.streaming_content)
+                else:
+                    content = response.content
+
+                end = timeit.default_timer()
             # Return result in milliseconds
             time_ms = (end - start) * 1000
-            # Try to get version information
-            version = subprocess.check_output(['git', 'describe'])
 
             return TestResult(view=view, time=time_ms, result=response,
-                              result_code=response.status_code, version=version)
+                              result_code=response.status_code,
+                              version=self.version, queries=len(queries),
+                              size=len(content))
         finally:
             if gc_old:
                 gc.enable()
@@ -12,8 +12,9 @@ class TestViewAdmin(admin.ModelAdmin):
 
 
 class TestResultAdmin(admin.ModelAdmin):
-    list_display = ('view', 'creation_time', 'time', 'result_code',
-                    trimmed_result)
+    list_display = ('view', 'creation_time', 'version', 'time', 'queries',
+                    'size', 'result_code', trimmed_result)
+    list_filter = ('version',)
     search_fields = ('view', 'result_code', 'result')
     order_by = ('creation_time',)
 
@@ -0,0 +1,116 @@
+from collections import defaultdict
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+
+from performancetests import PerformanceTest, summarize, find_regressions
+from performancetests.models import TestView, TestResult
+
+
+class Command(NoArgsCommand):
+    """ Call e.g. like
+        ./manage.py catmaid_run_performance_tests --template catmaid_benchmark \
+                --username test --password test --runs 20
+    """
+    help = "Run all registered performance test views against a copy of a " \
+           "template database, store the results and compare them to a baseline"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--template', dest='template', default=None,
+            help='The name of the database to copy for every test run, '
+                 'which should contain a fixed project to test against, e.g. '
+                 'one created by catmaid_create_synthetic_project'),
+        make_option('--username', dest='username', default=None,
+            help='The CATMAID user to make requests as'),
+        make_option('--password', dest='password', default=None,
+            help='The password of this user'),
+        make_option('--view', dest='views', action='append', type='int',
+            help='The ID of a view to test, all views are tested by default'),
+        make_option('--runs', dest='runs', type='int', default=10,
+            help='How often every view is requested'),
+        make_option('--version', dest='version', default=None,
+            help='The version to store results for, "git describe" by default'),
+        make_option('--baseline', dest='baseline', default=None,
+            help='The version to compare with, by default the latest other '
+                 'version with results of a view'),
+        make_option('--threshold', dest='threshold', type='float', default=0.2,
+            help='The fraction by which a statistic has to be worse than the '
+                 'baseline to be reported as regression'),
+        make_option('--nosave', dest='save', default=True,
+            action='store_false', help='Don\'t store the results'),
+        )
+
+    def handle_noargs(self, **options):
+        for name in ('template', 'username', 'password'):
+            if not options[name]:
+                raise CommandError("Please provide the --%s option" % name)
+        if options['runs'] < 1:
+            raise CommandError("At least one run is needed")
+
+        views = TestView.objects.all().order_by('id')
+        if options['views']:
+            views = views.filter(id__in=options['views'])
+        views = list(views)
+        if not views:
+            raise CommandError("There are no views to test, add some in the "
+                               "admin interface")
+
+        test = PerformanceTest(connection, options['username'],
+                               options['password'], options['template'])
+        if options['version']:
+            test.version = options['version']
+        results, repeat_results = test.run_tests_and_repeat(views,
+                repeats=options['runs'] - 1)
+
+        view_results = defaultdict(list)
+        for r in results + repeat_results:
+            view_results[r.view_id].append(r)
+
+        print("Version: %s" % test.version)
+        print("%-50s %6s %10s %10s %10s %8s %10s" % ('View', 'Status',
+              'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'Queries', 'Bytes'))
+        regressions = []
+        for view in views:
+            runs = view_results[view.id]
+            summary = summarize(runs)
+            status = ','.join(sorted(set(str(r.result_code) for r in runs)))
+            print("%-50s %6s %10.1f %10.1f %10.1f %8s %10s" % (
+                  str(view)[:50], status, summary['p50'], summary['p90'],
+                  summary['p99'], summary['queries'], summary['size']))
+
+            baseline = self.get_baseline(view, test.version, options['baseline'])
+            if baseline:
+                version, baseline_summary = baseline
+                for r in find_regressions(summary, baseline_summary,
+                                          options['threshold']):
+                    regressions.append("%s (compared to %s): %s" % (view,
+                                       version, r))
+
+        if options['save']:
+            for r in results + repeat_results:
+                r.save()
+
+        if regressions:
+            raise CommandError("Found %s regressions:\n%s" % (len(regressions),
+                               '\n'.join(regressions)))
+        print("No regressions found")
+
+    def get_baseline(self, view, current_version, version=None):
+        """ Return the version and the summary of the stored results of a view
+        that the current results are compared with, or None if there are
+        none. """
+        stored = TestResult.objects.filter(view=view).exclude(
+                version=current_version)
+        if version:
+            stored = stored.filter(version=version)
+        else:
+            latest = stored.order_by('-creation_time').first()
+            if not latest:
+                return None
+            version = latest.version
+            stored = stored.filter(version=version)
+        stored = list(stored)
+        if not stored:
+            return None
+        return version, summarize(stored)
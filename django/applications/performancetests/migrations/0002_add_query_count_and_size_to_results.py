@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'TestResult.queries'
+        db.add_column(u'performancetests_testresult', 'queries',
+                      self.gf('django.db.models.fields.IntegerField')(null=True, blank=True),
+                      keep_default=False)
+
+        # Adding field 'TestResult.size'
+        db.add_column(u'performancetests_testresult', 'size',
+                      self.gf('django.db.models.fields.IntegerField')(null=True, blank=True),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'TestResult.queries'
+        db.delete_column(u'performancetests_testresult', 'queries')
+
+        # Deleting field 'TestResult.size'
+        db.delete_column(u'performancetests_testresult', 'size')
+
+
+    models = {
+        u'performancetests.testresult': {
+            'Meta': {'object_name': 'TestResult'},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'queries': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'result': ('django.db.models.fields.TextField', [], {}),
+            'result_code': ('django.db.models.fields.IntegerField', [], {}),
+            'size': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'time': ('django.db.models.fields.FloatField', [], {}),
+            'version': ('django.db.models.fields.CharField', [], {'max_length': '50', 'blank': 'True'}),
+            'view': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['performancetests.TestView']"})
+        },
+        u'performancetests.testview': {
+            'Meta': {'object_name': 'TestView'},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'data': ('jsonfield.fields.JSONField', [], {'default': '{}', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'method': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'url': ('django.db.models.fields.TextField', [], {})
+        }
+    }
+
+    complete_apps = ['performancetests']
@@ -36,6 +36,9 @@ class TestResult(models.Model):
     result = models.TextField()
     creation_time = models.DateTimeField(default=datetime.now)
     version = models.CharField(blank=True, max_length=50)
+    # The number of SQL queries and the number of bytes returned
+    queries = models.IntegerField(null=True, blank=True)
+    size = models.IntegerField(null=True, blank=True)
 
     def __unicode__(self):
         return "%s (Time: %sms Status: %s)" % (self.view, self.time, self.result_code)
@@ -49,4 +52,6 @@ class TestResult(models.Model):
             result = self.result,
             creation_time = self.creation_time,
             version = self.version,
+            queries = self.queries,
+            size = self.size,
         )
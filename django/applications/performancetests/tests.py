@@ -1,3 +1,30 @@
 from django.test import TestCase
 
-# Create your tests here.
+from performancetests import percentile, summarize, find_regressions
+from performancetests.models import TestResult
+
+
+class SummaryTests(TestCase):
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3, 10, 9, 8, 7, 6]
+        self.assertEqual(5, percentile(values, 50))
+        self.assertEqual(9, percentile(values, 90))
+        self.assertEqual(10, percentile(values, 99))
+        self.assertEqual(1, percentile(values, 0))
+        self.assertEqual(None, percentile([], 50))
+
+    def test_regressions(self):
+        def results(times, queries):
+            return [TestResult(time=t, queries=queries, size=100)
+                    for t in times]
+        baseline = summarize(results([10, 11, 12], 5))
+        self.assertEqual(3, baseline['runs'])
+        self.assertEqual(11, baseline['p50'])
+
+        self.assertEqual([], find_regressions(
+                summarize(results([10, 12, 13], 5)), baseline, 0.2))
+        self.assertEqual(['p50: 11 -> 20', 'p90: 12 -> 21'], find_regressions(
+                summarize(results([19, 20, 21], 5)), baseline, 0.2))
+        self.assertEqual(['queries: 5 -> 7'], find_regressions(
+                summarize(results([10, 11, 12], 7)), baseline, 0.2))
@@ -1,6 +1,8 @@
+from collections import defaultdict
 from django.views.generic import TemplateView
 from django.core import serializers
 from .models import TestResult, TestView
+from . import summarize
 
 class TestResultDisplay(TemplateView):
     template_name = 'performancetests/test_result_display.html'
@@ -14,5 +16,17 @@ class TestResultDisplay(TemplateView):
         # Build a dictionary of views
         view_index = {r.view_id: r.view for r in test_results}
         context['view_index'] = view_index
+        # Summarize the results of every view and version
+        grouped = defaultdict(list)
+        for r in test_results:
+            grouped[(r.view_id, r.version)].append(r)
+        summaries = []
+        for (view_id, version), results in sorted(grouped.items(),
+                key=lambda g: (g[0][0], min(r.creation_time for r in g[1]))):
+            summary = summarize(results)
+            summary['view'] = view_index[view_id]
+            summary['version'] = version
+            summaries.append(summary)
+        context['summaries'] = summaries
 
         return context
@@ -24,6 +24,10 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'catmaid.middleware.InstrumentationMiddleware',
+    'catmaid.middleware.NodeListCacheMiddleware',
+    'catmaid.middleware.OntologyCacheMiddleware',
+    'catmaid.middleware.AuthorizationCacheMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -135,6 +139,50 @@ PROFILE_TRACING_OVERLAY_SCALE = 1
 # such an image will be created when requested.
 ROI_AUTO_CREATE_IMAGE = False
 
+# The tracing overlay's node lists can be assembled from cached tiles of
+# NODE_LIST_CACHE_TILE_SIZE calibrated units per section. Tiles are stored in
+# Django's cache for at most NODE_LIST_CACHE_TIMEOUT seconds and invalidated by
+# the write operations that change them. Fields of view that cover more than
+# NODE_LIST_CACHE_MAX_TILES tiles are queried directly. A cache backend shared
+# by all worker processes (e.g. memcached) is required.
+NODE_LIST_CACHE_ENABLED = False
+NODE_LIST_CACHE_TILE_SIZE = 4096
+NODE_LIST_CACHE_TIMEOUT = 300
+NODE_LIST_CACHE_MAX_TILES = 16
+
+# The relation and class ID maps of projects can be kept in memory and in
+# Django's cache for at most ONTOLOGY_CACHE_TIMEOUT seconds. Changes to a
+# project's ontology invalidate them, but other worker processes notice this
+# only after up to ONTOLOGY_CACHE_CHECK_INTERVAL seconds. A cache backend
+# shared by all worker processes (e.g. memcached) is required.
+ONTOLOGY_CACHE_ENABLED = False
+ONTOLOGY_CACHE_TIMEOUT = 3600
+ONTOLOGY_CACHE_CHECK_INTERVAL = 5
+
+# The permissions of users on projects and the users whose work they can edit
+# can be kept in Django's cache for at most AUTHORIZATION_CACHE_TIMEOUT
+# seconds. Changes to users, groups and permissions invalidate them. A cache
+# backend shared by all worker processes (e.g. memcached) is required.
+AUTHORIZATION_CACHE_ENABLED = False
+AUTHORIZATION_CACHE_TIMEOUT = 300
+
+# The wall time, database time, number of queries, duplicate queries and
+# response size of requests can be recorded per view, to be looked at on the
+# "Request statistics" admin page. Every process stores its statistics in
+# Django's cache every REQUEST_INSTRUMENTATION_FLUSH_INTERVAL seconds for at
+# most REQUEST_INSTRUMENTATION_TIMEOUT seconds, a cache backend shared by all
+# worker processes (e.g. memcached) is required. With
+# REQUEST_INSTRUMENTATION_SERVER_TIMING, responses get a Server-Timing header
+# that browsers show in their developer tools.
+REQUEST_INSTRUMENTATION_ENABLED = False
+REQUEST_INSTRUMENTATION_SERVER_TIMING = False
+REQUEST_INSTRUMENTATION_FLUSH_INTERVAL = 10
+REQUEST_INSTRUMENTATION_TIMEOUT = 86400
+
+# The reports of the user analytics admin page are cached per user and date
+# range for USER_ANALYTICS_CACHE_TIMEOUT seconds.
+USER_ANALYTICS_CACHE_TIMEOUT = 900
+
 # Default importer tile width and height
 IMPORTER_DEFAULT_TILE_WIDTH = 256
 IMPORTER_DEFAULT_TILE_HEIGHT = 256
@@ -147,12 +195,44 @@ MEDIA_HDF5_SUBDIRECTORY = 'hdf5'
 MEDIA_CROPPING_SUBDIRECTORY = 'cropping'
 MEDIA_ROI_SUBDIRECTORY = 'roi'
 MEDIA_TREENODE_SUBDIRECTORY = 'treenode_archives'
+MEDIA_TILE_CACHE_SUBDIRECTORY = 'tile_cache'
 
 # The maximum allowed size in Bytes for generated files. The cropping tool, for
 # instance, uses this to cancel a request if the generated file grows larger
 # than this. This defaults to 50 Megabyte.
 GENERATED_FILES_MAXIMUM_SIZE = 52428800
 
+# The cropping tool fetches and decodes the tiles of a job with a pool of
+# CROPPING_TILE_WORKERS threads per process. Requests that fail because of
+# connection problems or server errors are repeated up to CROPPING_TILE_RETRIES
+# times, waiting CROPPING_TILE_RETRY_DELAY seconds before the first repetition
+# and twice as long before every following one.
+CROPPING_TILE_WORKERS = 8
+CROPPING_TILE_TIMEOUT = 30
+CROPPING_TILE_RETRIES = 3
+CROPPING_TILE_RETRY_DELAY = 0.5
+
+# Tiles read by the cropping tool and the treenode and connector exports can be
+# cached in the MEDIA_TILE_CACHE_SUBDIRECTORY folder. The least recently used
+# tiles are removed when it grows larger than CROPPING_TILE_CACHE_SIZE Bytes,
+# 0 disables the cache. This defaults to 0, 1073741824 would allow 1 Gigabyte.
+CROPPING_TILE_CACHE_SIZE = 0
+
+# Treenode and connector exports crop the regions of nodes with a pool of
+# NODE_EXPORT_WORKERS processes, None uses one per CPU. Progress is reported
+# to the user every NODE_EXPORT_PROGRESS_INTERVAL seconds.
+NODE_EXPORT_WORKERS = None
+NODE_EXPORT_PROGRESS_INTERVAL = 10
+
+# The HDF5 tile server keeps up to HDF5_TILE_MAX_OPEN_FILES files open per
+# process. It caches decoded blocks of HDF5_TILE_CHUNK_SIZE x
+# HDF5_TILE_CHUNK_SIZE pixels up to HDF5_TILE_CHUNK_CACHE_SIZE Bytes and PNG
+# encoded tiles up to HDF5_TILE_CACHE_SIZE Bytes.
+HDF5_TILE_MAX_OPEN_FILES = 16
+HDF5_TILE_CHUNK_SIZE = 256
+HDF5_TILE_CHUNK_CACHE_SIZE = 67108864
+HDF5_TILE_CACHE_SIZE = 33554432
+
 # Specifies if user registration is allowed
 USER_REGISTRATION_ALLOWED = False
 
@@ -14,4 +14,7 @@ cat <<EOSQL
 CREATE ROLE "$CATMAID_USER" LOGIN PASSWORD '$CATMAID_PASSWORD';
 
 CREATE DATABASE "$CATMAID_DATABASE" OWNER "$CATMAID_USER";
+
+\\connect "$CATMAID_DATABASE"
+CREATE EXTENSION postgis;
 EOSQL